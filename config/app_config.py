@@ -9,6 +9,66 @@ make_payments = True
 
 aws={}
 
+# limits for imageupload questions; images are hashed in a pool of worker processes
+# and stored in GridFS or in a directory ("filesystem", defaults to images/); images
+# that no response uses upload_seconds after they were stored are removed
+image_upload = {"workers" : 2,
+                "max_bytes" : 16*1024*1024,
+                "max_pixels" : 40000000,
+                "timeout" : 10.0,
+                "upload_seconds" : 86400.0,
+                "storage" : "gridfs",
+                "path" : None}
+
+# the storage engine of the survey database, "mongodb" or "sqlite"; SQLite keeps the
+# database in the file <db_name>.sqlite3 in path (defaults to db/)
+storage = {"engine" : "mongodb",
+           "uri" : None,
+           "path" : None}
+
+# the incremental export /admin/export/responses; pipelines authenticate with token
+# (Authorization: Bearer <token>), responses are exported once settle_seconds old
+export = {"token" : None,
+          "settle_seconds" : 5.0}
+
+# cHITs are handed to other workers once their worker's browser has not pinged for
+# stale_seconds; browsers connected over the worker socket are pinged by the server every
+# heartbeat_seconds and their cHITs become stale heartbeat_seconds after they disconnect
+workers = {"stale_seconds" : 30.0,
+           "heartbeat_seconds" : 5.0}
+
+# the auxiliary collections are compacted every interval_seconds: the event log keeps the
+# last max_events events, workers who have not moved on for abandoned_seconds release
+# their cHITs and unused images are removed
+compaction = {"interval_seconds" : 600.0,
+              "max_events" : 1000,
+              "abandoned_seconds" : 86400.0}
+
+# admission control of the worker endpoints: at most concurrency requests are served at
+# a time and up to queue more wait; requests that find the queue full or would be served
+# more than deadline seconds after they arrived are answered 503 with Retry-After at once
+admission = {"view" : {"concurrency" : 8, "queue" : 64, "deadline" : 2.0, "retry_after" : 2.0},
+             "submit" : {"concurrency" : 8, "queue" : 128, "deadline" : 5.0, "retry_after" : 2.0},
+             "ping" : {"concurrency" : 4, "queue" : 32, "deadline" : 1.0, "retry_after" : 5.0},
+             "upload" : {"concurrency" : 4, "queue" : 16, "deadline" : 5.0, "retry_after" : 5.0}}
+
+# how submitted responses are stored: "acknowledged" inserts each response on its own,
+# "group_commit" inserts the responses arriving within delay seconds together and answers
+# the workers once the batch is stored (delay has to stay well below the settle_seconds
+# of the export); write_concern is passed to MongoDB, e.g. {"w" : "majority", "j" : true}
+responses = {"mode" : "acknowledged",
+             "delay" : 0.005,
+             "max_batch" : 500,
+             "write_concern" : {}}
+
+# the replies to submissions carrying a request id of the worker's browser are kept for
+# result_seconds (at most max_results), so that a retried submission gets the same reply
+submissions = {"result_seconds" : 300.0,
+               "max_results" : 10000}
+
+# when a run ends, the bonus of the workers is computed in a pool of worker processes
+bonus = {"workers" : 2}
+
 def populate_config(filename):
     global superadmins
     global google
@@ -17,6 +77,15 @@ def populate_config(filename):
     global db_name
     global make_payments
     global aws
+    global image_upload
+    global storage
+    global export
+    global workers
+    global compaction
+    global admission
+    global responses
+    global submissions
+    global bonus
 
     import json
     with open("../config/"+filename) as json_file: 
@@ -28,4 +97,22 @@ def populate_config(filename):
         db_name=data["db_name"]
         make_payments=data["make_payments"]
         aws=data["aws"]
+        if "image_upload" in data:
+            image_upload.update(data["image_upload"])
+        if "storage" in data:
+            storage.update(data["storage"])
+        if "export" in data:
+            export.update(data["export"])
+        if "workers" in data:
+            workers.update(data["workers"])
+        if "compaction" in data:
+            compaction.update(data["compaction"])
+        for endpoint, limits in data.get("admission", {}).items():
+            admission.setdefault(endpoint, {}).update(limits)
+        if "responses" in data:
+            responses.update(data["responses"])
+        if "submissions" in data:
+            submissions.update(data["submissions"])
+        if "bonus" in data:
+            bonus.update(data["bonus"])
        
\ No newline at end of file
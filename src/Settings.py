@@ -11,6 +11,8 @@ TMP_PATH = os.path.join(DIRNAME, '..', 'tmp')
 LOG_PATH = os.path.join(DIRNAME, '..', 'log')
 PIDFILE_PATH = os.path.join(DIRNAME, '..', 'pid')
 CONFIG_PATH = os.path.join(DIRNAME, '..', 'config')
+IMAGE_PATH = os.path.join(DIRNAME, '..', 'images')
+DB_PATH = os.path.join(DIRNAME, '..', 'db')
 DOC_PATH = os.path.join(DIRNAME, '..', 'doc')
 
 try :
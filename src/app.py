@@ -4,7 +4,6 @@ import tornado.httpserver
 import tornado.ioloop
 import tornado.options
 import tornado.web
-import pymongo
 import uuid
 import base64
 import hashlib
@@ -28,17 +27,20 @@ sys.path.pop(0)
 
 import controllers
 import handlers
+import helpers
+import storage
 
 def random256() :
     return base64.b64encode(uuid.uuid4().bytes + uuid.uuid4().bytes)
  
 class Application(tornado.web.Application):
     def __init__(self, drop):
-        self.db = pymongo.MongoClient()[app_config.db_name]
+        storage_config = dict(app_config.storage, path=app_config.storage['path'] or Settings.DB_PATH)
         if drop == "REALLYREALLY" :
-            pymongo.MongoClient().drop_database(app_config.db_name)        
+            storage.drop_database(app_config.db_name, **storage_config)
             print("Cleared.")
             sys.exit(0)
+        database = storage.open_database(app_config.db_name, **storage_config)
 
         settings = {
             "template_path":Settings.TEMPLATE_PATH,
@@ -49,7 +51,10 @@ class Application(tornado.web.Application):
             "root_path": Settings.ROOT_PATH,
             "login_url": "/admin/login/",
             "environment" : app_config.environment,
-            "google_oauth" :{"key": app_config.google['client_id'], "secret": app_config.google['client_secret']}           
+            "google_oauth" :{"key": app_config.google['client_id'], "secret": app_config.google['client_secret']},
+            # closes worker sockets whose browser stopped answering
+            "websocket_ping_interval" : app_config.workers['heartbeat_seconds'],
+            "websocket_ping_timeout" : 2 * app_config.workers['heartbeat_seconds']
         }
 
         app_handlers = [
@@ -65,6 +70,7 @@ class Application(tornado.web.Application):
             (r'/admin/login/?', handlers.GoogleLoginHandler),
             (r'/admin/logout/?', handlers.LogoutHandler),
             (r'/admin/download/?', handlers.CSVDownloadHandler),
+            (r'/admin/export/responses/?', handlers.ResponseExportHandler),
             (r'/admin/recruit/?', handlers.RecruitingInfoHandler),
             (r'/admin/recruit/end/?', handlers.RecruitingEndHandler),
             (r'/admin/recruit/begin/?', handlers.RecruitingBeginHandler),
@@ -72,37 +78,91 @@ class Application(tornado.web.Application):
             (r'/admin/new/?', handlers.AdminCreateHandler),
             (r'/admin/remove/?', handlers.AdminRemoveHandler),
             (r'/admin/info/?', handlers.AdminInfoHandler),
+            (r'/admin/live/?', handlers.AdminLiveHandler),
+            (r'/admin/metrics/?', handlers.AdminMetricsHandler),
             (r'/admin/hits/?', handlers.AdminHitInfoHandler),
             (r'/admin/bonusinfo/?', handlers.BonusInfoHandler),
             (r'/admin/hits/(.+)', handlers.AdminHitInfoHandler),
             (r'/admin/tasks/(.+)', handlers.AdminTaskInfoHandler),
             (r'/superadmin/?()', tornado.web.StaticFileHandler, dict(path=settings['static_path'], default_filename='superadmin.html')),
             (r'/admin/xmlupload/?', handlers.XMLUploadHandler),
+            (r'/admin/images/(.+)', handlers.AdminImageHandler),
             (r'/document/(.+)', handlers.DocumentViewHandler),
             (r'/HIT/?()', tornado.web.StaticFileHandler, dict(path=settings['static_path'], default_filename='hit.html')),
             (r'/HIT/view/?', handlers.CHITViewHandler),
             (r'/HIT/submit/?', handlers.CResponseHandler),
+            (r'/HIT/upload/?', handlers.ImageUploadHandler),
+            (r'/HIT/modules/?', handlers.CTypeModulesHandler),
             (r'/HIT/return/?', handlers.CHITReturnHandler),
             (r'/worker/login/?', handlers.WorkerLoginHandler),
             (r'/worker/ping/?', handlers.WorkerPingHandler),
+            (r'/worker/socket/?', handlers.WorkerSocketHandler),
             (r'.*()', tornado.web.StaticFileHandler, dict(path=settings['static_path'], default_filename='404.html'))
         ]
         tornado.web.Application.__init__(self, app_handlers, **settings)
 
+        # the survey collections resolve to the generation that is currently active
+        self.survey_controller = controllers.SurveyController(database)
+        self.db = controllers.GenerationalDatabase(database, self.survey_controller)
         self.currentstatus_controller = controllers.CurrentStatusController(self.db)
         self.ctype_controller = controllers.CTypeController(self.db)
         self.ctask_controller = controllers.CTaskController(self.db)
         self.admin_controller = controllers.AdminController(self.db)
-        self.chit_controller = controllers.CHITController(self.db)
+        self.chit_controller = controllers.CHITController(self.db,
+                                                          stale_seconds=app_config.workers['stale_seconds'])
         self.set_controller = controllers.SetController(self.db)
         self.cdocument_controller = controllers.CDocumentController(self.db)
         self.xmltask_controller = controllers.XMLTaskController(self.db)
-        self.cresponse_controller = controllers.CResponseController(self.db)
+        self.cresponse_controller = controllers.CResponseController(self.db,
+                                                                    settle_seconds=app_config.export['settle_seconds'])
         self.mturkconnection_controller = controllers.MTurkConnectionController(self.db)
         self.event_controller = controllers.EventController(self.db)
+        self.workerping_controller = controllers.WorkerPingController(self.db,
+                                                                      stale_seconds=app_config.workers['stale_seconds'])
+        # the worker sockets open in this server process
+        self.worker_sockets = set()
+        self.dashboard_controller = controllers.DashboardController(self.chit_controller,
+                                                                    self.cresponse_controller,
+                                                                    self.currentstatus_controller,
+                                                                    self.event_controller)
+        self.payload_cache = helpers.GenerationCache()
+        self.metrics = helpers.Metrics()
+        if (app_config.responses['mode'] == 'group_commit' and
+                app_config.responses['delay'] >= app_config.export['settle_seconds']) :
+            raise ValueError("The delay of the group commit has to be below the settle_seconds of the export.")
+        self.response_writer = controllers.ResponseWriter(self.cresponse_controller, self.metrics, **app_config.responses)
+        self.submission_results = helpers.ResultCache(ttl=app_config.submissions['result_seconds'],
+                                                      max_entries=app_config.submissions['max_results'])
+        self.admission = {endpoint : helpers.AdmissionLimiter(endpoint, self.metrics, **limits)
+                          for endpoint, limits in app_config.admission.items()}
+        self.cimage_controller = controllers.CImageController(database,
+                                                              storage=app_config.image_upload['storage'],
+                                                              path=app_config.image_upload['path'] or Settings.IMAGE_PATH,
+                                                              upload_seconds=app_config.image_upload['upload_seconds'])
+        self.compaction_controller = controllers.CompactionController(self.db,
+                                                                      self.event_controller,
+                                                                      self.chit_controller,
+                                                                      self.currentstatus_controller,
+                                                                      self.workerping_controller,
+                                                                      self.metrics,
+                                                                      max_events=app_config.compaction['max_events'],
+                                                                      abandoned_seconds=app_config.compaction['abandoned_seconds'],
+                                                                      cresponse_controller=self.cresponse_controller,
+                                                                      cimage_controller=self.cimage_controller)
+        self.bonus_controller = controllers.BonusController(self.db, self.survey_controller, self.metrics,
+                                                            app_config.db_name, storage_config,
+                                                            workers=app_config.bonus['workers'])
+        self.image_processor = helpers.ImageProcessor(workers=app_config.image_upload['workers'],
+                                                      max_bytes=app_config.image_upload['max_bytes'],
+                                                      max_pixels=app_config.image_upload['max_pixels'],
+                                                      timeout=app_config.image_upload['timeout'])
 
         if app_config.make_payments :
             self.ensure_automatic_make_payments()
+        self.ensure_garbage_collection()
+        self.ensure_dashboard()
+        self.ensure_worker_heartbeat()
+        self.ensure_compaction()
     
     @property
     def logging(self) :
@@ -127,6 +187,57 @@ class Application(tornado.web.Application):
         # run this from the main ioloop just in case we have multiple threads
         tornado.ioloop.IOLoop.instance().add_callback(_ensure)
 
+    def ensure_garbage_collection(self) :
+        """Periodically drops the survey generations that were replaced by an upload."""
+        def collect() :
+            try :
+                self.survey_controller.collect_garbage()
+            except :
+                self.logging.exception("Error in garbage collection.")
+        def callback() :
+            tornado.ioloop.IOLoop.current().run_in_executor(None, collect)
+        pc = tornado.ioloop.PeriodicCallback(callback, 1000 * controllers.SurveyController.gc_delay)
+        pc.start()
+
+    def ensure_dashboard(self) :
+        """Pushes the changes of the run status to the admins watching /admin/live."""
+        async def callback() :
+            try :
+                await self.dashboard_controller.refresh()
+            except :
+                self.logging.exception("Error in dashboard refresh.")
+        pc = tornado.ioloop.PeriodicCallback(callback, 1000)
+        pc.start()
+
+    def ensure_worker_heartbeat(self) :
+        """Pings the cHITs of the workers connected over /worker/socket together, so
+           that their browsers need not send pings."""
+        def heartbeat(workerids) :
+            try :
+                self.workerping_controller.ping_many(self.currentstatus_controller.hits_of_workers(workerids))
+            except :
+                self.logging.exception("Error in worker heartbeat.")
+        def callback() :
+            workerids = set(s.worker_id for s in self.worker_sockets)
+            if workerids :
+                tornado.ioloop.IOLoop.current().run_in_executor(None, heartbeat, workerids)
+        pc = tornado.ioloop.PeriodicCallback(callback, 1000 * app_config.workers['heartbeat_seconds'])
+        pc.start()
+
+    def ensure_compaction(self) :
+        """Periodically bounds the event log and the worker collections and removes the
+           uploaded images that no response uses."""
+        def compact() :
+            try :
+                removed = self.compaction_controller.compact()
+                self.logging.info("Compaction removed %s" % removed)
+            except :
+                self.logging.exception("Error in compaction.")
+        def callback() :
+            tornado.ioloop.IOLoop.current().run_in_executor(None, compact)
+        pc = tornado.ioloop.PeriodicCallback(callback, 1000 * app_config.compaction['interval_seconds'])
+        pc.start()
+
 def start() :
     application = Application(drop=options.drop)
     http_server = tornado.httpserver.HTTPServer(application)
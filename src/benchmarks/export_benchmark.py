@@ -0,0 +1,96 @@
+# Compares the tab-separated question responses of /admin/download with the long
+# and wide Parquet tables of /admin/download?format=parquet for 20000 task
+# responses of 10 questions each: the time to export, the size and the time to
+# load the file for analysis (pandas when installed, else csv and pyarrow).
+#
+# Run from the src directory:  python benchmarks/export_benchmark.py
+
+import csv
+import datetime
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import controllers
+import storage
+from helpers import export_machine
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+TASK_RESPONSES = 20000
+WORKERS = 500
+
+
+def fill(controller):
+    rnd = random.Random(1)
+    start = datetime.datetime(2026, 1, 1)
+    for i in range(TASK_RESPONSES):
+        controller.create({'submitted' : start + datetime.timedelta(seconds=i),
+                           'workerid' : 'A%013d' % (i % WORKERS), 'hitid' : 'hit%d' % (i // 4),
+                           'taskid' : 'task%d' % (i % 997),
+                           'response' : [{'name' : 'module%d' % m,
+                                          'responses' : [{'varname' : 'q%d' % q,
+                                                          'response' : str(rnd.randint(1, 7)) if q < 4 else
+                                                                       'free text answer %d' % rnd.randint(0, 50)}
+                                                         for q in range(5)]}
+                                         for m in range(2)]})
+    return ['A%013d' % w for w in range(WORKERS)]
+
+
+def load_tsv(data):
+    if pandas is not None:
+        return pandas.read_csv(io.BytesIO(data), sep='\t')
+    return list(csv.reader(io.StringIO(data.decode('utf8')), delimiter='\t'))
+
+
+def load_parquet(data):
+    if pandas is not None:
+        return pandas.read_parquet(io.BytesIO(data))
+    return export_machine.pyarrow.parquet.read_table(io.BytesIO(data))
+
+
+def measure(label, export, load):
+    start = time.perf_counter()
+    data = export()
+    exported = time.perf_counter() - start
+    start = time.perf_counter()
+    load(data)
+    loaded = time.perf_counter() - start
+    print("%-28s export %7.0f ms  %9.1f KiB  load %7.1f ms" % (label, 1e3 * exported, len(data) / 1024, 1e3 * loaded))
+
+
+if __name__ == '__main__':
+    if export_machine.pyarrow is None:
+        sys.exit("pyarrow is not installed")
+    directory = tempfile.mkdtemp()
+    try:
+        database = storage.open_database('benchmark', 'sqlite', path=directory)
+        controller = controllers.CResponseController(database)
+        workers = fill(controller)
+        print("%d task responses, loaded with %s" % (TASK_RESPONSES, "pandas" if pandas is not None else "csv/pyarrow"))
+
+        def tsv():
+            output = io.StringIO()
+            controller.write_question_responses_to_csv(csv.writer(output, delimiter='\t'), workers)
+            return output.getvalue().encode('utf8')
+        def parquet(write):
+            def export():
+                sink = io.BytesIO()
+                write(sink, workers)
+                return sink.getvalue()
+            return export
+        measure("question_responses.tsv", tsv, load_tsv)
+        measure("question_responses.parquet", parquet(controller.write_question_responses_to_parquet), load_parquet)
+        measure("question_responses_wide", parquet(controller.write_wide_question_responses_to_parquet), load_parquet)
+        database.close()
+    finally:
+        shutil.rmtree(directory)
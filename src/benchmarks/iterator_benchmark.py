@@ -0,0 +1,93 @@
+# Expands a question with a 4-dimension iterator (6^4 = 1296 instances) with the
+# compiled templates of XMLTask.expand_question and with the original expansion,
+# which replaced every placeholder in every string and parsed every condition again.
+#
+# Run from the src directory:  python benchmarks/iterator_benchmark.py
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import product
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import jsonpickle
+from helpers.lexer_machine import Lexer, Status
+from models.question import Question
+from models.xmltask import XMLTask
+
+DIMENSIONS = ['country', 'topic', 'outlet', 'week']
+INSTANCES = 6
+
+
+def survey_xml():
+    dimensions = ''.join(
+        '<dimension><name>%s</name><instances>%s</instances></dimension>' % (name, ''.join(
+            '<instance><kvpairs><kvpair><key>id</key><value>%s%d</value></kvpair>'
+            '<kvpair><key>label</key><value>%s number %d</value></kvpair></kvpairs></instance>' % (name, i, name, i)
+            for i in range(INSTANCES)))
+        for name in DIMENSIONS)
+    ids = '_'.join('{%s:id}' % name for name in DIMENSIONS)
+    labels = ', '.join('{%s:label}' % name for name in DIMENSIONS)
+    return ('<xml><modules><module><header>Coverage</header><name>coverage</name><questions><question>'
+            '<varname>covered_%s</varname><iterator><dimensions>%s</dimensions></iterator>'
+            '<condition><![CDATA[(seen_{country:id}=="yes" & rank_{topic:id}>=2) | exists{read_{outlet:id}_{week:id}}]]></condition>'
+            '<questiontext>Does the article cover %s?</questiontext><helptext>%s</helptext><valuetype>categorical</valuetype>'
+            '<content><categories><category><text>Yes</text><value>yes</value></category>'
+            '<category><text>No</text><value>no</value></category></categories></content>'
+            '</question></questions></module></modules><tasks/><hits/></xml>') % (ids, dimensions, labels, labels)
+
+
+def legacy_expand(xmltask, question):
+    dimensions = xmltask.get_dimensions(question)
+    questions = []
+    for D in product(*dimensions):
+        varname = question.find('varname').text
+        conditionStr = question.find('condition').text
+        questionText = question.find('questiontext').text
+        helpText = question.find('helptext').text
+        for instance in D:
+            for key in instance:
+                varname = varname.replace(key, instance[key])
+                conditionStr = conditionStr.replace(key, instance[key])
+                questionText = questionText.replace(key, instance[key])
+                helpText = helpText.replace(key, instance[key])
+        lex = Lexer()
+        status = Status()
+        if not lex.can_import(conditionStr, status):
+            raise Exception(status.error)
+        questions.append({'varname' : varname,
+                          'condition' : jsonpickle.encode(lex),
+                          'questiontext' : questionText,
+                          'helptext' : helpText,
+                          'options' : xmltask.get_options(question),
+                          'content' : Question.parse_content_from_xml(question.find('valuetype').text,
+                                                                      question.find('content'))})
+    return questions
+
+
+def measure(label, fn):
+    start = time.perf_counter()
+    count = fn()
+    elapsed = time.perf_counter() - start
+    # the allocations are traced in a second run, tracing slows the expansion down
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("%-32s %6d questions %8.1f ms  peak %8.1f KiB" % (label, count, elapsed * 1000, peak / 1024.0))
+
+
+if __name__ == '__main__':
+    with tempfile.NamedTemporaryFile('w', suffix='.xml', delete=False) as f:
+        f.write(survey_xml())
+    try:
+        xmltask = XMLTask(f.name)
+    finally:
+        os.remove(f.name)
+    question = next(xmltask.modules.iter('question'))
+    measure("original expansion", lambda: len(legacy_expand(xmltask, question)))
+    measure("compiled templates (list)", lambda: len(list(xmltask.expand_question(question))))
+    measure("compiled templates (streamed)", lambda: sum(1 for q in xmltask.expand_question(question)))
@@ -0,0 +1,52 @@
+# Times the single-pass condition parser (Lexer.can_import) on the conditions of
+# the example surveys and on long generated conditions.
+#
+# Run from the src directory:  python benchmarks/lexer_benchmark.py
+
+import glob
+import os
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from helpers.lexer_machine import Lexer, Status
+
+ROOT_PATH = os.path.join(os.path.dirname(__file__), '..', '..')
+
+
+def example_conditions():
+    conditions = []
+    paths = glob.glob(os.path.join(ROOT_PATH, 'examples', '**', '*.xml'), recursive=True)
+    paths += glob.glob(os.path.join(ROOT_PATH, 'src', 'tests', '*.xml'))
+    for path in paths:
+        try:
+            root = ET.parse(path).getroot()
+        except ET.ParseError:
+            continue
+        for condition in root.iter('condition'):
+            if condition.text and condition.text.strip():
+                conditions.append(condition.text)
+    return conditions
+
+
+def generated_conditions(n):
+    clause = '(q%d=="yes" | q%d>=3)'
+    return ['&'.join(clause % (i, i) for i in range(size)) for size in (10, 100, n)]
+
+
+def parse(condition_str):
+    Lexer().can_import(condition_str, Status())
+
+
+def bench(label, conditions, repeat):
+    seconds = min(timeit.repeat(lambda: [parse(c) for c in conditions], number=1, repeat=repeat))
+    print('%-28s %10.3f ms' % (label, seconds * 1000))
+
+
+if __name__ == '__main__':
+    conditions = example_conditions()
+    print('%d conditions from the example surveys' % len(conditions))
+    bench('example surveys (x100)', conditions * 100, 5)
+    for condition_str in generated_conditions(2000):
+        bench('%d characters' % len(condition_str), [condition_str], 3)
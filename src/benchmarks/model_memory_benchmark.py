@@ -0,0 +1,111 @@
+# Memory used by the models of a bonus run over 100k responses: 100k cResponses,
+# the 2000 cHITs they belong to (50 completed hits each) and a module with 40
+# questions of which 4 carry bonus points. The documents are decoded from BSON as
+# the driver would. The original classes kept a __dict__ per object, deserialized
+# every question of a module and read the whole cHIT, including completed_hits,
+# where the views only need CHIT.view_fields.
+#
+# Run from the src directory:  python benchmarks/model_memory_benchmark.py
+
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+
+import bson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+from models import CHIT, CResponse, CType
+from models.question import Question
+
+RESPONSES = 100000
+WORKERS_PER_HIT = 50
+TASKS_PER_HIT = RESPONSES // (2000 * WORKERS_PER_HIT)
+QUESTIONS = 40
+BONUS_QUESTIONS = 4
+
+
+class LegacyCResponse(object):
+    def __init__(self, submitted=None, response=None, taskid=None, hitid=None, workerid=None):
+        self.submitted = submitted
+        self.response = response
+        self.taskid = taskid
+        self.hitid = hitid
+        self.workerid = workerid
+
+
+class LegacyCHIT(object):
+    def __init__(self, hitid=None, exclusions=[], tasks=[], taskconditions=[], completed_hits=[], num_completed_hits=None, **kwargs):
+        self.hitid = hitid
+        self.tasks = tasks
+        self.taskconditions = taskconditions
+        self.completed_hits = completed_hits
+        self.exclusions = exclusions
+        self.num_completed_hits = num_completed_hits
+
+
+def documents():
+    submitted = datetime.datetime(2026, 1, 1)
+    chits = [{'hitid' : 'hit%d' % h,
+              'tasks' : ['task%d' % (h * TASKS_PER_HIT + t) for t in range(TASKS_PER_HIT)],
+              'taskconditions' : [None] * TASKS_PER_HIT,
+              'exclusions' : [],
+              'completed_hits' : [{'worker_id' : 'W%d' % w, 'turk_verify_code' : '%016x' % (h * w)}
+                                  for w in range(WORKERS_PER_HIT)],
+              'num_completed_hits' : WORKERS_PER_HIT}
+             for h in range(2000)]
+    responses = [{'submitted' : submitted,
+                  'response' : [{'name' : 'coverage', 'responses' : [{'varname' : 'q0', 'response' : 'yes'}]}],
+                  'taskid' : chit['tasks'][t],
+                  'hitid' : chit['hitid'],
+                  'workerid' : hit['worker_id']}
+                 for chit in chits for hit in chit['completed_hits'] for t in range(TASKS_PER_HIT)]
+    module = {'name' : 'coverage', 'header' : 'Coverage', 'contentUpdate' : None,
+              'questions' : [Question.deserialize({'varname' : 'q%d' % i, 'condition' : None,
+                                                   'questiontext' : 'Question %d?' % i, 'helptext' : '',
+                                                   'options' : None, 'valuetype' : 'categorical',
+                                                   'bonus' : 'linear' if i < BONUS_QUESTIONS else None,
+                                                   'bonuspoints' : 1.0,
+                                                   'content' : [{'text' : 'Yes', 'value' : 'yes', 'aprioripermissable' : False},
+                                                                {'text' : 'No', 'value' : 'no', 'aprioripermissable' : False}]}).serialize()
+                             for i in range(QUESTIONS)]}
+    return chits, responses, module
+
+
+def legacy_run(chits, responses, module):
+    views = [LegacyCHIT(**bson.decode(d)) for d in chits['full']]
+    modules = [[Question.deserialize(q) for q in bson.decode(module)['questions']] for i in range(100)]
+    return [LegacyCResponse(**bson.decode(d)) for d in responses], views, modules
+
+
+def slotted_run(chits, responses, module):
+    views = [CHIT.deserialize(bson.decode(d), CHIT.view_fields) for d in chits['view']]
+    modules = []
+    for i in range(100):
+        ctype = CType.from_dict(bson.decode(module))
+        modules.append([ctype.get_question('q%d' % q) for q in range(BONUS_QUESTIONS)])
+    return [CResponse(**bson.decode(d)) for d in responses], views, modules
+
+
+def measure(label, fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    models = fn(*args)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-28s %8.1f ms  held %8.1f MiB  peak %8.1f MiB" % (label, elapsed * 1000, current / 2.0**20, peak / 2.0**20))
+    return models
+
+
+if __name__ == '__main__':
+    chits, responses, module = documents()
+    encoded = ({'full' : [bson.encode(d) for d in chits],
+                'view' : [bson.encode({f : d[f] for f in CHIT.view_fields}) for d in chits]},
+               [bson.encode(d) for d in responses],
+               bson.encode(module))
+    print("%d responses, %d cHITs, %d questions per module" % (len(responses), len(chits), QUESTIONS))
+    measure("__dict__ models", legacy_run, *encoded)
+    measure("slotted, lazy models", slotted_run, *encoded)
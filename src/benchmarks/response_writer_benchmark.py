@@ -0,0 +1,85 @@
+# Submits 20000 responses from 200 concurrent workers through the response writer
+# in each mode, as the submit handlers do on the IOLoop, and reports the throughput,
+# the batch sizes and the time until a worker's response is stored. MongoDB is
+# measured when a server answers on localhost.
+#
+# Run from the src directory:  python benchmarks/response_writer_benchmark.py
+
+import asyncio
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import pymongo
+import tornado.ioloop
+import controllers
+import helpers
+import storage
+
+RESPONSES = 20000
+WORKERS = 200
+
+
+def response(workerid, i):
+    return {'submitted' : datetime.datetime.utcnow(),
+            'response' : [{'name' : 'm', 'responses' : [{'varname' : 'q%d' % q, 'response' : q} for q in range(10)]}],
+            'workerid' : workerid, 'hitid' : 'h%d' % (i % 50), 'taskid' : 't%d' % i}
+
+
+async def submit(writer):
+    async def worker(w):
+        for i in range(RESPONSES // WORKERS):
+            await writer.write(response('W%d' % w, i))
+            # the rest of the request and the worker's think time
+            await asyncio.sleep(0)
+    await asyncio.gather(*[worker(w) for w in range(WORKERS)])
+
+
+def run(database, mode, **options):
+    database.drop_collection('cresponses')
+    metrics = helpers.Metrics()
+    writer = controllers.ResponseWriter(controllers.CResponseController(database), metrics, mode=mode, **options)
+    start = time.perf_counter()
+    tornado.ioloop.IOLoop.current().run_sync(lambda : submit(writer))
+    seconds = time.perf_counter() - start
+    assert database.cresponses.count() == RESPONSES
+    snapshot = metrics.snapshot()
+    batches = snapshot['response_batch_size']
+    latency = snapshot['response_write_seconds']
+    print("  %-28s %7.0f responses/s  %5d batches (mean %5.1f)  stored after p50 %5.1f ms  p99 %6.1f ms"
+          % (mode + ' ' + ' '.join('%s=%s' % o for o in options.items()), RESPONSES / seconds, batches['count'],
+             batches['mean'], 1e3 * latency['p50'], 1e3 * latency['p99']))
+
+
+def run_all(database):
+    run(database, 'acknowledged')
+    run(database, 'group_commit', delay=0.002)
+    run(database, 'group_commit', delay=0.005)
+    run(database, 'group_commit', delay=0.02)
+
+
+if __name__ == '__main__':
+    print("%d responses from %d workers" % (RESPONSES, WORKERS))
+    directory = tempfile.mkdtemp()
+    try:
+        database = storage.open_database('benchmark', 'sqlite', path=directory)
+        print("sqlite")
+        run_all(database)
+        database.close()
+    finally:
+        shutil.rmtree(directory)
+    client = pymongo.MongoClient(serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        print("mongodb: no server on localhost")
+    else:
+        client.drop_database('news_crowdsourcer_benchmark')
+        print("mongodb")
+        run_all(client['news_crowdsourcer_benchmark'])
+        client.drop_database('news_crowdsourcer_benchmark')
@@ -0,0 +1,65 @@
+# Measures the serialization cost of a /HIT/view response (non-lean, with the module
+# definitions) for the example surveys: the original json.dumps(indent=4,
+# sort_keys=True), a compact dump of the whole payload with json_machine, and the
+# response composed from the cached, pre-serialized task and modules.
+#
+# Run from the src directory:  python benchmarks/serialization_benchmark.py
+
+import glob
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+from helpers import json_machine
+from models import CTask, CType, XMLTask
+
+ROOT_PATH = os.path.join(os.path.dirname(__file__), '..', '..')
+
+
+def task_views():
+    views = []
+    for path in sorted(glob.glob(os.path.join(ROOT_PATH, 'examples', '**', '*.xml'), recursive=True)):
+        xmltask = XMLTask(path)
+        modules = {m['name'] : CType.from_dict(m).to_dict() for m in xmltask.get_modules()}
+        for task in xmltask.get_tasks():
+            task = CTask.deserialize(task)
+            views.append((task.serialize(), {name : modules[name] for name in task.modules}))
+    return views
+
+
+def original(task, modules):
+    return json.dumps({"task" : task, "task_num" : 0, "num_tasks" : 5, "modules" : modules},
+                      indent=4, sort_keys=True)
+
+
+def compact(task, modules):
+    return json_machine.dumps({"task" : task, "task_num" : 0, "num_tasks" : 5, "modules" : modules})
+
+
+def composed(task_json, modules_json):
+    return json_machine.compose([("task", task_json),
+                                 ("task_num", json_machine.dumps(0)),
+                                 ("num_tasks", json_machine.dumps(5)),
+                                 ("modules", modules_json)])
+
+
+if __name__ == '__main__':
+    views = task_views()
+    cached = [(json_machine.dumps(task), json_machine.dumps(modules)) for task, modules in views]
+    size = sum(len(compact(task, modules)) for task, modules in views) / len(views)
+    print("%d task views, %.0f bytes on average, orjson %s" % (len(views), size, "installed" if json_machine.orjson else "not installed"))
+    fast = json_machine.orjson
+    for label, fn, args, encoder in (("json.dumps indent=4 sort_keys", original, views, None),
+                                     ("json_machine.dumps (json)", compact, views, None),
+                                     ("composed from cached parts (json)", composed, cached, None),
+                                     ("json_machine.dumps (orjson)", compact, views, fast),
+                                     ("composed from cached parts (orjson)", composed, cached, fast)):
+        if label.endswith("(orjson)") and fast is None:
+            continue
+        json_machine.orjson = encoder
+        seconds = min(timeit.repeat(lambda : [fn(*a) for a in args], number=20, repeat=3)) / 20
+        print("%-36s %8.1f us per task view" % (label, 1e6 * seconds / len(args)))
+    json_machine.orjson = fast
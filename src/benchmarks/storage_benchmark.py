@@ -0,0 +1,100 @@
+# Runs the same workload against every storage engine: loading a survey with
+# 2000 cHITs, then 200 workers each taking a cHIT, pinging and submitting its
+# tasks and completing it, as the /HIT/view, /HIT/ping and /HIT/response handlers
+# do. MongoDB is measured when a server answers on localhost.
+#
+# Run from the src directory:  python benchmarks/storage_benchmark.py
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import pymongo
+import controllers
+import storage
+from models import CHIT
+
+SURVEY = os.path.join(os.path.dirname(__file__), '..', 'tests', 'test_xml_1.xml')
+HITS = 2000
+WORKERS = 200
+
+
+def survey():
+    survey = controllers.XMLTaskController(None).read_survey(SURVEY)
+    taskids = [t['taskid'] for t in survey['tasks']]
+    survey['hits'] = [{'hitid' : 'h%d' % i, 'exclusions' : [], 'tasks' : taskids,
+                       'taskconditions' : [None] * len(taskids)} for i in range(HITS)]
+    return survey
+
+
+def run(database):
+    timings = {}
+    def timed(name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        timings.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    survey_controller = controllers.SurveyController(database)
+    db = controllers.GenerationalDatabase(database, survey_controller)
+    xmltask_controller = controllers.XMLTaskController(db)
+    generation = survey_controller.create_generation()
+    timed("load survey", xmltask_controller.load, db.pinned(generation), survey())
+    survey_controller.activate(generation)
+
+    chit_controller = controllers.CHITController(db)
+    status_controller = controllers.CurrentStatusController(db)
+    response_controller = controllers.CResponseController(db)
+    ping_controller = controllers.WorkerPingController(db)
+    for i in range(WORKERS):
+        workerid = 'W%d' % i
+        completed = timed("get_hits_for_worker", response_controller.get_hits_for_worker, workerid)
+        outstanding = timed("outstanding_hits", status_controller.outstanding_hits)
+        hitid = timed("get_next_chit_id", chit_controller.get_next_chit_id, exclusions=completed,
+                      workerid=workerid, outstanding_hits=outstanding)
+        timed("status create_or_update", status_controller.create_or_update, workerid=workerid, hitid=hitid, taskindex=0)
+        chit = timed("get_chit_by_id", chit_controller.get_chit_by_id, hitid, CHIT.view_fields)
+        for taskindex, taskid in enumerate(chit.tasks):
+            timed("ping", ping_controller.ping, hitid)
+            timed("get_current_status", status_controller.get_current_status, workerid)
+            timed("response create", response_controller.create,
+                  {'submitted' : datetime.datetime.utcnow(), 'response' : [{'varname' : 'q', 'response' : 1}],
+                   'workerid' : workerid, 'hitid' : hitid, 'taskid' : taskid})
+            timed("status create_or_update", status_controller.create_or_update,
+                  workerid=workerid, hitid=hitid, taskindex=taskindex + 1)
+        timed("add_completed_hit", chit_controller.add_completed_hit, chit=chit, worker_id=workerid)
+        timed("status remove", status_controller.remove, workerid)
+    timed("get_agg_hit_info", chit_controller.get_agg_hit_info)
+    timed("get_stale_chit", chit_controller.get_stale_chit)
+    return timings
+
+
+def report(engine, timings):
+    print(engine)
+    for name, seconds in timings.items():
+        print("  %-26s %6d x %9.1f us  %8.1f ms" % (name, len(seconds), 1e6 * sum(seconds) / len(seconds),
+                                                    1e3 * sum(seconds)))
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    try:
+        database = storage.open_database('benchmark', 'sqlite', path=directory)
+        report("sqlite", run(database))
+        database.close()
+    finally:
+        shutil.rmtree(directory)
+    client = pymongo.MongoClient(serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        print("mongodb: no server on localhost, not measured")
+    else:
+        client.drop_database('news_crowdsourcer_benchmark')
+        report("mongodb", run(storage.MongoDatabase(client['news_crowdsourcer_benchmark'])))
+        client.drop_database('news_crowdsourcer_benchmark')
@@ -0,0 +1,136 @@
+"""Computes the bonus of the workers as ending the run would, without paying it or
+writing to the database, and writes the bonus of every worker and the payout totals
+to a file. Run it during a run to check and time the bonus computation before the
+run is ended. MongoDB is only read, so a read-only user or a secondary can be given
+with --uri; a SQLite database is copied to a temporary snapshot first.
+
+Run from the src directory:
+
+  python bonus_dryrun.py --config=config.json --output=bonus_dryrun.jsonl [--interval=600]
+
+The first line of the output is the summary, every further line the bonus of one
+worker. The file is replaced once it is complete."""
+import asyncio
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+import tornado.ioloop
+import tornado.options
+from tornado.options import define, options
+
+import Settings
+
+sys.path.insert(0, Settings.CONFIG_PATH)
+import app_config
+sys.path.pop(0)
+
+import controllers
+import helpers
+import storage
+from models import MTurkConnection
+
+
+async def dry_run(db_name, storage_config, workers=2):
+    """Returns (summary, results): the summary of the payout and the bonus info of
+       normalize_bonus_info() of every worker, with the share of the bonus paid
+       ('percent') and the estimated amount in dollars ('amount')."""
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as snapshot:
+        if storage_config['engine'] == 'sqlite':
+            storage.snapshot_database(db_name, storage_config['path'], snapshot)
+            storage_config = dict(storage_config, path=snapshot)
+        database = storage.open_database(db_name, read_only=True, **storage_config)
+        try:
+            survey_controller = controllers.SurveyController(database)
+            if not survey_controller.get_generation():
+                raise ValueError("No survey is loaded in the database %s." % db_name)
+            db = controllers.GenerationalDatabase(database, survey_controller)
+            metadata = survey_controller.get_metadata(store=False)
+            metrics = helpers.Metrics()
+            bonus_controller = controllers.BonusController(db, survey_controller, metrics, db_name, storage_config,
+                                                           workers=workers, read_only=True)
+            worker_bonus_info = await bonus_controller.compute(metadata)
+            percents = bonus_controller.percents(worker_bonus_info)
+            connection = db.mturkconnections.get()
+            bonus = float(connection.get('bonus', 0.0)) if connection else 0.0
+            already_paid = set(d['workerid'] for d in db.paid_bonus.all())
+        finally:
+            database.close()
+    for workerid, info in worker_bonus_info.items():
+        info['percent'] = percents[workerid]
+        info['amount'] = MTurkConnection.bonus_amount(percents[workerid], bonus)
+    amounts = [info['amount'] for info in worker_bonus_info.values()]
+    unpaid = [info['amount'] for workerid, info in worker_bonus_info.items() if workerid not in already_paid]
+    timings = metrics.snapshot()
+    summary = {'computed_at' : datetime.datetime.utcnow().isoformat(),
+               'generation' : metadata['generation'],
+               'seconds' : {'map' : timings['bonus_map_seconds'],
+                            'reduce' : timings['bonus_reduce_seconds'],
+                            'total' : time.perf_counter() - start},
+               'workers' : len(worker_bonus_info),
+               'bonus' : bonus,
+               'payout' : {'total' : round(sum(amounts), 2),
+                           'unpaid' : round(sum(unpaid), 2),
+                           'unpaid_workers' : len(unpaid),
+                           'mean' : round(sum(amounts) / len(amounts), 2) if amounts else 0.0,
+                           'min' : min(amounts, default=0.0),
+                           'max' : max(amounts, default=0.0)}}
+    return summary, worker_bonus_info
+
+
+def write_results(path, summary, worker_bonus_info):
+    """Writes the summary and a line per worker to path, replacing it once the new
+       results are complete."""
+    partial = path + '.partial'
+    with open(partial, 'w') as f:
+        f.write(json.dumps(summary) + '\n')
+        for workerid in sorted(worker_bonus_info):
+            info = worker_bonus_info[workerid]
+            f.write(json.dumps({'workerid' : workerid,
+                                'percent' : info['percent'],
+                                'amount' : info['amount'],
+                                'earned' : info['earn'],
+                                'possible' : info['poss'],
+                                'rawpct' : info['rawpct'],
+                                'pct' : info['pct'],
+                                'explanation' : info['exp']}) + '\n')
+    os.replace(partial, path)
+
+
+async def run():
+    storage_config = dict(app_config.storage, path=app_config.storage['path'] or Settings.DB_PATH)
+    if options.uri:
+        storage_config['uri'] = options.uri
+    workers = options.workers or app_config.bonus['workers']
+    while True:
+        try:
+            summary, worker_bonus_info = await dry_run(app_config.db_name, storage_config, workers=workers)
+            write_results(options.output, summary, worker_bonus_info)
+            Settings.logging.info("Bonus of %d workers computed in %.1f seconds, payout %.2f (%.2f unpaid), written to %s"
+                                  % (summary['workers'], summary['seconds']['total'], summary['payout']['total'],
+                                     summary['payout']['unpaid'], options.output))
+        except Exception:
+            if not options.interval:
+                raise
+            Settings.logging.exception("Bonus dry run failed.")
+        if not options.interval:
+            return
+        await asyncio.sleep(options.interval)
+
+
+def main():
+    define('config', default="config.json", help="JSON file with config parameters such as Google authentication, AWS mTurl parameters, port, environ., and database", type=str)
+    define('output', default="bonus_dryrun.jsonl", help="file the summary and the bonus of every worker are written to", type=str)
+    define('uri', default="", help="MongoDB connection string to read from instead of the configured one", type=str)
+    define('workers', default=0, help="number of worker processes, 0 for the bonus workers of the config", type=int)
+    define('interval', default=0.0, help="repeat the dry run every interval seconds, 0 runs it once", type=float)
+    tornado.options.parse_command_line()
+    app_config.populate_config(options.config)
+    tornado.ioloop.IOLoop.current().run_sync(run)
+
+if __name__ == "__main__":
+    main()
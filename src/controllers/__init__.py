@@ -14,9 +14,16 @@ from .ctype_controller import CTypeController
 from .ctask_controller import CTaskController
 from .cresponse_controller import CResponseController
 from .mturkconnection_controller import MTurkConnectionController
-from .xmltask_controller import XMLTaskController
+from .xmltask_controller import XMLTaskController, SurveyError
 from .chit_controller import CHITController
 from .cdocument_controller import CDocumentController
 from .current_status_controller import CurrentStatusController
 from .event_controller import EventController
 from .set_controller import SetController
+from .cimage_controller import CImageController
+from .survey_controller import SurveyController, GenerationalDatabase
+from .worker_ping_controller import WorkerPingController
+from .dashboard_controller import DashboardController, event_json
+from .compaction_controller import CompactionController
+from .response_writer import ResponseWriter
+from .bonus_controller import BonusController
@@ -4,10 +4,8 @@ import app_config
 class AdminController(object):
     def __init__(self, db) :
         self.db = db
-        self.db.admin.ensure_index('email', unique=True)
     def get_emails(self) :
-        res = self.db.admin.find({}, {'email' : True})
-        return [r['email'] for r in res]
+        return self.db.admin.emails()
     def get_by_email(self, email) :
         a = self._get_by_email(email)
         if not a and email in app_config.superadmins :
@@ -15,7 +13,7 @@ class AdminController(object):
         return a
     def _get_by_email(self, email) :
         try:
-            d = self.db.admin.find_one({'email' : email})
+            d = self.db.admin.get(email)
             return models.Admin.from_dict(d)
         except TypeError as e:
             return None
@@ -30,4 +28,4 @@ class AdminController(object):
     def remove(self, d) :
         c = self.get_by_email(d['email'])
         print(c)
-        self.db.admin.remove(c.to_dict())
+        self.db.admin.remove(c.email)
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import tornado.ioloop
+
+import helpers
+import storage
+from .cresponse_controller import CResponseController
+from .ctype_controller import CTypeController
+from .set_controller import SetController
+from .survey_controller import GenerationalDatabase
+
+def map_bonus(db_name, storage_config, metadata, taskids, read_only=False):
+    """The map phase for the tasks in taskids, run in a worker process with its own
+       connection to the database: evaluates the task conditions, collects the
+       responses and computes the agreement of the workers. Returns the raw bonus
+       info of calculate_raw_bonus_info() for these tasks. With read_only no indexes
+       are created, see storage.open_database()."""
+    database = storage.open_database(db_name, read_only=read_only, **storage_config)
+    try:
+        db = GenerationalDatabase(database, None, metadata['generation'])
+        bonusDetails = CResponseController(db).getBonusDetails(metadata, CTypeController(db), SetController(db),
+                                                               taskids=taskids)
+        return helpers.calculate_raw_bonus_info(metadata['max_bonus_points'], bonusDetails, metadata['crosswalk'])
+    finally:
+        database.close()
+
+class BonusController(object):
+    """Computes the bonus of the workers when a run ends. The bonus of a task only
+       depends on the responses to that task, so the tasks are split into chunks
+       that are mapped in a pool of worker processes (see map_bonus()) instead of on
+       the IOLoop. The reduce phase sums the bonus points of each worker over the
+       chunks and normalizes them. The result is that of calculate_worker_bonus_info()
+       on getBonusDetails() up to the order of the explanations. The duration of
+       both phases is recorded in metrics."""
+    # if the following is set to True crowdsourcer will normalize the
+    # bonus of the best performer for 100% and scale up all other
+    # bonuses proportionally
+    grade_on_a_curve = False
+    def __init__(self, db, survey_controller, metrics, db_name, storage_config, workers=2, chunks_per_worker=4,
+                 read_only=False):
+        self.db = db
+        self.survey_controller = survey_controller
+        self.metrics = metrics
+        self.db_name = db_name
+        self.storage_config = storage_config
+        self.workers = workers
+        self.chunks_per_worker = chunks_per_worker
+        self.read_only = read_only
+    def chunks(self, taskids):
+        size = max(1, -(-len(taskids) // (self.workers * self.chunks_per_worker)))
+        return [taskids[i:i+size] for i in range(0, len(taskids), size)]
+    async def compute(self, metadata=None):
+        """Returns the bonus info per worker of normalize_bonus_info() for the current
+           survey, or for the survey of metadata if it is given."""
+        if metadata is None:
+            metadata = self.survey_controller.get_metadata()
+        chunks = self.chunks(list(metadata['task_modules']))
+        start = time.perf_counter()
+        raw_bonus_infos = []
+        if chunks:
+            executor = ProcessPoolExecutor(max_workers=min(self.workers, len(chunks)))
+            try:
+                ioloop = tornado.ioloop.IOLoop.current()
+                raw_bonus_infos = await asyncio.gather(*[ioloop.run_in_executor(executor, map_bonus, self.db_name,
+                                                                                self.storage_config, metadata, chunk,
+                                                                                self.read_only)
+                                                         for chunk in chunks])
+            finally:
+                executor.shutdown(wait=False)
+        self.metrics.gauge('bonus_map_seconds').set(time.perf_counter() - start)
+        start = time.perf_counter()
+        worker_bonus_info = helpers.normalize_bonus_info(helpers.reduce_raw_bonus_info(raw_bonus_infos))
+        self.metrics.gauge('bonus_reduce_seconds').set(time.perf_counter() - start)
+        self.metrics.gauge('bonus_workers').set(len(worker_bonus_info))
+        return worker_bonus_info
+    def percents(self, worker_bonus_info):
+        """Returns the share of the bonus paid to each worker."""
+        bonus_pct = 'pct' if self.grade_on_a_curve else 'rawpct'
+        return {wid : info[bonus_pct] for wid, info in worker_bonus_info.items()}
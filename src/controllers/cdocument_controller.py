@@ -1,9 +1,36 @@
+from models import CDocument
+
 class CDocumentController(object):
+    """Documents are stored once per content hash (the _id), gzip compressed, with
+       the list of names they were uploaded under."""
     def __init__(self, db):
         self.db = db
-        self.db.cdocs.ensure_index('name', unique=True)
     def create(self, name, d):
-        self.db.cdocs.insert({'name' : name, 'content' : d})
+        self.create_many({name : d})
+    def create_many(self, docs):
+        """docs maps document names to their content"""
+        by_hash = {}
+        for name, content in docs.items():
+            doc = by_hash.get(CDocument.hash_content(content))
+            if doc:
+                doc.names.append(name)
+            else:
+                doc = CDocument.from_content(name, content)
+                by_hash[doc.hash] = doc
+        self.db.cdocs.add_many([doc.serialize() for doc in by_hash.values()])
+    def get_hashes(self, names):
+        """Returns a dict name -> content hash for the given document names that exist."""
+        return self.db.cdocs.get_hashes(names)
+    def get_document(self, hash):
+        d = self.db.cdocs.get(hash)
+        return CDocument.deserialize(d) if d else None
     def get_document_by_name(self, name):
-        d = self.db.cdocs.find_one({'name' : name})
-        return d['content']
+        """Returns the document uploaded under name or None. Surveys loaded before
+           documents were stored by hash keep them as {name, content}, which are
+           read as well."""
+        d = self.db.cdocs.get_by_name(name)
+        if d is None:
+            return None
+        if 'names' in d:
+            return CDocument.deserialize(d)
+        return CDocument.from_content(name, d['content'] or "")
@@ -1,113 +1,62 @@
 import uuid
 from models import CHIT
-import bson.code
 import datetime
 
 class CHITController(object):
-    sum_map = bson.code.Code("function() { emit(1, this.num_completed_hits); }")
-    sum_reduce = bson.code.Code("function(key, vals) { return Array.sum(vals); }")
-    task_sum_map = bson.code.Code("function() { emit(1, this.tasks.length); }")
-
-    def __init__(self, db):
+    # the record of which worker was handed which cHIT is only kept for a week
+    chitload_seconds = 7 * 24 * 3600
+    def __init__(self, db, stale_seconds=30.0):
         self.db = db
-        self.db.chits.ensure_index('hitid', unique=True)
+        self.stale_seconds = stale_seconds
     def create(self, d):
         chit = CHIT.deserialize(d)
-        self.db.chits.insert(chit.serialize())
+        self.db.chits.insert_many([chit.serialize()])
         return chit
-    def get_chit_by_id(self, hitid):
-        d = self.db.chits.find_one({'hitid' : hitid})
-        return CHIT.deserialize(d) if d else None
+    def create_many(self, ds):
+        self.db.chits.insert_many([CHIT.deserialize(d).serialize() for d in ds])
+    def get_chit_by_id(self, hitid, fields=None):
+        """Only the given fields are read if fields is not None, e.g. CHIT.view_fields."""
+        d = self.db.chits.get(hitid, fields)
+        return CHIT.deserialize(d, fields) if d else None
     def has_available_hits(self) :
-        d = self.db.chits.find_one({'num_completed_hits' : {'$lt' : 1}})
-        return True if d else False
-    def get_next_chit_id(self, exclusions=[], workerid=None, outstanding_hits=[], stale_hits=[]):
-        #cl = self.db.chitloads.find({'hitid' : {'$exists' : True}}, {'hitid' : 1})
-        #loaded_chits = [c['hitid'] for c in cl] if cl else []
-        ct = datetime.datetime.utcnow()
-        min_seconds = 30.0
-        print(outstanding_hits)
-        d = self.db.chits.find_one({'$and' : 
-                                    [{ 'num_completed_hits' : {'$lt' : 1} },
-                                     { 'exclusions' : {'$nin' : exclusions}},
-                                     { 'hitid' : {'$nin' : outstanding_hits} } ] },
-                                   {'hitid' : 1})
-        if not d:
-            for sh in stale_hits :
-                if (ct - sh['lastping']).total_seconds() > min_seconds : 
-                    d = self.db.chits.find_one({'$and' : 
-                                                [{ 'num_completed_hits' : {'$lt' : 1} },
-                                                 { 'exclusions' : {'$nin' : exclusions}},
-                                                 { 'hitid' : sh['hitid']} ]},
-                                               {'hitid' : 1})
-                    if d :
-                        break
-                
-                
-                
-        if d and workerid :
+        return self.db.chits.has_available()
+    def get_next_chit_id(self, exclusions=[], workerid=None, outstanding_hits=[], stale_seconds=None):
+        hitid = self.db.chits.next_available(exclusions, outstanding_hits)
+        if not hitid:
+            hitid = self.get_stale_chit(exclusions=exclusions, stale_seconds=stale_seconds)
+        if hitid and workerid :
             self.db.chitloads.insert({'workerid' : workerid,
                                       'time' : datetime.datetime.utcnow(),
-                                      'hitid' : d['hitid']})
-
-        return d['hitid'] if d else None
+                                      'hitid' : hitid})
+        return hitid
+    def get_stale_chit(self, exclusions=[], stale_seconds=None):
+        """Returns the hitid of the uncompleted cHIT whose worker stopped pinging the
+           longest time ago, if it has been silent for more than stale_seconds. The
+           pings are found through the lastping index and joined with the cHITs in
+           the database."""
+        if stale_seconds is None :
+            stale_seconds = self.stale_seconds
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=stale_seconds)
+        return self.db.workerpings.stale_hit(self.db.chits, cutoff, exclusions)
+    def remove_old_chitloads(self) :
+        """Removes the chitloads older than chitload_seconds. Returns the number removed."""
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.chitload_seconds)
+        return self.db.chitloads.remove_older(cutoff)
     def get_chit_ids(self) :
-        ds = self.db.chits.find({}, {'hitid' : True})
-        return [d['hitid'] for d in ds]
+        return self.db.chits.ids()
     def get_agg_hit_info(self):
-        completed_hits_mr = self.db.chits.map_reduce(self.sum_map, self.sum_reduce, "chit_mapreducesum_results")
-        num_completed_hits = completed_hits_mr.find_one()
-        all_tasks_mr = self.db.chits.map_reduce(self.task_sum_map, self.sum_reduce, "chit_task_mapreducesum_results")
-        num_tasks = all_tasks_mr.find_one()
-        num_total_hits = self.db.chits.count()
-        return {'num_completed_hits' : num_completed_hits['value'] if num_completed_hits else 0,
-                'num_hits' : num_total_hits,
-                'num_tasks' : num_tasks['value'] if num_tasks else 0}
+        return self.db.chits.stats()
     def add_completed_hit(self,chit=None, worker_id=None):
         hit_info = {'worker_id' : worker_id,
                     'turk_verify_code' : uuid.uuid4().hex[:16]}
-        self.db.chits.update({'hitid' : chit.hitid},
-                             {'$push' : {'completed_hits' : hit_info},
-                              '$inc' : {'num_completed_hits' : 1}})
+        self.db.chits.add_completed(chit.hitid, hit_info)
         return hit_info
     def get_completed_hits(self) :
-        d = self.db.chits.find({'num_completed_hits' : {'$gte' : 1}}, {'hitid' : 1})
-        return [r['hitid'] for r in d]
+        return self.db.chits.completed_ids()
     def get_workers_with_completed_hits(self) :
-        d = self.db.chits.find({'num_completed_hits' : {'$gte' : 1}}, {'completed_hits' : 1})
-        worker_ids = set()
-        for r in d:
-            for hit in r['completed_hits']:
-                worker_ids.add(hit['worker_id'])
-        return list(worker_ids)
-    #max points
-    def getMaxBonusPoints(self):
-        maxBonusPoints=0
-        d = self.db.chits.find({}, {'tasks' : 1})
-        for row in d:
-            sum=0
-            for task in row['tasks']:
-                modules = self.db.ctasks.find({'taskid':task}, {'modules' : 1})
-                for row in modules:
-                    for m in row['modules']:
-                        questions = self.db.ctypes.find_one({'name':m}, {'questions' : 1})
-                        for q in questions['questions']:
-                            sum=sum+q['bonuspoints']
-            if sum>maxBonusPoints:
-                maxBonusPoints=sum
-        return maxBonusPoints
-
+        return list(self.db.chits.completed_workers())
     # static wasn't working ... ?
     # utility method called by MTurkConnecitonController.make_payments
     @classmethod
     def secret_code_matches(cls, db=None, worker_id=None, secret_code=None):
-        hit_info = {'worker_id' : worker_id,
-                    'turk_verify_code' : secret_code}
-        lower_hit_info = {'worker_id' : worker_id.lower(),
-                          'turk_verify_code' : secret_code}
-        either_hit_info = [hit_info, lower_hit_info]
-        #ugly hack. TODO: improve storage struture for easier searching
-        d = db.chits.find_one({'$and' : 
-                               [{'num_completed_hits' : {"$gte" : 1}},
-                                {'completed_hits' : {'$in' : either_hit_info}}]})
-        return True if d else False
+        return db.chits.has_completion([worker_id, worker_id.lower()], secret_code)
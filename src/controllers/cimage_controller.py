@@ -0,0 +1,101 @@
+import datetime
+import hashlib
+import mimetypes
+import os
+import time
+import uuid
+
+import bson
+
+class CImageController(object):
+    """Stores uploaded images outside of the response documents. Responses only
+       keep a reference of the form 'gridfs:<id>' or 'file:<name>'. Images that no
+       response refers to upload_seconds after they were stored are removed by
+       remove_unreferenced(). GridFS needs the mongodb storage engine."""
+    def __init__(self, db, storage="gridfs", path=None, upload_seconds=86400.0):
+        self.db = db
+        self.storage = storage
+        self.path = path
+        self.upload_seconds = upload_seconds
+        if storage == "gridfs":
+            self.fs = db.gridfs('images')
+        elif storage == "filesystem":
+            os.makedirs(path, exist_ok=True)
+        else:
+            raise Exception("Unknown image storage %s" % storage)
+    def create(self, data, content_type=None, **metadata):
+        if self.storage == "gridfs":
+            fileid = self.fs.put(data, content_type=content_type, metadata=metadata)
+            return "gridfs:" + str(fileid)
+        # files are named by content hash, so identical uploads are stored once
+        name = hashlib.sha256(data).hexdigest() + (mimetypes.guess_extension(content_type or '') or '')
+        filename = os.path.join(self.path, name)
+        if os.path.exists(filename):
+            # the age of a file is that of its latest upload, see remove_unreferenced()
+            os.utime(filename)
+        else:
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(filename + '.tmp', filename)
+        return "file:" + name
+    def create_from_file(self, path, digest, content_type=None, **metadata):
+        """Stores an image that was streamed to disk; digest is its sha256 hex digest.
+           The file at path is consumed."""
+        if self.storage == "gridfs":
+            with open(path, 'rb') as f:
+                fileid = self.fs.put(f, content_type=content_type, metadata=metadata)
+            os.remove(path)
+            return "gridfs:" + str(fileid)
+        name = digest + (mimetypes.guess_extension(content_type or '') or '')
+        os.replace(path, os.path.join(self.path, name))
+        return "file:" + name
+    def create_upload(self, workerid, ref, imagehash, content_type=None):
+        """Records an image uploaded through /HIT/upload and returns the blob id that
+           the worker's submission refers to."""
+        blobid = uuid.uuid4().hex
+        self.db.cuploads.insert({'blobid' : blobid,
+                                 'workerid' : workerid,
+                                 'ref' : ref,
+                                 'imagehash' : imagehash,
+                                 'content_type' : content_type,
+                                 'created' : datetime.datetime.utcnow()})
+        return blobid
+    def get_upload(self, blobid, workerid):
+        # an upload that no submission used within upload_seconds is forgotten
+        d = self.db.cuploads.get(blobid, workerid)
+        return d if d and d['created'] >= self.upload_cutoff() else None
+    def upload_cutoff(self):
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=self.upload_seconds)
+    def get(self, ref):
+        """Returns (content_type, data) for a reference returned by create()."""
+        kind, _, key = ref.partition(':')
+        if kind == "gridfs" and self.storage == "gridfs":
+            f = self.fs.get(bson.ObjectId(key))
+            return (f.content_type, f.read())
+        if kind == "file" and self.storage == "filesystem" and os.path.basename(key) == key:
+            with open(os.path.join(self.path, key), 'rb') as f:
+                return (mimetypes.guess_type(key)[0], f.read())
+        return None
+    def remove_unreferenced(self, referenced):
+        """Removes the images stored more than upload_seconds ago that neither a
+           reference in referenced (those of the responses) nor a pending upload refers
+           to: images of abandoned tasks, of files picked again and of submissions that
+           were rejected. Returns the number of images removed."""
+        self.db.cuploads.remove_older(self.upload_cutoff())
+        referenced = set(referenced)
+        referenced.update(self.db.cuploads.refs())
+        removed = 0
+        if self.storage == "gridfs":
+            cutoff = self.upload_cutoff()
+            for f in self.fs.find({'uploadDate' : {'$lt' : cutoff}}):
+                if "gridfs:" + str(f._id) not in referenced:
+                    self.fs.delete(f._id)
+                    removed += 1
+        else:
+            cutoff = time.time() - self.upload_seconds
+            for entry in os.scandir(self.path):
+                if (entry.is_file() and "file:" + entry.name not in referenced and
+                        entry.stat().st_mtime < cutoff):
+                    os.remove(entry.path)
+                    removed += 1
+        return removed
@@ -0,0 +1,39 @@
+# the collections whose sizes are reported after every compaction
+AUXILIARY_COLLECTIONS = ('events', 'chitloads', 'workerpings', 'currentstatus')
+
+class CompactionController(object):
+    """Keeps the auxiliary collections bounded over runs of several weeks. The event
+       log keeps the last max_events events, chitloads are kept for a week, and
+       workers who have not moved on for abandoned_seconds are forgotten together
+       with the pings of the cHITs nobody holds any more. Uploaded images that no
+       response refers to are removed if cimage_controller is given. Every
+       compaction records what it removed, the collection sizes and its duration in
+       metrics."""
+    def __init__(self, db, event_controller, chit_controller, currentstatus_controller, workerping_controller,
+                 metrics, max_events=1000, abandoned_seconds=86400.0, cresponse_controller=None,
+                 cimage_controller=None):
+        self.db = db
+        self.event_controller = event_controller
+        self.chit_controller = chit_controller
+        self.currentstatus_controller = currentstatus_controller
+        self.workerping_controller = workerping_controller
+        self.metrics = metrics
+        self.max_events = max_events
+        self.abandoned_seconds = abandoned_seconds
+        self.cresponse_controller = cresponse_controller
+        self.cimage_controller = cimage_controller
+    def compact(self):
+        """Returns the number of documents removed by kind."""
+        with self.metrics.histogram('compaction_seconds').time():
+            removed = {'events' : self.event_controller.trim(self.max_events),
+                       'chitloads' : self.chit_controller.remove_old_chitloads(),
+                       'currentstatus' : self.currentstatus_controller.remove_abandoned(self.abandoned_seconds)}
+            removed['workerpings'] = self.workerping_controller.remove_abandoned(self.abandoned_seconds,
+                                                                                self.currentstatus_controller.outstanding_hits())
+            if self.cimage_controller:
+                removed['images'] = self.cimage_controller.remove_unreferenced(self.cresponse_controller.get_image_refs())
+        for kind, n in removed.items():
+            self.metrics.counter('compaction_removed_' + kind).inc(n)
+        for name in AUXILIARY_COLLECTIONS:
+            self.metrics.gauge('documents_' + name).set(getattr(self.db, name).count())
+        return removed
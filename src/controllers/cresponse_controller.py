@@ -1,56 +1,178 @@
+import base64
+import datetime
 import tornado.escape
-import pymongo
-from models import CResponse, CType, SET
-from helpers import CustomEncoder, Lexer, Status
+import bson
+from models import CResponse
+from helpers import CustomEncoder, Lexer, Status, ImageError, export_machine
+import storage
 import jsonpickle
+import time
+import Settings
 
 class CResponseController(object):
-    def __init__(self, db):
+    def __init__(self, db, settle_seconds=5.0):
         self.db = db
-        #self.db.cresponses.ensure_index([('taskid', 1), ('workerid', 1)],
-        #                                unique=True)
-    def create(self, d):
+        self.settle_seconds = settle_seconds
+    def create(self, d, write_concern=None):
         cresponse = CResponse.deserialize(d)
-        self.db.cresponses.insert(cresponse.serialize())
+        self.db.cresponses.insert(cresponse.serialize(), write_concern)
         return cresponse
+    def create_many(self, ds, write_concern=None):
+        """Inserts the responses ds together and returns their CResponses, with the
+           exception of a response that could not be stored in place of its CResponse."""
+        cresponses = [CResponse.deserialize(d) for d in ds]
+        errors = self.db.cresponses.insert_many([c.serialize() for c in cresponses], write_concern)
+        return [e or c for c, e in zip(cresponses, errors)]
+    def get_latest_response(self, workerid, hitid, taskid, fields=None):
+        """Returns the document of the last response of the worker to the task in the
+           cHIT, None if there is none. Workers may have answered a task more than
+           once, e.g. after returning to it."""
+        return self.db.cresponses.latest(workerid, hitid, taskid, fields)
+    def get_by_requestid(self, requestid):
+        """The hitid and taskid of the response stored for the submission requestid,
+           None if there is none."""
+        return self.db.cresponses.get_by_requestid(requestid)
     def append_completed_task_info(self, **d) :
         d['num_completed_tasks'] = self.db.cresponses.count()
         return d
     def get_reponse_info_by_worker(self, workerid):
-        d = self.db.cresponses.find({'workerid' : workerid})
-        return {'count' : len(d) }
+        return {'count' : self.db.cresponses.count_by_worker(workerid)}
     def get_hits_for_worker(self, workerid):
-        d = self.db.cresponses.find({'workerid' : workerid}, {'hitid' : 1})
-        return [r['hitid'] for r in d]
+        return self.db.cresponses.hitids_by_worker(workerid)
     def write_response_to_csv(self, csvwriter, completed_workers=[]) :
-        for d in self.db.cresponses.find() :
+        for d in self.db.cresponses.all() :
             if d['workerid'] in completed_workers :
                 csvwriter.writerow([d['hitid'], d['taskid'], d['workerid'], str(d['submitted']),
                                     tornado.escape.json_encode(d['response'])])
     def write_task_submission_times_to_csv(self, csvwriter, completed_workers=[]) :
         csvwriter.writerow(['hitid', 'taskid', 'workerid', 'submitted_at'])
-        #for d in self.db.cresponses.find().sort("submitted",pymongo.ASCENDING) :
-        for d in self.db.cresponses.find() :
+        for d in self.db.cresponses.all() :
             if d['workerid'] in completed_workers :
                 csvwriter.writerow([d['hitid'], d['taskid'], d['workerid'], str(d['submitted'])])
-    def write_question_responses_to_csv(self, csvwriter, completed_workers=[]) :
-        csvwriter.writerow(['hitid', 'taskid', 'workerid', 'module', 'varname', 'response'])
-        #for d in self.db.cresponses.find().sort("submitted",pymongo.ASCENDING) :
-        for d in self.db.cresponses.find() :
+    def responses_since(self, token=None, limit=1000) :
+        """Returns (responses, token) for an incremental export: at most limit
+           responses that follow the position in token, from the start if token is
+           None, and the token to continue from. Raises ValueError if the token is
+           malformed. After an upload replaced the survey the export starts over
+           with its responses.
+
+           The stored responses are read in the order of submission, from the
+           watermark of the last one exported. Responses younger than
+           settle_seconds are left for a later call there, as concurrent
+           submissions may be stored out of order. Once the export has caught up,
+           it continues from the change stream of the responses on the engines that
+           have one (a MongoDB replica set), which returns every response as it is
+           stored."""
+        collection = self.db.cresponses
+        after = self.decode_token(token)
+        if after and after['collection'] != collection.name :
+            after = None
+        watermark = None
+        if after and 'submitted' in after :
+            watermark = (datetime.datetime.fromisoformat(after['submitted']), after['key'])
+        if after and 'resume' in after :
+            try :
+                changes, resume = collection.changes(after['resume'], limit)
+            except storage.StorageError :
+                # the stream no longer reaches back to the token, continue from its watermark
+                pass
+            else :
+                return self.export_page(collection.name, watermark, changes, resume)
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.settle_seconds)
+        if not self.db.change_streams :
+            return self.export_page(collection.name, watermark, collection.since(watermark, cutoff, limit))
+        # the stream is opened first, so that the responses stored while reading are in both
+        _, resume = collection.changes(None, 0)
+        responses = collection.since(watermark, None, limit)
+        if len(responses) == limit :
+            # not caught up yet, continue from the watermark of the settled responses
+            return self.export_page(collection.name, watermark,
+                                    [r for r in responses if r[1]['submitted'] < cutoff])
+        keys = set(key for key, d in responses)
+        changes, resume = collection.changes(resume)
+        return self.export_page(collection.name, watermark,
+                                responses + [r for r in changes if r[0] not in keys], resume)
+    def export_page(self, collection, watermark, responses, resume=None) :
+        """Returns the responses_since() result for the (key, response) pairs in
+           responses, which follow watermark, and the change stream position resume."""
+        if responses :
+            key, d = responses[-1]
+            watermark = (d['submitted'], key)
+        token = {'collection' : collection}
+        if watermark :
+            # BSON dates have milliseconds only
+            token['submitted'], token['key'] = watermark[0].isoformat(), watermark[1]
+        if resume is not None :
+            token['resume'] = resume
+        return [d for key, d in responses], self.encode_token(token) if len(token) > 1 else None
+    @staticmethod
+    def encode_token(token) :
+        return base64.urlsafe_b64encode(bson.encode(token)).decode('ascii')
+    @staticmethod
+    def decode_token(token) :
+        if not token :
+            return None
+        try :
+            after = bson.decode(base64.urlsafe_b64decode(token.encode('ascii')))
+            if 'collection' not in after or not set(after) <= {'collection', 'submitted', 'key', 'resume'} :
+                raise ValueError(token)
+            return after
+        except Exception :
+            raise ValueError("Invalid resume token %r" % token)
+    def question_responses(self, completed_workers=[]) :
+        """Yields (hitid, taskid, workerid, submitted, module, varname, response) for
+           every question response of the workers in completed_workers."""
+        completed_workers = set(completed_workers)
+        for d in self.db.cresponses.all() :
             if d['workerid'] in completed_workers :
                 for module in d['response']:
                     for question_response in module['responses']:
-                        response_string = question_response.get('response', None)
-                        if response_string is not None:
-                            response_string = response_string.encode("utf8")
-                        csvwriter.writerow([d['hitid'], d['taskid'], d['workerid'], module['name'],
-                                            question_response['varname'],
-                                            response_string])
+                        yield (d['hitid'], d['taskid'], d['workerid'], d['submitted'], module['name'],
+                               question_response['varname'],
+                               export_machine.response_text(question_response.get('response', None)))
+    def write_question_responses_to_csv(self, csvwriter, completed_workers=[]) :
+        csvwriter.writerow(['hitid', 'taskid', 'workerid', 'module', 'varname', 'response'])
+        for hitid, taskid, workerid, submitted, module, varname, response in self.question_responses(completed_workers) :
+            csvwriter.writerow([hitid, taskid, workerid, module, varname, response])
+    def write_question_responses_to_parquet(self, sink, completed_workers=[]) :
+        """Writes the question responses as a Parquet table with a row per response,
+           see question_responses(). Needs pyarrow."""
+        export_machine.write_parquet(sink, self.question_responses(completed_workers),
+                                     export_machine.long_schema())
+    def write_wide_question_responses_to_parquet(self, sink, completed_workers=[]) :
+        """Writes the question responses as a Parquet table with a row per task
+           response (hitid, taskid, workerid, submitted) and a column module.varname
+           per question. Needs pyarrow."""
+        completed_workers = set(completed_workers)
+        # the columns are collected first, so that the rows can be streamed
+        columns = {}
+        for workerid, module, varname in self.db.cresponses.questions() :
+            if workerid in completed_workers :
+                columns.setdefault((module, varname), 4 + len(columns))
+        def rows():
+            for d in self.db.cresponses.all() :
+                if d['workerid'] in completed_workers :
+                    row = [d['hitid'], d['taskid'], d['workerid'], d['submitted']] + [None] * len(columns)
+                    for module in d['response']:
+                        for question_response in module['responses']:
+                            # responses submitted since the columns were collected may add questions
+                            i = columns.get((module['name'], question_response['varname']))
+                            if i is not None:
+                                row[i] = export_machine.response_text(question_response.get('response', None))
+                    yield row
+        export_machine.write_parquet(sink, rows(), export_machine.wide_schema(list(columns)))
 
-    def getBonusDetails(self,moduleVarnameValuetype={}):
+    def getBonusDetails(self, metadata, module_controller, set_controller, taskids=None):
+        """metadata is the survey metadata of SurveyController.get_metadata(). If taskids
+           is given, only those tasks are included, so that the tasks can be split
+           among processes."""
+        if taskids is not None:
+            taskids=set(taskids)
+        moduleVarnameValuetype=metadata['crosswalk']
+        ctypes=module_controller.get_by_names(metadata['bonus_questions'].keys())
         #cycle through hits
         crosswalk={} # format taskid -> module -> varname -> {"possibleWorkers":set(),"actualWorkers":dict(),"bonus":{}}
-        d=self.db.chits.find({},{'tasks':1,'taskconditions':1,'completed_hits':1,'hitid':1})
+        d=self.db.chits.all(['tasks','taskconditions','completed_hits','hitid'])
         for row in d:
             hitid=row['hitid']
             tasks=row['tasks']
@@ -59,6 +181,8 @@ class CResponseController(object):
                 workerid=completed_hit["worker_id"]
                 #now we cycle through tasks
                 for i,task in enumerate(tasks):
+                    if taskids is not None and task not in taskids:
+                        continue
                     includeTask=False
                     couldBeReached=False
                     if taskconditions[i]==None:
@@ -76,10 +200,7 @@ class CResponseController(object):
                                 if len(frags)!=3:
                                     has_error=True
                                 else:
-                                    docs = self.db.cresponses.find({"$and":[{'workerid' : workerid},{'hitid' : hitid},{'taskid':frags[0]}]}).sort('submitted')
-                                    lastDoc=None
-                                    for d in docs:
-                                        lastDoc=d
+                                    lastDoc=self.get_latest_response(workerid, hitid, frags[0], ['response'])
                                     if lastDoc!=None:
                                         response=lastDoc["response"]
                                         for module in response:
@@ -91,7 +212,7 @@ class CResponseController(object):
                                                             couldBeReached=True
                         allSets=dict()
                         for s in condition.setlist:
-                            allSets[s]=SET(self.db,s)
+                            allSets[s]=set_controller.get_set(s)
                         if has_error:
                             continue
                         else:
@@ -104,17 +225,14 @@ class CResponseController(object):
                         if task not in crosswalk:
                             crosswalk[task]={}
                         #now cycle through the modules and variables
-                        m=self.db.ctasks.find_one({'taskid':task},{'modules':1})
-                        r=self.db.cresponses.find_one({'taskid':task,'hitid':hitid,'workerid':workerid},{'response':1})
-                        for module in m["modules"]:
+                        r=self.get_latest_response(workerid, hitid, task, ['response'])
+                        for module in metadata['task_modules'][task]:
                             if module not in crosswalk[task]:
                                 crosswalk[task][module]={}
-                            #now find questions for this module
-                            d = self.db.ctypes.find_one({'name' : module})
-                            mod=CType.from_dict(d)
-                            for q in mod.questions:
-                                if q.bonuspoints==0:
-                                    continue
+                            #now find the bonus questions for this module
+                            mod=ctypes[module]
+                            for varname in metadata['bonus_questions'][module]:
+                                q=mod.get_question(varname)
                                 includedQuestionOrReachable=False
                                 if q.varname not in crosswalk[task][module]:
                                     crosswalk[task][module][q.varname]={'possibleWorkers':set(),'actualWorkers':{},'bonus':q.get_bonus()}
@@ -133,25 +251,78 @@ class CResponseController(object):
                                     crosswalk[task][module][q.varname]['possibleWorkers'].add(workerid)
         return crosswalk
 
-    def sanitize_response(self, taskid, response, task_controller, module_controller):
+    def process_response(self, taskid, response, task_controller, module_controller) :
+        """Validates and sanitizes a submitted response in a single pass. The task and
+           its modules are fetched once and every display condition is evaluated once.
+           Returns a dict with the verdict ('valid'), the sanitized response ('response',
+           None if invalid), the image uploads that still have to be processed by
+           process_uploads() ('uploads') and the time spent in each stage in seconds
+           ('timings')."""
+        timings = {}
+        result = {'valid' : False, 'response' : None, 'uploads' : [], 'timings' : timings}
+
+        start = time.perf_counter()
         task = task_controller.get_task_by_id(taskid)
+        modules = module_controller.get_by_names(task.modules)
+        timings['resolve'] = time.perf_counter() - start
 
-        cleaned_responses = []
-        for m in response :
-            module = module_controller.get_by_name(m['name'])
-            cleaned_responses.append(module.sanitize_response(m))
-        return cleaned_responses
+        start = time.perf_counter()
+        received_modules = set(m.get('name', None) for m in response)
+        valid = received_modules == set(task.modules)
+        if valid :
+            for m in response :
+                # a task may list a module that is not defined
+                if m['name'] not in modules or not modules[m['name']].validate(m) :
+                    valid = False
+                    break
+        timings['validate'] = time.perf_counter() - start
+        if not valid :
+            return result
 
-    def validate(self, taskid, response, task_controller, module_controller) :
-        task = task_controller.get_task_by_id(taskid)
+        start = time.perf_counter()
+        cleaned_responses = [modules[m['name']].sanitize_response(m) for m in response]
+        for m in cleaned_responses :
+            questions = modules[m['name']].questions_by_varname
+            for r in m['responses'] :
+                if questions[r['varname']].valuetype == "imageupload" :
+                    result['uploads'].append((m, r))
+        timings['sanitize'] = time.perf_counter() - start
+
+        result['valid'] = True
+        result['response'] = cleaned_responses
+        return result
 
-        received_modules = set(m['name'] for m in response)
-        required_modules = set(task.modules)
-        if received_modules != required_modules :
-            return False
+    def get_image_refs(self) :
+        """Returns the references of the images that the responses keep, which are
+           read from the index on images."""
+        return self.db.cresponses.image_refs()
 
-        for m in response :
-            module = module_controller.get_by_name(m['name'])
-            if not module.validate(m) :
-                return False
-        return True
+    async def process_uploads(self, uploads, image_processor, image_controller, workerid=None) :
+        """Hashes the uploaded images in the image processor's process pool and stores
+           the raw images out of line. Responses of the form blob:<id> refer to images
+           that were already uploaded through /HIT/upload. The response keeps the image
+           hash and a <varname>_raw entry with the storage reference. Returns the
+           references, which are stored as the images of the response, or None if any
+           image could not be processed."""
+        refs = []
+        for module_response, r in uploads :
+            if r['response'].startswith("blob:") :
+                # the image was already streamed to /HIT/upload and hashed there
+                upload = image_controller.get_upload(r['response'][len("blob:"):], workerid)
+                if not upload :
+                    return None
+                ref, imagehash = upload['ref'], upload['imagehash']
+            else :
+                try :
+                    info = await image_processor.process_data_url(r['response'])
+                except ImageError as e :
+                    Settings.logging.info("Could not process image %s of %s: %s" % (r['varname'], workerid, e))
+                    return None
+                ref = image_controller.create(info['data'], info['content_type'], workerid=workerid,
+                                              imagehash=info['hash'])
+                imagehash = info['hash']
+            r['response'] = "imagehash:" + imagehash
+            module_response['responses'].append({'varname' : r['varname'] + '_raw',
+                                                 'response' : ref})
+            refs.append(ref)
+        return refs
@@ -3,17 +3,24 @@ from models import CTask
 class CTaskController(object):
     def __init__(self, db):
         self.db = db
-        self.db.ctasks.ensure_index('taskid', unique=True)
     def create(self, d):
         ctask = CTask.deserialize(d)
-        self.db.ctasks.insert(ctask.serialize())
+        self.db.ctasks.insert_many([ctask.serialize()])
         return ctask
+    def create_many(self, ds):
+        self.db.ctasks.insert_many([CTask.deserialize(d).serialize() for d in ds])
     def get_task_ids(self) :
-        return [r['taskid'] for r in self.db.ctasks.find({}, {'taskid' : 1})]
+        return self.db.ctasks.ids()
     def get_task_count(self) :
         return self.db.ctasks.count()
+    def get_module_names(self, taskids) :
+        """Returns the names of all modules used by the given tasks."""
+        names = set()
+        for r in self.db.ctasks.get_many(taskids, ['modules']) :
+            names.update(r['modules'])
+        return sorted(names)
     def get_task_by_id(self, taskid):
-        d = self.db.ctasks.find_one({'taskid' : taskid})
+        d = self.db.ctasks.get(taskid)
         ctask = CTask.deserialize(d)
         return ctask
 
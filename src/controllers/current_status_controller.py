@@ -1,21 +1,28 @@
+import datetime
 
 class CurrentStatusController(object):
     def __init__(self, db):
         self.db = db
-        self.db.currentstatus.ensure_index('workerid', unique=True)
+        # workers whose status was stored without the time count as updated now, so
+        # that remove_abandoned() forgets them too
+        self.db.currentstatus.set_missing_updated(datetime.datetime.utcnow())
     def outstanding_hits(self) :
-        d = self.db.currentstatus.find({}, {'hitid' : 1})
-        return [r['hitid'] for r in d]
+        return self.db.currentstatus.hitids()
+    def outstanding_hits_by_worker(self) :
+        return self.db.currentstatus.hitids_by_worker()
+    def hits_of_workers(self, workerids) :
+        return self.db.currentstatus.hitids_of(workerids)
     def create_or_update(self, workerid=None, hitid=None, taskindex=None) :
-        self.db.currentstatus.update({'workerid' : workerid},
-                                     {'workerid' : workerid,
-                                      'hitid' : hitid,
-                                      'taskindex' : taskindex},
-                                     True)
+        self.db.currentstatus.put(workerid, hitid, taskindex, datetime.datetime.utcnow())
     def remove(self, workerid=None):
-        self.db.currentstatus.remove({'workerid' : workerid})
+        self.db.currentstatus.remove(workerid)
+    def remove_abandoned(self, seconds) :
+        """Forgets the workers who have not moved on for seconds, which releases their
+           cHITs to the other workers. Returns the number of workers removed."""
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)
+        return self.db.currentstatus.remove_older(cutoff)
     def get_current_status(self, workerid=None):
         if not workerid :
             return None
-        d = self.db.currentstatus.find_one({'workerid' : workerid})
+        d = self.db.currentstatus.get(workerid)
         return d if d else None
@@ -0,0 +1,102 @@
+import calendar
+import email.utils
+import time
+
+import tornado.ioloop
+
+from helpers import json_machine
+
+def event_json(e):
+    return {'date' : email.utils.formatdate(calendar.timegm(e['date'].utctimetuple()), usegmt=True),
+            'event' : e['event']}
+
+class DashboardController(object):
+    """Aggregates the run status shown on the admin page once per server process
+       and pushes it to the admins connected to /admin/live, so that the database
+       load does not grow with the number of admins watching. The handlers report
+       submitted responses and taken, released and completed cHITs as they happen;
+       the status is re-read from the database every resync_seconds while admins
+       are connected, which picks up uploads, events and what other server
+       processes changed. Changes reported while the status is being re-read are
+       applied to the new status as well, so that they are not lost."""
+    def __init__(self, chit_controller, cresponse_controller, currentstatus_controller, event_controller,
+                 resync_seconds=10.0):
+        self.chit_controller = chit_controller
+        self.cresponse_controller = cresponse_controller
+        self.currentstatus_controller = currentstatus_controller
+        self.event_controller = event_controller
+        self.resync_seconds = resync_seconds
+        self.listeners = set()
+        self.state = None
+        self.changed = False
+        self.resynced = 0.0
+        # the hooks called while the status is being read, None if no read is in flight
+        self.pending = None
+    def subscribe(self, listener):
+        """listener is called with the serialized status whenever it changes.
+           Returns the current status, None until it has been read."""
+        self.listeners.add(listener)
+        return self.message() if self.state is not None else None
+    def unsubscribe(self, listener):
+        self.listeners.discard(listener)
+    def read_state(self):
+        hitinfo = self.chit_controller.get_agg_hit_info()
+        return {'hitinfo' : self.cresponse_controller.append_completed_task_info(**hitinfo),
+                'outstanding' : self.currentstatus_controller.outstanding_hits_by_worker(),
+                'completed' : set(self.chit_controller.get_completed_hits()),
+                'events' : [event_json(e) for e in self.event_controller.get_events(8)]}
+    def message(self):
+        # serialized once for all listeners, as text for WebSocket text frames
+        return json_machine.dumps({'hitinfo' : self.state['hitinfo'],
+                                   'hitstatus' : {'outstanding' : sorted(set(self.state['outstanding'].values())),
+                                                  'completed' : sorted(self.state['completed'])},
+                                   'events' : self.state['events']}).decode('utf8')
+    async def refresh(self):
+        """Called every second on the IOLoop: re-reads the status when it is due and
+           sends it to the listeners if it changed."""
+        if not self.listeners:
+            # nobody is watching, the hooks stop updating the status until the next admin connects
+            self.state = None
+            return
+        if self.state is None or time.monotonic() - self.resynced > self.resync_seconds:
+            self.resynced = time.monotonic()
+            self.pending = []
+            try:
+                state = await tornado.ioloop.IOLoop.current().run_in_executor(None, self.read_state)
+            finally:
+                pending, self.pending = self.pending, None
+            for hook in pending:
+                hook(state)
+            self.state = state
+            self.changed = True
+        if self.changed and self.state is not None:
+            self.changed = False
+            message = self.message()
+            for listener in list(self.listeners):
+                listener(message)
+
+    # hooks of the handlers
+    def update(self, hook):
+        """Applies hook to the status, and queues it for the status being read."""
+        if self.pending is not None:
+            self.pending.append(hook)
+        if self.state is not None:
+            hook(self.state)
+            self.changed = True
+    def response_submitted(self):
+        def hook(state):
+            state['hitinfo']['num_completed_tasks'] += 1
+        self.update(hook)
+    def hit_taken(self, workerid, hitid):
+        def hook(state):
+            state['outstanding'][workerid] = hitid
+        self.update(hook)
+    def hit_released(self, workerid):
+        def hook(state):
+            state['outstanding'].pop(workerid, None)
+        self.update(hook)
+    def hit_completed(self, hitid):
+        def hook(state):
+            state['hitinfo']['num_completed_hits'] += 1
+            state['completed'].add(hitid)
+        self.update(hook)
@@ -9,5 +9,11 @@ class EventController(object):
         event = str(event)
         self.db.events.insert({'date' : datetime.datetime.utcnow(),
                                'event' : event})
-    def get_events(self) :
-        return list(self.db.events.find().sort("date"))
+    def get_events(self, limit=None) :
+        """The events in the order they happened, only the last limit ones if given."""
+        if limit is None :
+            return self.db.events.all()
+        return self.db.events.last(limit)
+    def trim(self, keep) :
+        """Removes all but the last keep events. Returns the number removed."""
+        return self.db.events.trim(keep)
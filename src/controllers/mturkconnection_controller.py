@@ -4,7 +4,6 @@ from models import MTurkConnection
 class MTurkConnectionController(object):
     def __init__(self, db):
         self.db = db
-        self.db.mturkconnections.ensure_index('email', unique=True)
 
     def create(self, d):
         mtconn = MTurkConnection(**d)
@@ -15,18 +14,19 @@ class MTurkConnectionController(object):
         # self.db.mturkconnections.update({'email' : mtconn.email}, 
         #                                 {'$set' : mtconn.serialize()},
         #                                 upsert=True )
-        self.db.mturkconnections.update({}, 
-                                        {'$set' : mtconn.serialize()},
-                                        upsert=True )
+        self.db.mturkconnections.update(mtconn.serialize())
         print(mtconn.serialize())
 
     def get_hit_id(self) :
-        d = self.db.mturkconnections.find_one({})
+        d = self.db.mturkconnections.get()
         return d['hitid'] if d else None
 
+    def get_connection_info(self) :
+        return self.db.mturkconnections.get()
+
     def get_by_email(self, email=None, environment="development"):
         #d = self.db.mturkconnections.find_one({'email' : email})
-        d = self.db.mturkconnections.find_one({})
+        d = self.db.mturkconnections.get()
         if not d:
             return None
         else:
@@ -42,15 +42,24 @@ class MTurkConnectionController(object):
 
     async def end_run_async(self, email=None, bonus={}, environment="development") :
         mt_conn = self.get_by_email(email=email, environment=environment)
-        ap_sel = self.db.paid_bonus.find()
-        already_paid = [a['workerid'] for a in ap_sel]
+        already_paid = [a['workerid'] for a in self.get_paid_bonuses()]
         paid_bonus = await mt_conn.end_run_async(bonus=bonus, already_paid=already_paid)
         for pb_info in paid_bonus :
             self.db.paid_bonus.insert(pb_info)
         self.update(mt_conn)
 
+    def get_paid_bonuses(self):
+        return self.db.paid_bonus.all()
+
+    def store_bonus_info(self, bonus_info):
+        """Replaces the bonus of every worker computed at the end of the run."""
+        self.db.bonus_info.replace(bonus_info)
+
+    def get_bonus_info(self):
+        return self.db.bonus_info.all()
+
     def get_all(self, environment="development"):
-        d = self.db.mturkconnections.find()
+        d = self.db.mturkconnections.all()
         if d :
             for c in d:
                 c['environment']=environment
@@ -0,0 +1,85 @@
+import functools
+import time
+
+import tornado.concurrent
+import tornado.ioloop
+
+MODES = ('acknowledged', 'group_commit')
+
+# upper bounds of the buckets of the batch size histogram
+BATCH_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class ResponseWriter(object):
+    """Stores the submitted responses. In the 'acknowledged' mode every response is
+       inserted on its own on the request path. In the 'group_commit' mode the
+       responses that arrive within delay seconds (at most max_batch) are inserted
+       together in the executor, and write() returns once the batch is stored, so
+       the worker is only answered for stored responses. One batch is written at a
+       time; the responses arriving meanwhile form the next one. write_concern is
+       passed to the inserts, e.g. {'w' : 'majority', 'j' : True} for MongoDB.
+       The batch sizes and the time from write() to the stored response are
+       recorded in metrics.
+
+       A response is stored up to delay seconds plus the time of the insert after
+       it was submitted, which has to stay well below the settle_seconds of the
+       incremental export."""
+    def __init__(self, cresponse_controller, metrics, mode='acknowledged', delay=0.005, max_batch=500,
+                 write_concern=None):
+        if mode not in MODES:
+            raise ValueError("Unknown response writer mode %s, use one of %s" % (mode, ', '.join(MODES)))
+        self.cresponse_controller = cresponse_controller
+        self.mode = mode
+        self.delay = delay
+        self.max_batch = max_batch
+        self.write_concern = write_concern or {}
+        self.batch_histogram = metrics.histogram('response_batch_size', BATCH_BOUNDS)
+        self.latency_histogram = metrics.histogram('response_write_seconds')
+        self.pending = []
+        self.timer = None
+        self.flushing = False
+    async def write(self, d):
+        """Stores the response d (as for CResponseController.create) and returns its
+           CResponse. Raises what the insert raised."""
+        start = time.perf_counter()
+        if self.mode == 'acknowledged':
+            cresponse = self.cresponse_controller.create(d, self.write_concern)
+            self.batch_histogram.observe(1)
+        else:
+            future = tornado.concurrent.Future()
+            self.pending.append((d, future))
+            self.schedule()
+            cresponse = await future
+        self.latency_histogram.observe(time.perf_counter() - start)
+        return cresponse
+    def schedule(self):
+        if self.flushing or not self.pending:
+            return
+        ioloop = tornado.ioloop.IOLoop.current()
+        if len(self.pending) >= self.max_batch:
+            if self.timer is not None:
+                ioloop.remove_timeout(self.timer)
+            self.timer = None
+            ioloop.add_callback(self.flush)
+        elif self.timer is None:
+            self.timer = ioloop.call_later(self.delay, self.flush)
+    async def flush(self):
+        self.timer = None
+        if self.flushing or not self.pending:
+            return
+        batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+        self.flushing = True
+        create_many = functools.partial(self.cresponse_controller.create_many, [d for d, f in batch],
+                                        self.write_concern)
+        try:
+            results = await tornado.ioloop.IOLoop.current().run_in_executor(None, create_many)
+        except Exception as e:
+            results = [e] * len(batch)
+        finally:
+            self.flushing = False
+            self.schedule()
+        self.batch_histogram.observe(len(batch))
+        for (d, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
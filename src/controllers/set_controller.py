@@ -3,16 +3,23 @@ from models import SET
 class SetController(object):
     def __init__(self, db):
         self.db = db
-        self.db.sets.ensure_index('name', unique=False)
     def create(self, d):
         set = SET.deserialize(d)
-        self.db.sets.insert(set.serialize())
+        self.db.sets.insert_many([set.serialize()])
         return set
+    def create_many(self, ds):
+        self.db.sets.insert_many([SET.deserialize(d).serialize() for d in ds])
     def get_sets_names(self) :
-        return [r['name'] for r in self.db.sets.find({}, {'name' : 1})]
+        return self.db.sets.names()
     def get_set_count(self) :
         return self.db.sets.count()
-    def get_set_by_name(self, name):
-        d = self.db.ctasks.find_one({'name' : name})
-        set = SET.deserialize(d)
-        return set
\ No newline at end of file
+    def get_set(self, name):
+        """Returns the set called name, which the task conditions test members of."""
+        return StoredSet(self.db, name)
+
+class StoredSet(object):
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+    def hasMember(self, value):
+        return self.db.sets.has_member(self.name, str(value))
@@ -0,0 +1,173 @@
+import datetime
+import time
+import uuid
+
+import storage
+from models import CType
+
+# the collections that belong to a survey; every upload loads them into a new generation
+SURVEY_COLLECTIONS = ('ctasks', 'ctypes', 'cresponses', 'chits', 'cdocs', 'chitloads',
+                      'currentstatus', 'workerpings', 'paid_bonus', 'bonus_info', 'sets')
+
+def generation_collection_name(name, generation):
+    # surveys loaded before generations were introduced live in the plain collections
+    return name + '_' + generation if generation and name in SURVEY_COLLECTIONS else name
+
+class GenerationalDatabase(object):
+    """Wraps a storage database so that the survey collections resolve to the
+       collections of the current survey generation (ctasks_<generation>, ...).
+       All other collections are shared by the generations. pinned() returns a
+       database that always resolves to one generation, which is used to load a
+       survey before it is activated."""
+    def __init__(self, database, survey_controller, generation=None):
+        self.database = database
+        self.survey_controller = survey_controller
+        self.generation = generation
+    def pinned(self, generation):
+        return GenerationalDatabase(self.database, self.survey_controller, generation)
+    def collection_name(self, name):
+        generation = self.generation if self.generation is not None else self.survey_controller.get_generation()
+        return generation_collection_name(name, generation)
+    def __getattr__(self, name):
+        if name in SURVEY_COLLECTIONS:
+            return self.database.collection(name, self.collection_name(name))
+        return getattr(self.database, name)
+
+class SurveyController(object):
+    """Keeps track of the currently loaded survey. Every upload is loaded into a
+       new generation of the survey collections, which is then activated by
+       swapping the pointer in db.survey. Anything derived from the survey
+       definition can be cached until the generation changes."""
+    # retired generations are dropped once every server process has re-read the pointer
+    gc_delay = 60.0
+    def __init__(self, db, ttl=1.0):
+        self.db = db
+        self.ttl = ttl
+        self._generation = None
+        self._checked = 0
+    def create_generation(self):
+        return uuid.uuid4().hex
+    def activate(self, generation):
+        """Makes generation the current survey. The pointer is swapped with a
+           compare-and-set on the previous generation, which is retired in the same
+           update so that collect_garbage() drops it later."""
+        while True:
+            now = datetime.datetime.utcnow()
+            d = self.db.survey.get('current')
+            if d is None:
+                try:
+                    self.db.survey.create({'_id' : 'current',
+                                           'generation' : generation,
+                                           'uploaded' : now,
+                                           'retired' : [{'generation' : '', 'retired' : now}]})
+                    break
+                except storage.DuplicateKeyError:
+                    continue
+            if self.db.survey.swap_generation(d['generation'], generation, now):
+                break
+        self._generation = generation
+        self._checked = time.monotonic()
+    def get_generation(self):
+        # other server processes may have loaded a new survey, so the pointer is
+        # re-read from the database at most every ttl seconds
+        if time.monotonic() - self._checked > self.ttl:
+            d = self.db.survey.get('current')
+            self._generation = d['generation'] if d else ''
+            self._checked = time.monotonic()
+        return self._generation
+    def drop_generation(self, generation):
+        for name in SURVEY_COLLECTIONS:
+            self.db.drop_collection(generation_collection_name(name, generation))
+        self.db.survey.remove('metadata:' + generation)
+    def collect_garbage(self):
+        """Drops the generations that were retired more than gc_delay seconds ago."""
+        d = self.db.survey.get('current')
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.gc_delay)
+        for retired in (d or {}).get('retired', []):
+            if retired['retired'] < cutoff:
+                self.drop_generation(retired['generation'])
+                self.db.survey.remove_retired(retired['generation'])
+    def create_metadata(self, ctypes, tasks, hits, generation=None, base=None, store=True):
+        """Computes and stores what the bonus calculation needs to know about the
+           survey: the maximal bonus points of each cHIT, the module/varname/valuetype
+           crosswalk with the a priori permissable values and the bonus questions of
+           each module. Everything is stored as lists because module names, varnames
+           and ids may contain dots. base is the stored metadata of the survey that
+           ctypes, tasks and hits are appended to. With store=False the metadata is
+           only returned."""
+        modules = list(base['modules']) if base else []
+        for ctype in ctypes:
+            questions = []
+            for q in ctype.questions:
+                apriori = []
+                if q.valuetype == "categorical":
+                    apriori = [c['value'] for c in q.content if c.get('aprioripermissable') == True]
+                questions.append({'varname' : q.varname,
+                                  'valuetype' : q.valuetype,
+                                  'aprioripermissable' : apriori})
+            modules.append({'name' : ctype.name,
+                            'bonuspoints' : sum(q.bonuspoints for q in ctype.questions),
+                            'questions' : questions,
+                            'bonus_questions' : [q.varname for q in ctype.questions if q.bonuspoints != 0]})
+        module_points = {m['name'] : m['bonuspoints'] for m in modules}
+        task_out = list(base['tasks']) if base else []
+        task_out.extend({'taskid' : task['taskid'], 'modules' : task['modules']} for task in tasks)
+        task_points = {}
+        for task in task_out:
+            task_points[task['taskid']] = task_points.get(task['taskid'], 0) + \
+                sum(module_points.get(m, 0) for m in task['modules'])
+        chits = list(base['chits']) if base else []
+        chits.extend({'hitid' : hit['hitid'],
+                      'bonuspoints' : sum(task_points.get(t, 0) for t in hit['tasks'])} for hit in hits)
+        if generation is None:
+            generation = self.get_generation()
+        d = {'_id' : 'metadata:' + generation,
+             'generation' : generation,
+             'max_bonus_points' : max([c['bonuspoints'] for c in chits] + [0]),
+             'modules' : modules,
+             'tasks' : task_out,
+             'chits' : chits}
+        if store:
+            self.db.survey.put(d)
+        return self.decode_metadata(d)
+    def extend_metadata(self, ctypes, tasks, hits, generation):
+        """Adds the modules, tasks and cHITs of an appended upload to the metadata."""
+        base = self.db.survey.get('metadata:' + generation)
+        if base is None:
+            # computed from the collections, which already contain the appended survey
+            return self.get_metadata(generation)
+        return self.create_metadata(ctypes, tasks, hits, generation, base)
+    def get_metadata(self, generation=None, store=True):
+        """Returns the metadata of the current survey as dicts:
+           max_bonus_points, chit_bonus_points (hitid -> points),
+           crosswalk (module -> varname -> {valuetype, aprioripermissable}),
+           bonus_questions (module -> [varname]) and task_modules (taskid -> [module]).
+           Metadata that was not stored at upload time is computed and stored, unless
+           store is False."""
+        if generation is None:
+            generation = self.get_generation()
+        # not cached, appended uploads change the metadata within a generation
+        d = self.db.survey.get('metadata:' + generation)
+        if d is None:
+            # surveys uploaded before the metadata was stored
+            db = GenerationalDatabase(self.db, self, generation)
+            return self.create_metadata([CType.from_dict(c) for c in db.ctypes.all()],
+                                        db.ctasks.all(['taskid', 'modules']),
+                                        db.chits.all(['hitid', 'tasks']),
+                                        generation, store=store)
+        return self.decode_metadata(d)
+    @staticmethod
+    def decode_metadata(d):
+        task_modules = {}
+        for task in d['tasks']:
+            # like ctasks.get, the first task with a taskid wins
+            task_modules.setdefault(task['taskid'], task['modules'])
+        return {'generation' : d['generation'],
+                'max_bonus_points' : d['max_bonus_points'],
+                'chit_bonus_points' : {c['hitid'] : c['bonuspoints'] for c in d['chits']},
+                'crosswalk' : {m['name'] : {q['varname'] : {'valuetype' : q['valuetype'],
+                                                            'aprioripermissable' : q['aprioripermissable']}
+                                            for q in m['questions']}
+                               for m in d['modules']},
+                'bonus_questions' : {m['name'] : m['bonus_questions'] for m in d['modules']},
+                'task_modules' : task_modules}
@@ -0,0 +1,26 @@
+import datetime
+
+class WorkerPingController(object):
+    """Records the last time the browser of the worker holding a cHIT pinged the
+       server. cHITs whose pings stop for stale_seconds are handed to other workers."""
+    def __init__(self, db, stale_seconds=30.0):
+        self.db = db
+        self.stale_seconds = stale_seconds
+    def ping(self, hitid=None):
+        self.db.workerpings.ping(hitid, datetime.datetime.utcnow())
+    def ping_many(self, hitids):
+        """Pings the cHITs of the workers connected over the worker socket together."""
+        if not hitids :
+            return
+        self.db.workerpings.ping_many(hitids, datetime.datetime.utcnow())
+    def expire(self, hitid, seconds):
+        """Lets the cHIT become stale seconds from now instead of stale_seconds after
+           the last ping, for workers whose connection closed."""
+        lastping = datetime.datetime.utcnow() - datetime.timedelta(seconds=max(0.0, self.stale_seconds - seconds))
+        self.db.workerpings.ping(hitid, lastping)
+    def remove_abandoned(self, seconds, outstanding_hits) :
+        """Removes the pings older than seconds of the cHITs no worker holds. The
+           pings of held cHITs are kept so that they still become stale. Returns the
+           number removed."""
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)
+        return self.db.workerpings.remove_older(cutoff, outstanding_hits)
@@ -1,4 +1,22 @@
+import itertools
+
 import models
+from .cdocument_controller import CDocumentController
+from .chit_controller import CHITController
+from .ctask_controller import CTaskController
+from .ctype_controller import CTypeController
+from .set_controller import SetController
+
+class SurveyError(Exception):
+    pass
+
+def batches(iterable, size=1000):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
 class XMLTaskController(object):
     def __init__(self, db):
@@ -6,19 +24,128 @@ class XMLTaskController(object):
     def xml_process(self, xml_path=None) :
         return models.XMLTask(xml_path)
 
-    def dropDB(self) :
-        self.db.ctasks.drop()
-        self.db.ctypes.drop()
-        self.db.cresponses.drop()
-        self.db.chits.drop()
-        self.db.cdocs.drop()
-        self.db.chitloads.drop()
-        self.db.currentstatus.drop()
-        self.db.workerpings.drop()
-        self.db.paid_bonus.drop()
-        self.db.bonus_info.drop()
-        self.db.sets.drop()
+    def read_survey(self, xml_path, append=False):
+        """Parses the survey and checks that none of its parts is missing. Returns a
+           dict with the modules, tasks, hits and sets and the documents. For a new
+           survey these are iterators: the questions, tasks and cHITs are expanded
+           while load() inserts them, so errors in the expansion are raised from
+           load(). An appended survey is expanded into lists, because check_append()
+           validates all of it before anything is inserted, and only needs to contain
+           tasks or cHits. Raises SurveyError if a part of the survey is missing."""
+        xmltask = self.xml_process(xml_path)
+        survey = {'modules' : xmltask.get_modules(),
+                  'tasks' : xmltask.get_tasks(),
+                  'hits' : xmltask.get_hits(),
+                  'sets' : xmltask.get_sets(),
+                  'docs' : xmltask.docs}
+        if append:
+            for part in ('modules', 'tasks', 'hits', 'sets'):
+                survey[part] = list(survey[part])
+            if len(survey['tasks'])==0 and len(survey['hits'])==0:
+                raise SurveyError("Survey adds no tasks or cHits.")
+            return survey
+        for part, name in (('modules', 'modules'), ('tasks', 'tasks'), ('hits', 'cHits')):
+            first = next(survey[part], None)
+            if first is None:
+                raise SurveyError("Survey has no %s." % name)
+            survey[part] = itertools.chain([first], survey[part])
+        if len(survey['docs'])==0:
+            raise SurveyError("Survey has no docs.")
+        return survey
+
+    def load(self, db, survey):
+        """Bulk loads a survey returned by read_survey() into db, a database pinned to
+           a new generation, in batches. The collections are created first, so their
+           indexes exist before the survey is activated. Returns the CType of every
+           module and the taskid and modules of every task and the hitid and tasks of
+           every cHIT, which the survey metadata is computed from. The survey is loaded
+           in a single transaction on the engines that have them."""
+        for name in ('currentstatus', 'cresponses', 'workerpings'):
+            # the repositories create the collection and its indexes
+            getattr(db, name)
+        with db.batch():
+            ctypes = CTypeController(db).create_many(survey['modules'])
+            tasks, hits = [], []
+            ctask_controller = CTaskController(db)
+            for batch in batches(survey['tasks']):
+                ctask_controller.create_many(batch)
+                tasks.extend({'taskid' : t['taskid'], 'modules' : t['modules']} for t in batch)
+            chit_controller = CHITController(db)
+            for batch in batches(survey['hits']):
+                chit_controller.create_many(batch)
+                hits.extend({'hitid' : h['hitid'], 'tasks' : h['tasks']} for h in batch)
+            set_controller = SetController(db)
+            for batch in batches(survey['sets']):
+                set_controller.create_many(batch)
+            CDocumentController(db).create_many(survey['docs'])
+        return ctypes, tasks, hits
+
+    def check_append(self, db, survey):
+        """Checks that survey can be appended to the survey in db. Modules have to be
+           new or identical to the live ones, taskids and hitids have to be new and
+           documents new or unchanged. Tasks may show live documents that the file
+           does not contain. Removes the modules and documents that are already live
+           from survey and raises SurveyError otherwise."""
+        live_modules = {d['name'] : d for d in db.ctypes.get_many([m['name'] for m in survey['modules']])}
+        new_modules = []
+        for module in survey['modules']:
+            if module['name'] in live_modules:
+                if models.CType.from_dict(module).to_dict() != live_modules[module['name']]:
+                    raise SurveyError("Module %s differs from the module in the running survey." % module['name'])
+            else:
+                new_modules.append(module)
+        survey['modules'] = new_modules
+        # the live taskids, hitids and module names among the given ones
+        live_taskids = lambda ids : [d['taskid'] for d in db.ctasks.get_many(ids, ['taskid'])]
+        live_hitids = lambda ids : [d['hitid'] for d in db.chits.get_many(ids, ['hitid'])]
+        live_names = lambda names : [d['name'] for d in db.ctypes.get_many(names)]
+        def check_new(kind, ids, live):
+            seen = set()
+            for i in ids:
+                if i in seen:
+                    raise SurveyError("%s %s is defined more than once." % (kind, i))
+                seen.add(i)
+            for i in live(seen):
+                raise SurveyError("%s %s is already part of the running survey." % (kind, i))
+        check_new("Task", [t['taskid'] for t in survey['tasks']], live_taskids)
+        check_new("cHit", [h['hitid'] for h in survey['hits']], live_hitids)
+        def check_known(kind, names, live, added):
+            names = set(names) - set(added)
+            known = set(live(names))
+            if names - known:
+                raise SurveyError("%s %s is not defined." % (kind, sorted(names - known)[0]))
+        check_known("Module", [m for t in survey['tasks'] for m in t['modules']],
+                    live_names, [m['name'] for m in survey['modules']])
+        check_known("Task", [t for h in survey['hits'] for t in h['tasks']],
+                    live_taskids, [t['taskid'] for t in survey['tasks']])
+        document_controller = CDocumentController(db)
+        # a task whose document is not in the file may show a live document
+        names = [t['content'] for t in survey['tasks'] if t['document'] is None]
+        live_hashes = document_controller.get_hashes(names)
+        for task in survey['tasks']:
+            if task['document'] is None:
+                if task['content'] not in live_hashes:
+                    raise SurveyError("Document %s of task %s is not defined." % (task['content'], task['taskid']))
+                task['document'] = live_hashes[task['content']]
+                task['content'] = None
+        live_docs = document_controller.get_hashes(survey['docs'])
+        for name, content in list(survey['docs'].items()):
+            if name in live_docs:
+                if live_docs[name] != models.CDocument.hash_content(content):
+                    raise SurveyError("Document %s differs from the document in the running survey." % name)
+                del survey['docs'][name]
 
+    def append(self, db, survey):
+        """Bulk inserts a survey checked by check_append() into db. The cHits are
+           inserted last, so workers are only handed cHits whose tasks exist.
+           Returns the CType of every new module."""
+        with db.batch():
+            ctypes = CTypeController(db).create_many(survey['modules'])
+            CDocumentController(db).create_many(survey['docs'])
+            CTaskController(db).create_many(survey['tasks'])
+            SetController(db).create_many(survey['sets'])
+            CHITController(db).create_many(survey['hits'])
+        return ctypes
 
 """
         for module in xmltask.get_modules():
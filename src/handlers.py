@@ -4,6 +4,7 @@ import tornado.httpserver
 import tornado.ioloop
 import tornado.options
 import tornado.web
+import tornado.websocket
 import datetime
 import calendar
 import email.utils
@@ -17,18 +18,46 @@ import json
 import helpers
 import urllib
 import csv
+import hashlib
+import hmac
+import math
 import io
+import tempfile
 import app_config
 from io import BytesIO
 from zipfile import ZipFile
-from helpers import CountryTools
+from helpers import CountryTools, export_machine, json_machine
 
 
 from tornado.options import define, options
 from helpers import CustomEncoder, Lexer, Status
 import jsonpickle
 
+def overloaded_json(retry_after):
+    return {'error' : True, 'explanation' : 'overloaded', 'retry_after' : retry_after}
+
 class BaseHandler(tornado.web.RequestHandler):
+    # the worker endpoint in app_config.admission whose limiter admits the requests
+    admission_endpoint = None
+    admitted = None
+
+    async def prepare(self):
+        if self.admission_endpoint is None :
+            return
+        limiter = self.application.admission[self.admission_endpoint]
+        try :
+            await limiter.acquire(waited=self.request.request_time())
+        except helpers.Overloaded as e :
+            return self.return_overloaded(e.retry_after)
+        self.admitted = limiter
+    def on_finish(self):
+        if self.admitted is not None :
+            self.admitted.release()
+            self.admitted = None
+    def return_overloaded(self, retry_after):
+        self.set_status(503)
+        self.set_header('Retry-After', '%d' % math.ceil(retry_after))
+        self.return_json(overloaded_json(retry_after))
 
     @property
     def logging(self) :
@@ -64,12 +93,24 @@ class BaseHandler(tornado.web.RequestHandler):
     def cresponse_controller(self):
         return self.application.cresponse_controller
     @property
+    def bonus_controller(self):
+        return self.application.bonus_controller
+    @property
     def mturkconnection_controller(self):
         return self.application.mturkconnection_controller
     @property
     def event_controller(self):
         return self.application.event_controller
     @property
+    def workerping_controller(self):
+        return self.application.workerping_controller
+    @property
+    def cimage_controller(self):
+        return self.application.cimage_controller
+    @property
+    def image_processor(self):
+        return self.application.image_processor
+    @property
     def main_hit_url(self) :
         return "http://" + self.request.host + "/HIT"
     def is_super_admin(self):
@@ -77,9 +118,179 @@ class BaseHandler(tornado.web.RequestHandler):
         return admin_email in app_config.superadmins
     def get_current_admin(self):
         admin = self.admin_controller.get_by_email(tornado.escape.to_unicode(self.get_secure_cookie("admin_email")))
-    def return_json(self, data):
+    @property
+    def dashboard_controller(self):
+        return self.application.dashboard_controller
+    @property
+    def survey_controller(self):
+        return self.application.survey_controller
+    @property
+    def payload_cache(self):
+        return self.application.payload_cache
+    @property
+    def metrics(self):
+        return self.application.metrics
+    @property
+    def response_writer(self):
+        return self.application.response_writer
+    @property
+    def submission_results(self):
+        return self.application.submission_results
+    def task_payload(self, chit, taskindex, lean=False):
+        """The data the worker's browser needs to show task number taskindex of chit,
+           as JSON bytes composed from pre-serialized parts cached per survey generation.
+           In lean mode the module definitions are left out and the client fetches
+           them from /HIT/modules/; hit_modules lists all modules of the cHIT so the
+           client can fetch them ahead of time."""
+        generation = self.survey_controller.get_generation()
+        taskid = chit.tasks[taskindex]
+        task_json, modules = self.payload_cache.get(generation, ('task', taskid),
+                                                    lambda : self.task_json(taskid))
+        parts = [("task", task_json),
+                 ("task_num", json_machine.dumps(taskindex)),
+                 ("num_tasks", json_machine.dumps(len(chit.tasks)))]
+        if lean :
+            parts.append(("modules_version", json_machine.dumps(generation)))
+            parts.append(("hit_modules", self.payload_cache.get(generation, ('hit_modules', chit.hitid),
+                                                                lambda : json_machine.dumps(self.ctask_controller.get_module_names(chit.tasks)))))
+        else :
+            parts.append(("modules", self.modules_json(tuple(sorted(set(modules))))[0]))
+        return json_machine.compose(parts)
+    async def submit_response(self, worker_id, response, prefetch=False, requestid=None):
+        """Records the response of the worker to the current task of their cHIT and
+           moves them on to the next task whose condition holds. Returns the reply
+           for the browser, which is the next task as JSON bytes if prefetch is set
+           and there is one. Used by /HIT/submit and the worker socket.
+
+           requestid is the browser's id of the submission, the same for its retries.
+           A retry is answered with the reply to the first attempt and the response
+           is stored once."""
+        if not worker_id or not requestid :
+            return await self.record_response(worker_id, response, prefetch)
+        # unique across workers, as it is stored with the response
+        requestid = '%s:%s' % (worker_id, requestid)
+        return await self.submission_results.get(requestid,
+                                                 lambda : self.record_response(worker_id, response, prefetch,
+                                                                               requestid),
+                                                 keep=lambda reply : not (isinstance(reply, dict) and
+                                                                          reply.get('error')))
+    async def record_response(self, worker_id, response, prefetch=False, requestid=None):
+        existing_status = self.currentstatus_controller.get_current_status(worker_id)
+        if not existing_status:
+            if not worker_id :
+                return {'error' : True, 'explanation' : 'no_cookies'}
+            else :
+                return {'error' : True, 'explanation' : 'not_logged_in'}
+        hitid = existing_status['hitid']
+        chit = self.chit_controller.get_chit_by_id(hitid, models.CHIT.view_fields)
+        #print(chit.serialize())
+        taskindex = existing_status['taskindex']
+        if requestid :
+            stored = self.cresponse_controller.get_by_requestid(requestid)
+            if stored and (stored['hitid'] != chit.hitid or chit.tasks[taskindex:taskindex+1] != [stored['taskid']]) :
+                # an earlier attempt moved the worker on, but its reply was lost
+                return self.next_task_reply(chit, taskindex, prefetch)
+        taskid = chit.tasks[taskindex]
+        #task = self.ctask_controller.get_task_by_id(taskid)
+
+        result = self.cresponse_controller.process_response(taskid, response,
+                                                            self.ctask_controller,
+                                                            self.ctype_controller)
+        self.logging.debug("processed response for task %s in %s" % (taskid, result['timings']))
+        if not result['valid'] :
+            return {'error' : True, 'explanation' : 'invalid_response'}
+        images = await self.cresponse_controller.process_uploads(result['uploads'],
+                                                                 self.image_processor,
+                                                                 self.cimage_controller,
+                                                                 workerid=worker_id)
+        if images is None :
+            return {'error' : True, 'explanation' : 'invalid_response'}
+        response = result['response']
+
+        self.logging.info("%s submitted response for task_index %d on HIT %s" % (worker_id, taskindex, hitid))
+        try :
+            await self.response_writer.write({'submitted' : datetime.datetime.utcnow(),
+                                              'response' : response,
+                                              'workerid' : worker_id,
+                                              'hitid' : chit.hitid,
+                                              'taskid' : taskid,
+                                              'images' : images,
+                                              'requestid' : requestid})
+        except pymongo.errors.DuplicateKeyError :
+            # another attempt of the same submission stored it; the worker moves on once
+            self.logging.info("%s resubmitted request %s" % (worker_id, requestid))
+        else :
+            self.dashboard_controller.response_submitted()
+        #check if there is a taskcondition set
+        skip=1
+        while taskindex+skip<len(chit.taskconditions):
+            oldSkip=skip
+            if chit.taskconditions[taskindex+skip]!=None:
+                #let's check the condition
+                condition=jsonpickle.decode(chit.taskconditions[taskindex+skip])
+                allVariables=dict()
+                has_error=False
+                for v in condition.varlist:
+                    if v=="$workerid":
+                        allVariables["$workerid"]=worker_id
+                    else:
+                        frags=v.split('*')
+                        if len(frags)!=3:
+                            has_error=True
+                        else:
+                            lastDoc=self.cresponse_controller.get_latest_response(worker_id, chit.hitid, frags[0],
+                                                                                  ['response'])
+                            if lastDoc!=None:
+                                response=lastDoc["response"]
+                                for module in response:
+                                    if module["name"]==frags[1]:
+                                        for q in module["responses"]:
+                                            if q["varname"]==frags[2] and ("response" in q):
+                                                allVariables[v]=q["response"]
+
+                allSets=dict()
+                for s in condition.setlist:
+                    allSets[s]=self.set_controller.get_set(s)
+                if has_error:
+                    skip+=1
+                else:
+                    status=Status()
+                    if not condition.check_conditions(allVariables, allSets, status):
+                        skip+=1
+            if skip==oldSkip:
+               break;
+        self.currentstatus_controller.create_or_update(workerid=worker_id,
+                                                       hitid=hitid,
+                                                       taskindex=taskindex+skip)
+        return self.next_task_reply(chit, taskindex+skip, prefetch)
+    def next_task_reply(self, chit, taskindex, prefetch):
+        if prefetch and taskindex < len(chit.tasks) :
+            # saves the client the round-trip to /HIT/view for the next task
+            return json_machine.compose([("next_task", self.task_payload(chit, taskindex, lean=True))])
+        return {}
+    def task_json(self, taskid):
+        task = self.ctask_controller.get_task_by_id(taskid)
+        return (json_machine.dumps(task.serialize()), task.modules)
+    def modules_json(self, names):
+        """Returns the serialized definitions of the modules with the given sorted
+           names and their ETag, cached per survey generation."""
+        generation = self.survey_controller.get_generation()
+        def serialize():
+            modules = self.ctype_controller.get_by_names(names)
+            body = json_machine.dumps({name : modules[name].to_dict() for name in names})
+            return (body, '"%s"' % hashlib.sha1(body).hexdigest())
+        return self.payload_cache.get(generation, ('modules',) + names, serialize)
+    def return_json(self, data, pretty=False):
+        """Sends data as JSON. Pre-serialized JSON can be passed as bytes."""
         self.set_header('Content-Type', 'application/json')
-        self.finish(json.dumps(data, indent = 4, sort_keys = True))
+        if isinstance(data, bytes) :
+            self.finish(data)
+        else :
+            self.finish(json_machine.dumps(data, pretty=pretty))
+    def compute_etag(self):
+        # handlers serving cached payloads set a precomputed content hash
+        etag = getattr(self, '_etag', None)
+        return etag if etag else super(BaseHandler, self).compute_etag()
 
 class MainHandler(BaseHandler):
     def get(self):
@@ -157,51 +368,132 @@ class LogoutHandler(BaseHandler) :
         self.redirect('/admin/')
 
 class XMLUploadHandler(BaseHandler):
-    def post(self):
+    """Loads the survey into a new generation of the survey collections in the
+       background and activates it once it is indexed. Workers keep using the
+       previous survey until the swap; it is dropped later by collect_garbage()."""
+    async def post(self):
         if not self.request.files :
             self.return_json({'error' : "Error: No file selected."});
             return
+        if self.get_argument('append', None) == '1':
+            await self.append()
+            return
+        ioloop = tornado.ioloop.IOLoop.current()
         try :
-            with open(os.path.join(Settings.TMP_PATH, uuid.uuid4().hex + '.upload'), 'wb') as temp:
-                temp.write(self.request.files['file'][0]['body'])
-                temp.flush()
-                uploadedFilename = self.request.files['file'][0]['filename']
-                xmltask = self.xmltask_controller.xml_process(temp.name)
-                if len(list(xmltask.get_modules()))==0:
-                    self.return_json({'error' : "Error: Survey has no modules."})
-                    return
-                if len(list(xmltask.get_tasks()))==0:
-                    self.return_json({'error' : "Error: Survey has no tasks."})
-                    return
-                if len(list(xmltask.get_hits()))==0:
-                    self.return_json({'error' : "Error: Survey has no cHits."})
-                    return
-                if len(list(xmltask.docs.items()))==0:
-                    self.return_json({'error' : "Error: Survey has no docs."})
-                    return
-                self.xmltask_controller.dropDB()
-                self.event_controller.add_event("Uploaded: " + uploadedFilename)
-                for module in xmltask.get_modules():
-                    self.ctype_controller.create(module)
-                for task in xmltask.get_tasks():
-                    self.ctask_controller.create(task)
-                for hit in xmltask.get_hits():
-                    self.chit_controller.create(hit)
-                for set in xmltask.get_sets():
-                    self.set_controller.create(set)
-                for name, doc in xmltask.docs.items():
-                    self.cdocument_controller.create(name, doc)
+            uploadedFilename = self.request.files['file'][0]['filename']
+            path = self.save_upload()
+            try :
+                survey = await ioloop.run_in_executor(None, self.xmltask_controller.read_survey, path)
+            except controllers.SurveyError as x :
+                self.return_json({'error' : "Error: " + str(x)})
+                return
+            finally :
+                os.remove(path)
+            generation = self.survey_controller.create_generation()
+            try :
+                staging = self.db.pinned(generation)
+                ctypes, tasks, hits = await ioloop.run_in_executor(None, self.xmltask_controller.load, staging, survey)
+                self.survey_controller.create_metadata(ctypes, tasks, hits, generation)
+            except Exception :
+                await ioloop.run_in_executor(None, self.survey_controller.drop_generation, generation)
+                raise
+            self.survey_controller.activate(generation)
+            self.event_controller.add_event("Uploaded: " + uploadedFilename)
             self.return_json({'success' : True})
         except Exception as x :
             self.return_json({'error' : type(x).__name__ + ": " + str(x)})
             raise
+    async def append(self):
+        """Adds the tasks, cHits, sets and documents of the uploaded survey to the
+           running survey, without touching the responses."""
+        ioloop = tornado.ioloop.IOLoop.current()
+        try :
+            uploadedFilename = self.request.files['file'][0]['filename']
+            generation = self.survey_controller.get_generation()
+            live = self.db.pinned(generation)
+            path = self.save_upload()
+            try :
+                survey = await ioloop.run_in_executor(None, self.xmltask_controller.read_survey, path, True)
+                await ioloop.run_in_executor(None, self.xmltask_controller.check_append, live, survey)
+            except controllers.SurveyError as x :
+                self.return_json({'error' : "Error: " + str(x)})
+                return
+            finally :
+                os.remove(path)
+            ctypes = await ioloop.run_in_executor(None, self.xmltask_controller.append, live, survey)
+            self.survey_controller.extend_metadata(ctypes, survey['tasks'], survey['hits'], generation)
+            self.event_controller.add_event("Appended: %s (%d tasks, %d cHits)" % (uploadedFilename, len(survey['tasks']), len(survey['hits'])))
+            self.return_json({'success' : True, 'appended' : True})
+        except Exception as x :
+            self.return_json({'error' : type(x).__name__ + ": " + str(x)})
+            raise
+    def save_upload(self):
+        """Writes the uploaded file to TMP_PATH and returns its path; the caller
+           removes it."""
+        with tempfile.NamedTemporaryFile(dir=Settings.TMP_PATH, suffix='.upload', delete=False) as temp:
+            temp.write(self.request.files['file'][0]['body'])
+        return temp.name
 
 class DocumentViewHandler(BaseHandler):
-    def get(self, name):
+    """Serves documents by content hash. The body is immutable, so browsers may
+       cache it for good. Documents are stored gzip compressed and sent as stored to
+       clients that accept gzip; the decompressed body is cached per survey
+       generation. Documents can also be requested by name, which is not cached
+       by the browser."""
+    def get(self, key):
+        generation = self.survey_controller.get_generation()
+        document = self.payload_cache.get(generation, ('document', key),
+                                          lambda : self._prepare(key))
+        if document.hash == key :
+            self.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+        else :
+            self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Vary', 'Accept-Encoding')
+        if 'gzip' in self.request.headers.get('Accept-Encoding', '') :
+            self.set_header('Content-Encoding', 'gzip')
+            self._etag = '"%s-gz"' % document.hash
+            self.finish(document.compressed)
+        else :
+            self._etag = '"%s"' % document.hash
+            self.finish(document.body)
+    def _prepare(self, key):
+        document = self.cdocument_controller.get_document(key)
+        if document is None :
+            document = self.cdocument_controller.get_document_by_name(key)
+        if document is None :
+            raise tornado.web.HTTPError(404)
+        # decompress once, so that the cached document can serve every client
+        document.body
+        return document
+
+class CTypeModulesHandler(BaseHandler):
+    """Returns the definitions of the modules given as names arguments. The URL
+       carries the survey generation as v, so the browser can cache the answer
+       until a new survey is uploaded."""
+    def get(self):
+        names = tuple(sorted(set(self.get_arguments('names'))))
+        generation = self.survey_controller.get_generation()
+        try :
+            body, self._etag = self.modules_json(names)
+        except KeyError :
+            raise tornado.web.HTTPError(404)
+        if self.get_argument('v', None) == generation :
+            self.set_header('Cache-Control', 'private, max-age=86400')
+        else :
+            self.set_header('Cache-Control', 'no-cache')
+        self.return_json(body)
+
+class AdminImageHandler(BaseHandler):
+    def get(self, ref):
+        admin_email = tornado.escape.to_unicode(self.get_secure_cookie('admin_email'))
+        if not (admin_email and self.admin_controller.get_by_email(admin_email)) :
+            raise tornado.web.HTTPError(403)
         try :
-            self.finish(self.cdocument_controller.get_document_by_name(name))
+            content_type, data = self.cimage_controller.get(ref)
         except :
             raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', content_type or 'application/octet-stream')
+        self.finish(data)
 
 class RecruitingBeginHandler(BaseHandler):
     async def post(self):
@@ -227,33 +519,17 @@ class RecruitingEndHandler(BaseHandler):
                 self.event_controller.add_event(admin_email + " ending run " + tkconn.hitid)
             else:
                 self.event_controller.add_event(admin_email + " ending run")
-            #create crosswalk: module/varname/valuetype
-            moduleVarnameValuetype=self.ctype_controller.getModuleVarnameValuetype()
-            #create crosswalk: task/module/variable/workers
-            bonusDetails=self.cresponse_controller.getBonusDetails(moduleVarnameValuetype)
-            #worker/possible bonus points
-            possible_bonus_points = self.chit_controller.getMaxBonusPoints()
-            #now calculate raw bonus points
-            worker_bonus_info =  helpers.calculate_worker_bonus_info(possible_bonus_points, bonusDetails, moduleVarnameValuetype)
-            self.db.bonus_info.drop()
-            for wid, info in worker_bonus_info.items() :
-                self.db.bonus_info.insert({'workerid' : wid,
-                                           'percent' : info['pct'],
-                                           'explanation' : info['exp'],
-                                           'possible' : info['poss'],
-                                           'earned' : info['earn'],
-                                           'rawpct' : info['rawpct'],
-                                           'best' : info['best']})
-            # if the following is set to True crowdsourcer will normalize the
-            # bonus of the best performer for 100% and scale up all other
-            # bonuses proportionally
-            grade_on_a_curve = False
-            if grade_on_a_curve:
-                bonus_pct = 'pct'
-            else:
-                bonus_pct = 'rawpct'
-            worker_bonus_percent = { wid : info[bonus_pct]
-                                     for wid, info in worker_bonus_info.items() }
+            #compute the bonus of every worker in worker processes
+            worker_bonus_info = await self.bonus_controller.compute()
+            self.mturkconnection_controller.store_bonus_info([{'workerid' : wid,
+                                                               'percent' : info['pct'],
+                                                               'explanation' : info['exp'],
+                                                               'possible' : info['poss'],
+                                                               'earned' : info['earn'],
+                                                               'rawpct' : info['rawpct'],
+                                                               'best' : info['best']}
+                                                              for wid, info in worker_bonus_info.items()])
+            worker_bonus_percent = self.bonus_controller.percents(worker_bonus_info)
             await self.mturkconnection_controller.end_run_async(email=admin_email,
                                                     bonus=worker_bonus_percent,
                                                     environment=self.settings['environment'])
@@ -267,8 +543,8 @@ class BonusInfoHandler(BaseHandler) :
         self.set_header ('Content-Disposition', 'attachment; filename=bonusinfo.json')
         admin_email = tornado.escape.to_unicode(self.get_secure_cookie('admin_email'))
         if admin_email and self.admin_controller.get_by_email(admin_email) :
-            bi = self.db.bonus_info.find()
-            pb = self.db.paid_bonus.find()
+            bi = self.mturkconnection_controller.get_bonus_info()
+            pb = self.mturkconnection_controller.get_paid_bonuses()
             resp = {d['workerid'] :
                     {'percent' : d['percent'],
                      'explanation' : d['explanation'],
@@ -281,7 +557,7 @@ class BonusInfoHandler(BaseHandler) :
                     for d in bi}
             total_workers = 0
             total_bonuses = 0
-            connection_info = self.db.mturkconnections.find()[0]
+            connection_info = self.mturkconnection_controller.get_connection_info()
             for d in pb :
                 total_workers += 1
                 total_bonuses += d['amount']
@@ -299,7 +575,7 @@ class BonusInfoHandler(BaseHandler) :
                                         'Total task payments:': total_workers * connection_info['hitpayment'],
                                         'Total bonus payments:': total_bonuses,
                                         'Total overall payments:': total_bonuses + total_workers * connection_info['hitpayment']}
-            self.return_json(resp)
+            self.return_json(resp, pretty=True)
         else :
             self.return_json([])
 
@@ -373,13 +649,41 @@ class AdminInfoHandler(BaseHandler):
                           'hitinfo' : hit_info,
                           'hitstatus' : {'outstanding' : outstanding_hits,
                                          'completed' : completed_hits},
-                          'events' : [{'date' : email.utils.formatdate(calendar.timegm(e['date'].utctimetuple()),
-                                                                       usegmt=True),
-                                       'event' : e['event']}
-                                      for e in self.event_controller.get_events()[-8:]],
+                          'events' : [controllers.event_json(e) for e in self.event_controller.get_events(8)],
                           'turkinfo' : turk_info,
                           'turkbalance' : turk_balance})
 
+class AdminLiveHandler(tornado.websocket.WebSocketHandler):
+    """Pushes the run status of the admin page (hitinfo, hitstatus and events as in
+       /admin/info) to a logged in admin whenever it changes. The status is
+       aggregated once for all admins by the DashboardController."""
+    def open(self):
+        admin_email = tornado.escape.to_unicode(self.get_secure_cookie('admin_email'))
+        if not (admin_email and self.application.admin_controller.get_by_email(admin_email)):
+            self.close(4003, 'not_admin')
+            return
+        message = self.application.dashboard_controller.subscribe(self.send)
+        if message is not None:
+            self.send(message)
+    def send(self, message):
+        try:
+            self.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            self.application.dashboard_controller.unsubscribe(self.send)
+    def on_message(self, message):
+        pass
+    def on_close(self):
+        self.application.dashboard_controller.unsubscribe(self.send)
+
+class AdminMetricsHandler(BaseHandler):
+    """The counters, gauges and latency histograms of this server process."""
+    def get(self):
+        admin_email = tornado.escape.to_unicode(self.get_secure_cookie('admin_email'))
+        if not (admin_email and self.admin_controller.get_by_email(admin_email)):
+            self.set_status(403)
+            return self.return_json({'error' : 'not_admin'})
+        self.return_json(self.metrics.snapshot(), pretty=True)
+
 class AdminHitInfoHandler(BaseHandler):
     def get(self, id=None) :
         admin_email = tornado.escape.to_unicode(self.get_secure_cookie('admin_email'))
@@ -388,7 +692,7 @@ class AdminHitInfoHandler(BaseHandler):
                 ids = self.chit_controller.get_chit_ids()
                 self.return_json({'ids' : ids})
             else :
-                chit = self.chit_controller.get_chit_by_id(id)
+                chit = self.chit_controller.get_chit_by_id(id, models.CHIT.view_fields)
                 self.return_json({'tasks' : chit.tasks})
         else :
             self.return_json({'authed' : False})
@@ -399,6 +703,10 @@ class AdminTaskInfoHandler(BaseHandler):
         if admin_email and self.admin_controller.get_by_email(admin_email):
             task = self.ctask_controller.get_task_by_id(tid)
             modules = self.ctype_controller.get_by_names(task.modules)
+            if task.document :
+                # the content is inlined, so hit.js does not fetch the document again
+                task.content = self.cdocument_controller.get_document(task.document).body.decode('utf8')
+                task.document = None
             self.return_json({
                 "task" : task.serialize(),
                 "modules" : {name : module.to_dict() for name, module in modules.items()}
@@ -412,6 +720,7 @@ class WorkerLoginHandler(BaseHandler):
         self.finish()
 
 class CHITViewHandler(BaseHandler):
+    admission_endpoint = 'view'
     def post(self):
         forced = False
         workerid = tornado.escape.to_unicode(self.get_secure_cookie('workerid'))
@@ -423,6 +732,7 @@ class CHITViewHandler(BaseHandler):
             self.currentstatus_controller.create_or_update(workerid=workerid,
                                                            hitid=hitid,
                                                            taskindex=0)
+            self.dashboard_controller.hit_taken(workerid, hitid)
         if not workerid :
             if forced :
                 self.return_json({'needs_login' : True, 'reforce' : True})
@@ -432,7 +742,7 @@ class CHITViewHandler(BaseHandler):
                 self.return_json({'needs_login' : True})
         else :
             existing_status = self.currentstatus_controller.get_current_status(workerid)
-            chit = self.chit_controller.get_chit_by_id(existing_status['hitid']) if existing_status != None else None
+            chit = self.chit_controller.get_chit_by_id(existing_status['hitid'], models.CHIT.view_fields) if existing_status != None else None
             if chit:
                 taskindex = existing_status['taskindex']
                 hitid = existing_status['hitid']
@@ -440,24 +750,21 @@ class CHITViewHandler(BaseHandler):
                     self.clear_cookie('workerid')
                     completed_chit_info = self.chit_controller.add_completed_hit(chit=chit, worker_id=workerid)
                     self.currentstatus_controller.remove(workerid)
+                    self.dashboard_controller.hit_completed(hitid)
+                    self.dashboard_controller.hit_released(workerid)
                     self.return_json({'completed_hit':True,
                                       'verify_code' : completed_chit_info['turk_verify_code']})
                 else:
-                    task = self.ctask_controller.get_task_by_id(chit.tasks[taskindex])
-                    modules = self.ctype_controller.get_by_names(task.modules)
+                    lean = self.get_argument('lean', '') in ('1', 'true')
+                    payload = self.task_payload(chit, taskindex, lean=lean)
                     self.currentstatus_controller.create_or_update(workerid=workerid,
                                                                    hitid=hitid,
                                                                    taskindex = taskindex)
-                    self.return_json({"task" : task.serialize(),
-                                      "modules" : {name : module.to_dict() for name, module in modules.items()},
-                                      "task_num" : taskindex,
-                                      "num_tasks" : len(chit.tasks)})
+                    self.return_json(payload)
             else:
                 completed_hits = self.cresponse_controller.get_hits_for_worker(workerid)
                 outstanding_hits = self.currentstatus_controller.outstanding_hits()
-                sh = self.db.workerpings.find().sort([('lastping',1)])
-                stale_hits = [s for s in sh if self.chit_controller.get_chit_by_id(s['hitid'])]
-                nexthit = self.chit_controller.get_next_chit_id(exclusions=completed_hits, workerid=workerid, outstanding_hits=outstanding_hits, stale_hits=stale_hits)
+                nexthit = self.chit_controller.get_next_chit_id(exclusions=completed_hits, workerid=workerid, outstanding_hits=outstanding_hits)
                 if nexthit == None :
                     self.logging.info('no next hit')
                     #self.clear_cookie('workerid')
@@ -467,19 +774,73 @@ class CHITViewHandler(BaseHandler):
                     self.currentstatus_controller.create_or_update(workerid=workerid,
                                                                    hitid=nexthit,
                                                                    taskindex=0)
+                    self.dashboard_controller.hit_taken(workerid, nexthit)
                     self.return_json({'reload_for_first_task':True})
 
 class WorkerPingHandler(BaseHandler) :
+    admission_endpoint = 'ping'
     def post(self) :
         workerid = tornado.escape.to_unicode(self.get_secure_cookie('workerid'))
         existing_status = self.currentstatus_controller.get_current_status(workerid)
         if existing_status :
-            self.db.workerpings.update({'hitid' : existing_status['hitid']},
-                                       {'hitid' : existing_status['hitid'],
-                                        'lastping' : datetime.datetime.utcnow()},
-                                       True)
+            self.workerping_controller.ping(existing_status['hitid'])
         self.finish()
 
+class WorkerSocketHandler(tornado.websocket.WebSocketHandler, BaseHandler):
+    """The connection of a worker's browser while they work on their cHIT. While it
+       is open the server pings the cHIT (see Application.ensure_worker_heartbeat)
+       instead of the browser, and when it closes the cHIT becomes stale after
+       heartbeat_seconds, so abandoned cHITs are handed out again within seconds.
+       Responses can be submitted as {"type" : "submit", "id" : n, "data" : modules,
+       "prefetch" : 1} and are answered with {"id" : n, "response" : reply}, where
+       reply is what /HIT/submit returns. Browsers without the socket use the HTTP
+       handlers."""
+    worker_id = None
+    def open(self):
+        self.worker_id = tornado.escape.to_unicode(self.get_secure_cookie('workerid'))
+        if not self.worker_id :
+            self.close(4001, 'not_logged_in')
+            return
+        self.application.worker_sockets.add(self)
+        existing_status = self.currentstatus_controller.get_current_status(self.worker_id)
+        if existing_status :
+            self.workerping_controller.ping(existing_status['hitid'])
+    async def on_message(self, message):
+        try:
+            message = json.loads(message)
+        except ValueError:
+            return self.close(4000, 'bad_message')
+        if not isinstance(message, dict):
+            return self.close(4000, 'bad_message')
+        if message.get('type') == 'submit' :
+            limiter = self.application.admission['submit']
+            try :
+                await limiter.acquire()
+            except helpers.Overloaded as e :
+                reply = overloaded_json(e.retry_after)
+            else :
+                try :
+                    reply = await self.submit_response(self.worker_id, message.get('data', {}),
+                                                       prefetch=message.get('prefetch') in (1, True, '1', 'true'),
+                                                       requestid=message.get('requestid', None))
+                finally :
+                    limiter.release()
+            if not isinstance(reply, bytes) :
+                reply = json_machine.dumps(reply)
+            try:
+                self.write_message(json_machine.compose([("id", json_machine.dumps(message.get('id'))),
+                                                         ("response", reply)]).decode('utf8'))
+            except tornado.websocket.WebSocketClosedError:
+                pass
+    def on_close(self):
+        self.application.worker_sockets.discard(self)
+        if not self.worker_id or any(s.worker_id == self.worker_id for s in self.application.worker_sockets) :
+            # a reloaded page has connected again already
+            return
+        existing_status = self.currentstatus_controller.get_current_status(self.worker_id)
+        if existing_status :
+            self.workerping_controller.expire(existing_status['hitid'], app_config.workers['heartbeat_seconds'])
+
 # https://workersandbox.mturk.com/mturk/continue?hitId=2CQU98JHSTLB3ZGMPO0IRBJEK6HQEE
 class CHITReturnHandler(BaseHandler):
     def get(self):
@@ -487,119 +848,134 @@ class CHITReturnHandler(BaseHandler):
         mthitid = self.mturkconnection_controller.get_hit_id()
         if workerid :
             self.currentstatus_controller.remove(workerid)
+            self.dashboard_controller.hit_released(workerid)
         redir_subdomain = 'www' if self.settings['environment'] == 'production' else 'workersandbox'
         redir_url = 'https://%s.mturk.com/mturk/myhits' % redir_subdomain
         self.clear_cookie('workerid')
         self.redirect(redir_url)
 
-class Set():
-    def __init__(self,db,name):
-        self.db=db
-        self.name=name
-
-    def hasMember(self,value):
-        rows = self.db.sets.find({"$and":[{'name' : self.name},{'member' : str(value)}]})
-        member=None
-        for m in rows:
-            member=m
-        if member==None:
-            return False
-        else:
-            return True
+@tornado.web.stream_request_body
+class ImageUploadHandler(BaseHandler):
+    """Receives the raw bytes of an image for an imageupload question. The body is
+       streamed to a temporary file and hashed as it arrives, so memory use per
+       request stays bounded. Returns a blob id which the submission refers to as
+       blob:<id>."""
+    admission_endpoint = 'upload'
+    async def prepare(self):
+        self.temp = None
+        self.error = None
+        await super().prepare()
+        if self.admitted is None :
+            # shed, the body is not read
+            return
+        max_bytes = app_config.image_upload['max_bytes']
+        self.worker_id = tornado.escape.to_unicode(self.get_secure_cookie('workerid'))
+        if not self.currentstatus_controller.get_current_status(self.worker_id) :
+            self.set_status(403)
+            return self.return_json({'error' : True, 'explanation' : 'not_logged_in'})
+        if not self.request.headers.get('Content-Type', '').startswith('image/') :
+            self.set_status(415)
+            return self.return_json({'error' : True, 'explanation' : 'not_an_image'})
+        if int(self.request.headers.get('Content-Length', 0)) > max_bytes :
+            self.set_status(413)
+            return self.return_json({'error' : True, 'explanation' : 'too_large'})
+        # chunked uploads without a Content-Length are cut off by the connection itself
+        self.request.connection.set_max_body_size(max_bytes)
+        self.received = 0
+        self.digest = hashlib.sha256()
+        self.temp = open(os.path.join(Settings.TMP_PATH, uuid.uuid4().hex + '.image'), 'wb')
+
+    def data_received(self, chunk):
+        if self.temp is None or self.error :
+            return
+        self.received += len(chunk)
+        if self.received > app_config.image_upload['max_bytes'] :
+            self.error = 'too_large'
+            return
+        self.digest.update(chunk)
+        self.temp.write(chunk)
+
+    async def post(self):
+        self.temp.close()
+        if self.error or self.received == 0 :
+            self.set_status(413 if self.error else 400)
+            return self.return_json({'error' : True, 'explanation' : self.error or 'empty'})
+        try :
+            imagehash = await self.image_processor.process_file(self.temp.name)
+        except helpers.ImageError as e :
+            self.logging.info("Rejected image upload from %s: %s" % (self.worker_id, e))
+            return self.return_json({'error' : True, 'explanation' : 'invalid_image'})
+        content_type = self.request.headers['Content-Type']
+        ref = self.cimage_controller.create_from_file(self.temp.name, self.digest.hexdigest(),
+                                                      content_type, workerid=self.worker_id,
+                                                      imagehash=imagehash)
+        blobid = self.cimage_controller.create_upload(self.worker_id, ref, imagehash, content_type)
+        self.return_json({'blob' : blobid})
+
+    def on_finish(self):
+        super().on_finish()
+        if self.temp is not None :
+            self.temp.close()
+            if os.path.exists(self.temp.name) :
+                os.remove(self.temp.name)
 
 class CResponseHandler(BaseHandler):
-    def post(self):
+    admission_endpoint = 'submit'
+    async def post(self):
         worker_id = tornado.escape.to_unicode(self.get_secure_cookie('workerid'))
-        existing_status = self.currentstatus_controller.get_current_status(worker_id)
-        if not existing_status:
-            if not worker_id :
-                return self.return_json({'error' : True,
-                                         'explanation' : 'no_cookies'})
-            else :
-                return self.return_json({'error' : True,
-                                         'explanation' : 'not_logged_in'})
-        else:
-            response = json.loads(self.get_argument('data', '{}'))
-
-            hitid = existing_status['hitid']
-            chit = self.chit_controller.get_chit_by_id(hitid)
-            #print(chit.serialize())
-            taskindex = existing_status['taskindex']
-            taskid = chit.tasks[taskindex]
-            #task = self.ctask_controller.get_task_by_id(taskid)
-
-            valid = self.cresponse_controller.validate(taskid, response,
-                                                       self.ctask_controller,
-                                                       self.ctype_controller)
-            if not valid :
-                return self.return_json({'error' : True,
-                                         'explanation' : 'invalid_response'})
-
-            # sanitize the response
-            response = self.cresponse_controller.sanitize_response(taskid, response,
-                                                                   self.ctask_controller,
-                                                                   self.ctype_controller)
-
-
-            self.logging.info("%s submitted response for task_index %d on HIT %s" % (worker_id, taskindex, hitid))
-            self.cresponse_controller.create({'submitted' : datetime.datetime.utcnow(),
-                                              'response' : response,
-                                              'workerid' : worker_id,
-                                              'hitid' : chit.hitid,
-                                              'taskid' : taskid})
-            #check if there is a taskcondition set
-            skip=1
-            while taskindex+skip<len(chit.taskconditions):
-                oldSkip=skip
-                if chit.taskconditions[taskindex+skip]!=None:
-                    #let's check the condition
-                    condition=jsonpickle.decode(chit.taskconditions[taskindex+skip])
-                    allVariables=dict()
-                    has_error=False
-                    for v in condition.varlist:
-                        if v=="$workerid":
-                            allVariables["$workerid"]=worker_id
-                        else:
-                            frags=v.split('*')
-                            if len(frags)!=3:
-                                has_error=True
-                            else:
-                                docs = self.db.cresponses.find({"$and":[{'workerid' : worker_id},{'hitid' : chit.hitid},{'taskid':frags[0]}]}).sort('submitted')
-                                lastDoc=None
-                                for d in docs:
-                                    lastDoc=d
-                                if lastDoc!=None:
-                                    response=lastDoc["response"]
-                                    for module in response:
-                                        if module["name"]==frags[1]:
-                                            for q in module["responses"]:
-                                                if q["varname"]==frags[2] and ("response" in q):
-                                                    allVariables[v]=q["response"]
-
-                    allSets=dict()
-                    for s in condition.setlist:
-                        allSets[s]=Set(self.db,s)
-                    if has_error:
-                        skip+=1
-                    else:
-                        status=Status()
-                        if not condition.check_conditions(allVariables, allSets, status):
-                            skip+=1
-                if skip==oldSkip:
-                   break;
-            self.currentstatus_controller.create_or_update(workerid=worker_id,
-                                                           hitid=hitid,
-                                                           taskindex=taskindex+skip)
-            self.finish()
+        self.return_json(await self.submit_response(worker_id, json.loads(self.get_argument('data', '{}')),
+                                                    prefetch=self.get_argument('prefetch', '') in ('1', 'true'),
+                                                    requestid=self.get_argument('requestid', None)))
 
-class CSVDownloadHandler(BaseHandler):
+class ResponseExportHandler(BaseHandler):
+    """Incremental export for analysis pipelines that poll during a run. Returns
+       the responses submitted since the watermark in the resume token 'after' (all
+       without it) in the order of submission, and the token to pass next time.
+       Admins are authenticated by their login, pipelines by the export token of
+       the configuration in the header Authorization: Bearer <token>."""
+    max_limit = 10000
+    def authorized(self):
+        admin_email = tornado.escape.to_unicode(self.get_secure_cookie('admin_email'))
+        if admin_email and self.admin_controller.get_by_email(admin_email):
+            return True
+        token = app_config.export['token']
+        authorization = self.request.headers.get('Authorization', '')
+        return bool(token) and hmac.compare_digest(authorization.encode('utf8'), ('Bearer ' + token).encode('utf8'))
     def get(self):
+        if not self.authorized():
+            self.set_status(403)
+            return self.return_json({'error' : 'not_authorized'})
+        try:
+            limit = max(1, min(int(self.get_argument('limit', 1000)), self.max_limit))
+            responses, token = self.cresponse_controller.responses_since(self.get_argument('after', None), limit)
+        except ValueError as x:
+            self.set_status(400)
+            return self.return_json({'error' : str(x)})
+        self.return_json({'responses' : [{'hitid' : d['hitid'],
+                                          'taskid' : d['taskid'],
+                                          'workerid' : d['workerid'],
+                                          'submitted' : d['submitted'].isoformat() + 'Z',
+                                          'response' : d['response']}
+                                         for d in responses],
+                          'after' : token,
+                          'more' : len(responses) >= limit})
+
+class CSVDownloadHandler(BaseHandler):
+    # the Parquet archive is sent in chunks of this many bytes
+    chunk_size = 1024 * 1024
+    async def get(self):
         """
         takes all completed hits and puts together two tab-separated files:
         - task_submission_times.tsv: contains timestamps at which tasks were submitted
         - question_responses.tsv: contains the responses to all questions
+        with ?format=parquet the responses are exported as Parquet instead:
+        - question_responses.parquet: a row per question response, with the submission time
+        - question_responses_wide.parquet: with &wide=1, a row per task and a column per question
         """
         completed_workers = self.chit_controller.get_workers_with_completed_hits()
+        if self.get_argument('format', None) == 'parquet':
+            await self.get_parquet(completed_workers)
+            return
 
         task_submission_times_output = io.StringIO()
         task_submission_times_csvwriter = csv.writer(task_submission_times_output, delimiter='\t')
@@ -619,3 +995,31 @@ class CSVDownloadHandler(BaseHandler):
         self.set_header("Content-Disposition", "attachment; filename={}".format(zip_name))
 
         self.finish(f.getvalue())
+
+    async def get_parquet(self, completed_workers):
+        if export_machine.pyarrow is None:
+            self.set_status(501)
+            self.return_json({'error' : "The Parquet export needs pyarrow, pip install pyarrow"})
+            return
+        wide = self.get_argument('wide', None) == '1'
+        def export(f):
+            with ZipFile(f, "w") as zf:
+                # Parquet files are compressed already
+                with zf.open('question_responses.parquet', 'w') as sink:
+                    self.cresponse_controller.write_question_responses_to_parquet(sink, completed_workers)
+                if wide:
+                    with zf.open('question_responses_wide.parquet', 'w') as sink:
+                        self.cresponse_controller.write_wide_question_responses_to_parquet(sink, completed_workers)
+        # the archive is written to disk and sent in chunks, so that it is never held in memory
+        with tempfile.TemporaryFile(dir=Settings.TMP_PATH) as f:
+            await tornado.ioloop.IOLoop.current().run_in_executor(None, export, f)
+            f.seek(0)
+            self.set_header('Content-Type', 'application/zip')
+            self.set_header("Content-Disposition", "attachment; filename=data_parquet.zip")
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.write(chunk)
+                await self.flush()
+        self.finish()
@@ -1,4 +1,8 @@
-from .bonus_helper import BonusType, calculate_worker_bonus_info
+from .bonus_helper import BonusType, calculate_worker_bonus_info, calculate_raw_bonus_info, reduce_raw_bonus_info, normalize_bonus_info
 from .lexer_machine import CustomEncoder, Lexer, Status
 from .country_machine import CountryTools
-from .jaccard_machine import Jaccard
\ No newline at end of file
+from .jaccard_machine import Jaccard
+from .image_machine import ImageError, ImageProcessor
+from .cache_machine import GenerationCache, ResultCache
+from .metrics_machine import Metrics
+from .admission_machine import AdmissionLimiter, Overloaded
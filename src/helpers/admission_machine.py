@@ -0,0 +1,71 @@
+import collections
+import datetime
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.util
+
+
+class Overloaded(Exception):
+    """Raised for requests that are shed; the client should retry after retry_after
+       seconds."""
+    def __init__(self, retry_after):
+        Exception.__init__(self, "overloaded, retry after %s seconds" % retry_after)
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter(object):
+    """Admits at most concurrency requests of an endpoint at a time, up to queue more
+       wait for a slot in the order they arrived. Requests that find the queue full or
+       would be served more than deadline seconds after they arrived are shed at once,
+       before they do any work, so that an overloaded server answers the requests it
+       can serve in time instead of all of them too late. Used on the IOLoop only.
+       Records the wait of the admitted requests and the number shed in metrics."""
+    def __init__(self, name, metrics, concurrency=8, queue=64, deadline=2.0, retry_after=2.0):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.deadline = deadline
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiters = collections.deque()
+        self.wait_histogram = metrics.histogram('admission_%s_wait_seconds' % name)
+        self.shed_counter = metrics.counter('admission_%s_shed' % name)
+
+    async def acquire(self, waited=0.0):
+        ''' Inputs: waited, the seconds the request spent queued before it reached the
+                    limiter (in the IOLoop or the network)
+            Output: None once the request may run; it must call release() when done.
+                    Raises Overloaded if the request is shed. '''
+        if waited > self.deadline:
+            self.shed()
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            self.wait_histogram.observe(waited)
+            return
+        if len(self.waiters) >= self.queue:
+            self.shed()
+        future = tornado.concurrent.Future()
+        self.waiters.append(future)
+        start = time.monotonic()
+        try:
+            await tornado.gen.with_timeout(datetime.timedelta(seconds=self.deadline - waited), future)
+        except tornado.util.TimeoutError:
+            if future.done():
+                # the slot was handed over just as the deadline passed
+                self.release()
+            else:
+                self.waiters.remove(future)
+            self.shed()
+        self.wait_histogram.observe(waited + time.monotonic() - start)
+
+    def release(self):
+        if self.waiters:
+            # the slot passes straight to the next waiting request
+            self.waiters.popleft().set_result(None)
+        else:
+            self.active -= 1
+
+    def shed(self):
+        self.shed_counter.inc()
+        raise Overloaded(self.retry_after)
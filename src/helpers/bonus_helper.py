@@ -76,8 +76,20 @@ def calculate_raw_bonus_info(possible_bonus_points, bonusDetails, moduleVarnameV
                 for workerid in questionDetails["possibleWorkers"]:
                     if workerid not in questionDetails["actualWorkers"]:
                         bonus_exp = 'On task %s, question %s_%s was not shown.' % (task, module, varname)
+                        # the worker may not have answered a bonus question of these tasks
+                        worker_bonus_info.setdefault(workerid, {'earned' : 0.0, 'possible' : 1.0*possible_bonus_points,'exp' : []})
                         worker_bonus_info[workerid]['exp'].append(bonus_exp)
-    print(worker_bonus_info)
+    return worker_bonus_info
+
+def reduce_raw_bonus_info(raw_bonus_infos) :
+    """Sums the raw bonus info of calculate_raw_bonus_info() computed for disjoint sets
+       of tasks into the raw bonus info of all of them."""
+    worker_bonus_info = {}
+    for raw_bonus in raw_bonus_infos:
+        for workerid, info in raw_bonus.items():
+            total = worker_bonus_info.setdefault(workerid, {'earned' : 0.0, 'possible' : info['possible'], 'exp' : []})
+            total['earned'] += info['earned']
+            total['exp'].extend(info['exp'])
     return worker_bonus_info
 
 def normalize_bonus_info(worker_bonus_info) :
@@ -108,6 +120,4 @@ def normalize_bonus_info(worker_bonus_info) :
                               'best' : max_bonus_percent}
                             for a in worker_bonus_percent}
 
-    print(worker_bonus_percent)
-
     return worker_bonus_percent
@@ -0,0 +1,80 @@
+import time
+from collections import OrderedDict
+
+import tornado.concurrent
+
+
+class GenerationCache:
+    """A bounded LRU cache for payloads derived from the survey definition (modules,
+       documents, ...). Those never change while a survey is loaded, so the cache is
+       only emptied when the survey generation changes."""
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.generation = None
+        self.entries = OrderedDict()
+
+    def get(self, generation, key, compute):
+        ''' Inputs: generation, the current survey generation
+                    key, any hashable
+                    compute, function that returns the value if it is not cached
+            Output: the cached value '''
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        value = compute()
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.generation = None
+
+
+class ResultCache:
+    """Remembers the results of recent requests by key for ttl seconds (at most
+       max_entries), so that a retried request is answered with the result of the
+       first one instead of being carried out again. A retry that arrives while the
+       first request is still being served waits for its result. Used on the IOLoop
+       only."""
+    def __init__(self, ttl=300.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    async def get(self, key, compute, keep=None):
+        ''' Inputs: key, any hashable
+                    compute, coroutine function that returns the result
+                    keep, function that tells whether a result may be reused (all are
+                          by default)
+            Output: the result, raises what compute raised '''
+        now = time.monotonic()
+        self.expire(now)
+        if key in self.entries:
+            return await self.entries[key][1]
+        future = tornado.concurrent.Future()
+        self.entries[key] = (now + self.ttl, future)
+        try:
+            result = await compute()
+        except BaseException as e:
+            self.entries.pop(key, None)
+            future.set_exception(e)
+            # the waiting retries get it, nobody else needs to
+            future.exception()
+            raise
+        if keep is not None and not keep(result):
+            self.entries.pop(key, None)
+        future.set_result(result)
+        return result
+
+    def expire(self, now):
+        # entries are added in the order they expire
+        while self.entries:
+            key, (expires, future) = next(iter(self.entries.items()))
+            if expires > now and len(self.entries) < self.max_entries:
+                break
+            del self.entries[key]
@@ -0,0 +1,73 @@
+import json
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# rows per record batch, bounds the memory an export holds at a time
+BATCH_SIZE = 50000
+
+# the identifiers repeat on every row and are dictionary encoded
+KEY_COLUMNS = ('hitid', 'taskid', 'workerid')
+
+
+def response_text(value):
+    ''' Inputs: value, a question response as stored
+        Output: the response as text, JSON encoded unless it is a string or None '''
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _dictionary():
+    return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+
+
+def long_schema():
+    ''' Output: the schema of the long table, one row per question response '''
+    return pyarrow.schema([(c, _dictionary()) for c in KEY_COLUMNS] +
+                          [('submitted', pyarrow.timestamp('ms')),
+                           ('module', _dictionary()),
+                           ('varname', _dictionary()),
+                           ('response', pyarrow.string())])
+
+
+def wide_schema(questions):
+    ''' Inputs: questions, type list of (module, varname)
+        Output: the schema of the wide table, one row per task response with a
+                column module.varname per question '''
+    return pyarrow.schema([(c, _dictionary()) for c in KEY_COLUMNS] +
+                          [('submitted', pyarrow.timestamp('ms'))] +
+                          [(module + '.' + varname, pyarrow.string()) for module, varname in questions])
+
+
+def _batch(columns, schema):
+    return pyarrow.RecordBatch.from_arrays([pyarrow.array(c, type=f.type) for c, f in zip(columns, schema)],
+                                           schema=schema)
+
+
+def record_batches(rows, schema, batch_size=BATCH_SIZE):
+    ''' Inputs: rows, iterable of tuples with a value for every field of schema
+                schema, type pyarrow.Schema
+        Output: generator of pyarrow.RecordBatch with at most batch_size rows '''
+    columns = [[] for f in schema]
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(value)
+        if len(columns[0]) == batch_size:
+            yield _batch(columns, schema)
+            columns = [[] for f in schema]
+    if columns[0]:
+        yield _batch(columns, schema)
+
+
+def write_parquet(sink, rows, schema):
+    ''' Inputs: sink, a path or binary file object
+                rows, iterable of tuples with a value for every field of schema
+                schema, type pyarrow.Schema
+        Output: the rows written to sink as a zstd compressed Parquet file '''
+    with pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for batch in record_batches(rows, schema):
+            writer.write_batch(batch)
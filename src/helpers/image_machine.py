@@ -0,0 +1,132 @@
+import asyncio
+import base64
+import binascii
+import io
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import imagehash
+from PIL import Image
+
+
+class ImageError(Exception):
+    pass
+
+
+def split_data_url(data_url):
+    ''' Inputs: data_url, type string of the form data:image/png;base64,....
+        Output: (content_type, base64 payload) '''
+    try:
+        header, payload = data_url.split('base64,', 1)
+    except (AttributeError, ValueError):
+        raise ImageError("response is not a base64 data URL")
+    content_type = header[len('data:'):].rstrip(';') if header.startswith('data:') else ''
+    return (content_type or 'application/octet-stream', payload)
+
+
+def hash_image(data, max_pixels):
+    ''' Inputs: data, type bytes
+                max_pixels, type int
+        Output: the average hash of the image as a hex string '''
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Exception:
+        raise ImageError("could not read image")
+    # the size is read from the header, so this check happens before decoding the pixels
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageError("image has %d pixels, the limit is %d" % (width * height, max_pixels))
+    return str(imagehash.average_hash(image))
+
+
+def process_data_url(data_url, max_bytes, max_pixels):
+    ''' Runs inside a worker process: decodes a base64 data URL and hashes the image.
+        Output: {'content_type' : str, 'data' : bytes, 'hash' : str} '''
+    content_type, payload = split_data_url(data_url)
+    try:
+        data = base64.b64decode(payload)
+    except (binascii.Error, ValueError):
+        raise ImageError("could not decode image")
+    if len(data) > max_bytes:
+        raise ImageError("image has %d bytes, the limit is %d" % (len(data), max_bytes))
+    return {'content_type' : content_type,
+            'data' : data,
+            'hash' : hash_image(data, max_pixels)}
+
+
+def process_file(path, max_pixels):
+    ''' Runs inside a worker process: hashes an image that was streamed to disk.
+        Output: the average hash of the image as a hex string '''
+    with open(path, 'rb') as f:
+        return hash_image(f.read(), max_pixels)
+
+
+def report_pid(pids):
+    pids.put(os.getpid())
+
+
+class ImageProcessor:
+    """Decodes and hashes uploaded images in a process pool so that large
+       uploads do not block the IOLoop. A worker process that is still busy
+       with an image when the timeout expires is killed with its pool, so
+       that slow images cannot hold the pool and time out every later upload."""
+    def __init__(self, workers=2, max_bytes=16*1024*1024, max_pixels=40000000, timeout=10.0):
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.timeout = timeout
+        self.pool = self._start()
+
+    async def process_data_url(self, data_url):
+        content_type, payload = split_data_url(data_url)
+        # reject oversized images before shipping them to a worker process
+        if len(payload) * 3 // 4 > self.max_bytes + 2:
+            raise ImageError("image is larger than %d bytes" % self.max_bytes)
+        return await self.run(process_data_url, data_url, self.max_bytes, self.max_pixels)
+
+    async def process_file(self, path):
+        return await self.run(process_file, path, self.max_pixels)
+
+    async def run(self, fn, *args):
+        """Returns fn(*args) computed in the pool. Raises ImageError if it takes
+           longer than the timeout or its worker process dies."""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.timeout
+        while True:
+            pool = self.pool
+            future = loop.run_in_executor(pool[0], fn, *args)
+            try:
+                return await asyncio.wait_for(future, max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                self._recycle(pool)
+                raise ImageError("processing the image took longer than %s seconds" % self.timeout)
+            except BrokenProcessPool:
+                if pool is self.pool:
+                    # a worker process died on this image
+                    self._recycle(pool)
+                    raise ImageError("could not process image")
+                # the pool was replaced because of another image; run again on the new one
+
+    def _start(self):
+        # the worker processes report their pids, so that they can be killed
+        pids = multiprocessing.SimpleQueue()
+        executor = ProcessPoolExecutor(max_workers=self.workers, initializer=report_pid, initargs=(pids,))
+        return (executor, pids)
+
+    def _recycle(self, pool):
+        """Replaces pool by a new one and kills its worker processes, as shutdown()
+           would wait for the running calls."""
+        if pool is not self.pool:
+            return
+        self.pool = self._start()
+        executor, pids = pool
+        while not pids.empty():
+            try:
+                os.kill(pids.get(), signal.SIGTERM)
+            except OSError:
+                # the process has already exited
+                pass
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,39 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(data, pretty=False):
+    ''' Inputs: data, JSON serializable object
+                pretty, type bool, indents and sorts the keys
+        Output: data as utf8 encoded JSON, serialized with orjson when it is installed '''
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(data, option=option)
+        except TypeError:
+            # e.g. integers beyond 64 bit, which the json module can serialize
+            pass
+    if pretty:
+        return json.dumps(data, indent=4, sort_keys=True).encode('utf8')
+    return json.dumps(data, separators=(',', ':')).encode('utf8')
+
+
+# serialized keys of composed objects; the handlers use a handful of fixed keys
+_keys = {}
+
+
+def compose(parts):
+    ''' Inputs: parts, type list of (key, bytes) where the values are serialized JSON
+        Output: the JSON object with these members, without serializing the values again '''
+    members = []
+    for key, value in parts:
+        if key not in _keys:
+            _keys[key] = dumps(key) + b':'
+        members.append(_keys[key] + value)
+    return b'{' + b','.join(members) + b'}'
@@ -1,5 +1,6 @@
 # -*- coding: future_fstrings -*-
 # Import packages
+import re
 from json import JSONEncoder
 
 class CustomEncoder(JSONEncoder):
@@ -20,83 +21,62 @@ class Status:
         self.error_offset = 0
 
 
+# the operators that a single condition is built around, see tokenize()
+COMPARISONS = {"==" : "EQUAL", "!=" : "NOTEQUAL", ">=" : "GREATEREQUAL", "<=" : "LESSEQUAL"}
+FUNCTIONS = {"notinset{" : "NOTINSET", "inset{" : "INSET", "exists{" : "EXISTS"}
+
+
 class SingleCondition:
-    def __init__(self, condition_string, status):
-        ''' Inputs: condition_string, type string
+    def __init__(self, tokens, status):
+        ''' Inputs: tokens, type (kind, offset, text) list, the tokens of the condition
+                            as produced by tokenize()
                     status, type Status instance'''
         self.variables = []  # type [str]
         self.values_integers = []  # type [int]
         self.values_string = [] # type [str] 
-        if '==' in condition_string:
-            self.op = "EQUAL"
-            frags = condition_string.split('==')
-            self.condition_fragments(frags, condition_string, status)
-            return
-        if '!=' in condition_string:
-            self.op = "NOTEQUAL"
-            frags = condition_string.split("!=")
-            self.condition_fragments(frags, condition_string, status)
-            return
-        if '>=' in condition_string:
-            self.op = "GREATEREQUAL"
-            frags = condition_string.split(">=")
-            self.condition_fragments(frags, condition_string, status)
-            return
-        if '<=' in condition_string:
-            self.op = "LESSEQUAL"
-            frags = condition_string.split("<=")
-            self.condition_fragments(frags, condition_string, status)
-            return
-        if 'notinset{' in condition_string:
-            if condition_string.startswith("notinset{") and condition_string[-1]=="}":
-                self.op = "NOTINSET"
-                fields=condition_string[len("notinset{"):-1].split(",")
-                if len(fields)==2:
-                    self.variables.append(fields[0].strip())
-                    self.variables.append(fields[1].strip())
-                else:
-                    status.error=f"{condition_string} needs to have two arguments"
-                return
-            else:
-                status.error=f"{condition_string} is not a valid notinset condition"
-                return
+        condition_string = "".join(token[2] for token in tokens).strip()
+        operators = [i for i, token in enumerate(tokens) if token[0] != "TEXT"]
+        if len(operators) == 0:
+            status.error = f"{condition_string} is an invalid condition"
             return
-        if 'inset{' in condition_string:
-            if condition_string.startswith("inset{") and condition_string[-1]=="}":
-                self.op = "INSET"
-                fields=condition_string[len("inset{"):-1].split(",")
-                if len(fields)==2:
-                    self.variables.append(fields[0].strip())
-                    self.variables.append(fields[1].strip())
-                else:
-                    status.error=f"{condition_string} needs to have two arguments"
-                return
-            else:
-                status.error=f"{condition_string} is not a valid inset condition"
+        first = operators[0]
+        kind = tokens[first][0]
+        lhs = "".join(token[2] for token in tokens[:first])
+        rhs = "".join(token[2] for token in tokens[first+1:])
+        if kind in COMPARISONS:
+            # a second comparison operator may only occur inside a string value
+            if any(tokens[i][0] in COMPARISONS for i in operators[1:]) and not rhs.strip().startswith('"'):
+                status.error = f"{condition_string} is an invalid condition"
                 return
+            self.op = COMPARISONS[kind]
+            self.condition_fragments(lhs, rhs, condition_string, status)
             return
-        if 'exists{' in condition_string:
-            if condition_string.startswith("exists{") and condition_string[-1]=="}":
-                self.op = "EXISTS"
-                field=condition_string[len("exists{"):-1]
-                self.variables.append(field);
-                return
-            else:
-                status.error=f"{condition_string} is not a valid exists condition"
-                return
+        name = kind[:-1]
+        rhs = rhs.rstrip()
+        if lhs.strip() != "" or len(operators) > 1 or not rhs.endswith("}"):
+            status.error = f"{condition_string} is not a valid {name} condition"
             return
-        status.error = f"{condition_string} is an invalid condition"
+        self.op = FUNCTIONS[kind]
+        fields = rhs[:-1].split(",")
+        if self.op == "EXISTS":
+            self.variables.append(rhs[:-1])
+        elif len(fields) == 2:
+            self.variables.append(fields[0].strip())
+            self.variables.append(fields[1].strip())
+        else:
+            status.error = f"{condition_string} needs to have two arguments"
 
-    def condition_fragments(self, frags, condition_string, status):
-        ''' Inputs: frags, type string list
+    def condition_fragments(self, lhs, rhs, condition_string, status):
+        ''' Inputs: lhs, type string, the text before the comparison operator
+                    rhs, type string, the text after it
                     condition_string, type string
                     status, type Status instance'''
-        if len(frags) != 2:
+        self.variables=lhs.strip().split("+")
+        # check if second argument is a number, string or other variable
+        argument = rhs.strip()
+        if argument == "":
             status.error = f"{condition_string} is an invalid condition"
             return
-        self.variables=frags[0].strip().split("+")
-        # check if second argument is a number, string or other variable
-        argument = frags[1].strip()
         if argument[0] == '"':
             if (argument[-1] != '"') or (len(argument) < 2):
                 status.error = f"{argument} in {condition_string} is an invalid string"
@@ -247,6 +227,29 @@ class SingleCondition:
         else:
             return (self.variables[0] in all_variables)
 
+# brackets and logical operators, which end a condition, and the operators of a
+# single condition; notinset{ is listed before inset{ so that it matches first
+SPECIAL_TOKENS = re.compile(r'[()&|]|' + '|'.join(re.escape(op) for op in list(COMPARISONS) + list(FUNCTIONS)))
+
+
+def tokenize(condition_str):
+    ''' Inputs: condition_str, type string
+        Output: list of (kind, offset, text) tokens in a single pass over the string.
+                kind is "TEXT" for the text between special tokens, the special
+                token itself or "END" '''
+    tokens = []
+    position = 0
+    for match in SPECIAL_TOKENS.finditer(condition_str):
+        if match.start() > position:
+            tokens.append(("TEXT", position, condition_str[position:match.start()]))
+        tokens.append((match.group(), match.start(), match.group()))
+        position = match.end()
+    if position < len(condition_str):
+        tokens.append(("TEXT", position, condition_str[position:]))
+    tokens.append(("END", len(condition_str), ""))
+    return tokens
+
+
 class Lexer:
     def __init__(self):
         ''' Inputs: conditions, type SingleCondition list
@@ -262,7 +265,7 @@ class Lexer:
         return "conditions: " + str(self.conditions) + " fragments: " + str([str(f) for f in self.fragments]) + " logical: " + str(self.logical)
 
     def can_import(self, condition_str, status):
-        if self.can_import_worker(0,condition_str,status):
+        if self.parse_tokens(tokenize(condition_str), 0, 0, status) >= 0:
             self.get_variables(status)
             if status.error!=None:
                 return False
@@ -270,88 +273,76 @@ class Lexer:
         else:
             return False
 
-    def can_import_worker(self, depth, condition_str, status):
-        ''' Inputs: depth, type int
-                    condition_str, type string
+    def parse_tokens(self, tokens, position, depth, status):
+        ''' Recursive descent parser over the output of tokenize(). The tokens between
+            brackets and logical operators make up the single conditions.
+            Inputs: tokens, type (kind, offset, text) list
+                    position, type int, index of the first token of this fragment
+                    depth, type int
                     status, type Status instance
-                    offset, type int, *reference*
-                    error, type string, *out*
-                    error_offset, type int, *out*
-             Output: bool'''
-        text = ""
+            Output: int, index of the token after this fragment or -1 on error '''
+        condition = []
         while True:
-            # check if we reached the end
-            if status.offset == len(condition_str):
-                if not(self.check_condition(text, status)):
-                    return False
-                # next check if there are any conditions
-                if len(self.conditions) + len(self.fragments) == 0:
-                    status.error_offset = status.offset
-                    error = f"condition ending in position {status.offset} is empty"
-                    return False
-                if depth > 0:
-                    status.error_offset = status.offset
-                    status.error = f"condition ending in position {status.offset} has opening bracket but no closing bracket"
-                    return False
-                return True
-            if condition_str[status.offset] == '(':
-                status.offset += 1
+            kind, offset, value = tokens[position]
+            status.offset = offset
+            if kind == "TEXT" or kind in COMPARISONS or kind in FUNCTIONS:
+                condition.append(tokens[position])
+                position += 1
+                continue
+            if kind == "(":
                 frag = Lexer()
                 self.fragments.append(frag)
-                if not(frag.can_import_worker(depth+1, condition_str, status)):
-                    return False
+                position = frag.parse_tokens(tokens, position+1, depth+1, status)
+                if position < 0:
+                    return -1
                 continue
-            if condition_str[status.offset] == ')':
-                if depth == 0:
-                    status.error_offset = status.offset
-                    status.error = f"bracket closes at position {status.offset} but no corresponding open bracket"
-                    return False
-                if not(self.check_condition(text, status)):
-                    return False
-                # next check if there are any conditions
-                if len(self.conditions) + len(self.fragments) == 0:
-                    status.error_offset = status.offset
-                    status.error = f"condition ending in position {status.offset} is empty"
-                    return False
-                status.offset += 1
-                return True
-            if (condition_str[status.offset] == '&') or (condition_str[status.offset] == '|'):
-                op = "AND"
-                otherop = "OR"
-                if condition_str[status.offset] == '|':
-                    op = "OR"
-                    otherop = "AND"
-                if not(self.check_condition(text, status)):
-                    return False
-                text = ""
-                # next check if there are any conditions
+            if kind == "&" or kind == "|":
+                op = "AND" if kind == "&" else "OR"
+                otherop = "OR" if kind == "&" else "AND"
+                if not(self.check_condition(condition, status)):
+                    return -1
+                condition = []
                 if len(self.conditions) + len(self.fragments) == 0:
-                    status.error_offset = status.offset
-                    error = f"{op} symbol at position {status.offset} is not preceded by any conditions"
-                    return False
+                    status.error_offset = offset
+                    status.error = f"{op} symbol at position {offset} is not preceded by any conditions"
+                    return -1
                 if self.logical == otherop:
-                    status.error_offset = status.offset
-                    status.error = f"{op} symbol at position {status.offset} is preceded by {otherop} condition"
-                    return False
+                    status.error_offset = offset
+                    status.error = f"{op} symbol at position {offset} is preceded by {otherop} condition"
+                    return -1
                 self.logical = op
-                status.offset += 1
+                position += 1
                 continue
-            text += condition_str[status.offset]
-            status.offset += 1
-
+            if kind == ")" and depth == 0:
+                status.error_offset = offset
+                status.error = f"bracket closes at position {offset} but no corresponding open bracket"
+                return -1
+            # a closing bracket or the end of the string finishes this fragment
+            if not(self.check_condition(condition, status)):
+                return -1
+            if len(self.conditions) + len(self.fragments) == 0:
+                status.error_offset = offset
+                status.error = f"condition ending in position {offset} is empty"
+                return -1
+            if kind == ")":
+                status.offset = offset + 1
+                return position + 1
+            if depth > 0:
+                status.error_offset = offset
+                status.error = f"condition ending in position {offset} has opening bracket but no closing bracket"
+                return -1
+            return position
 
-    def check_condition(self, text, status):
-        ''' Inputs: text, type string,
-                    offset, type int
+    def check_condition(self, tokens, status):
+        ''' Inputs: tokens, type (kind, offset, text) list
                     error, type string, *out*
                     error_offset, type int, *out*
             Output: bool'''
         status.error = None
         status.error_offset = -1
         # check if we can add a condition
-        text = text.strip()
-        if text != "":
-            cond = SingleCondition(text, status)
+        if "".join(token[2] for token in tokens).strip() != "":
+            cond = SingleCondition(tokens, status)
             if status.error is not None:
                 return False
             self.conditions.append(cond)
@@ -376,22 +367,30 @@ class Lexer:
     def get_variables(self,status):
         self.varlist=[]
         self.setlist=[]
+        # the sets mirror the lists to keep the membership tests constant time
+        seen_variables=set()
+        seen_sets=set()
         for cond in self.conditions:
             if cond.op=="NOTINSET" or cond.op=="INSET":
                 self.varlist.append(cond.variables[0])
                 self.setlist.append(cond.variables[1])
+                seen_variables.add(cond.variables[0])
+                seen_sets.add(cond.variables[1])
             else:
                 for v in cond.variables:
-                    if v not in self.varlist:
+                    if v not in seen_variables:
                         self.varlist.append(v)
+                        seen_variables.add(v)
         for frag in self.fragments:
             frag.get_variables(status)
             for v in frag.varlist:
-                if v not in self.varlist:
+                if v not in seen_variables:
                     self.varlist.append(v)
+                    seen_variables.add(v)
             for s in frag.setlist:
-                if s not in self.setlist:
+                if s not in seen_sets:
                     self.setlist.append(s)
+                    seen_sets.add(s)
 
 
     def check_conditions(self, variables, sets, status):
@@ -0,0 +1,108 @@
+import bisect
+import contextlib
+import threading
+import time
+
+# upper bounds of the buckets of latency histograms, in seconds
+LATENCY_BOUNDS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    """Counts the observed values in buckets, so that percentiles can be reported
+       without keeping the values. Observations may come from several threads."""
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = value if self.max is None else max(self.max, value)
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q):
+        ''' Inputs: q, between 0 and 1
+            Output: the upper bound of the bucket holding the q-quantile, the largest
+                    value observed for the last bucket, None without observations '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {'count' : self.count,
+                'mean' : self.sum / self.count if self.count else None,
+                'p50' : self.quantile(0.5),
+                'p90' : self.quantile(0.9),
+                'p99' : self.quantile(0.99),
+                'max' : self.max,
+                'buckets' : [[bound, n] for bound, n in zip(self.bounds + ('inf',), self.counts) if n]}
+
+
+class Metrics(object):
+    """The counters, gauges and histograms of a server process by name, created on
+       first use. /admin/metrics shows their snapshot."""
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, name, kind, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(name, kind(*args))
+        return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name):
+        return self._get(name, Gauge)
+
+    def histogram(self, name, bounds=LATENCY_BOUNDS):
+        return self._get(name, Histogram, bounds)
+
+    def snapshot(self):
+        return {name : metric.snapshot() for name, metric in sorted(self.metrics.items())}
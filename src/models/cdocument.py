@@ -0,0 +1,39 @@
+import gzip
+import hashlib
+
+import bson
+
+class CDocument(object):
+    """A document that tasks refer to. Documents are stored once per content hash,
+       gzip compressed, and tasks only keep the hash."""
+    __slots__ = ('hash', 'names', '_body', '_compressed')
+    def __init__(self, hash=None, names=[], body=None, compressed=None):
+        self.hash = hash
+        self.names = names
+        self._body = body
+        self._compressed = compressed
+    @staticmethod
+    def hash_content(content):
+        return hashlib.sha256(content.encode('utf8')).hexdigest()
+    @classmethod
+    def from_content(cls, name, content):
+        return cls(cls.hash_content(content), [name], body=content.encode('utf8'))
+    @classmethod
+    def deserialize(cls, d):
+        return cls(d['_id'], d['names'], compressed=bytes(d['content']))
+    def serialize(self):
+        return {'_id' : self.hash,
+                'names' : self.names,
+                'size' : len(self.body),
+                'content' : bson.Binary(self.compressed)}
+    @property
+    def body(self):
+        """The utf8 encoded document"""
+        if self._body is None:
+            self._body = gzip.decompress(self._compressed)
+        return self._body
+    @property
+    def compressed(self):
+        if self._compressed is None:
+            self._compressed = gzip.compress(self._body)
+        return self._compressed
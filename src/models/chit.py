@@ -1,5 +1,9 @@
 
 class CHIT(object):
+    __slots__ = ('hitid', 'exclusions', 'tasks', 'taskconditions', 'completed_hits', 'num_completed_hits')
+    # the fields the worker's view and the response handler read; completed_hits
+    # grows with every worker who completes the cHIT and is left out
+    view_fields = ('hitid', 'tasks', 'taskconditions')
     def __init__(self, hitid=None, exclusions=[], tasks=[], taskconditions=[], completed_hits=[], num_completed_hits=None, **kwargs):
         self.hitid = hitid
         self.tasks = tasks
@@ -8,8 +12,15 @@ class CHIT(object):
         self.exclusions = exclusions
         self.num_completed_hits = num_completed_hits
     @classmethod
-    def deserialize(cls, d):
-        return cls(**d);
+    def deserialize(cls, d, fields=None):
+        """If the document was read with a projection, fields lists the fields it
+           contains. The other fields are left unset and raise AttributeError."""
+        if fields is None:
+            return cls(**d)
+        chit = cls.__new__(cls)
+        for field in fields:
+            setattr(chit, field, d.get(field))
+        return chit
     def serialize(self):
         return {'hitid' : self.hitid,
                 'tasks' : self.tasks,
@@ -1,6 +1,8 @@
 
 class CResponse(object) :
-    def __init__(self, submitted=None, response=None, taskid=None, hitid=None, workerid=None):
+    __slots__ = ('submitted', 'response', 'taskid', 'hitid', 'workerid', 'images', 'requestid')
+    def __init__(self, submitted=None, response=None, taskid=None, hitid=None, workerid=None, images=None,
+                 requestid=None):
         self.submitted = submitted # date
         # response: [module_responses]
         # module_response: {name:'name', responses:[question_responses]}
@@ -9,16 +11,28 @@ class CResponse(object) :
         self.taskid = taskid
         self.hitid = hitid
         self.workerid = workerid
+        # the references of the images stored for the response's imageupload questions
+        self.images = images or []
+        # identifies the submission of the worker's browser, so that retries are stored once
+        self.requestid = requestid
     @classmethod
     def deserialize(cls, d) :
         return CResponse(submitted=d['submitted'],
                          response=d['response'],
                          taskid=d['taskid'],
                          hitid=d['hitid'],
-                         workerid=d['workerid'])
+                         workerid=d['workerid'],
+                         images=d.get('images', None),
+                         requestid=d.get('requestid', None))
     def serialize(self) :
-        return {'submitted' : self.submitted,
-                'response' : self.response,
-                'taskid' : self.taskid,
-                'hitid' : self.hitid,
-                'workerid' : self.workerid}
+        d = {'submitted' : self.submitted,
+             'response' : self.response,
+             'taskid' : self.taskid,
+             'hitid' : self.hitid,
+             'workerid' : self.workerid}
+        if self.images :
+            d['images'] = self.images
+        if self.requestid is not None :
+            # left out otherwise, as the sparse unique index only skips missing fields
+            d['requestid'] = self.requestid
+        return d
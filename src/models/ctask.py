@@ -1,16 +1,20 @@
 
 class CTask(object):
-    def __init__(self, taskid=None, content=None, modules=[]):
+    __slots__ = ('taskid', 'content', 'modules', 'document')
+    # tasks that show a document keep its hash in document and no content
+    def __init__(self, taskid=None, content=None, modules=[], document=None):
         self.taskid = taskid
         self.content = content
         self.modules = modules
+        self.document = document
     @classmethod
     def deserialize(cls, d):
-        return cls(d['taskid'], d['content'], d['modules'])
+        return cls(d['taskid'], d['content'], d['modules'], d.get('document'))
     def serialize(self):
         return {'taskid' : self.taskid,
                 'content' : self.content,
-                'modules' : self.modules}
+                'modules' : self.modules,
+                'document' : self.document}
 
 
 
@@ -1,14 +1,20 @@
 from .question import Question
 
 class CType(object) :
+    """A module. Questions read from the database stay dicts until they are used,
+       so callers that need only a few questions do not deserialize the rest."""
+    __slots__ = ('name', 'header', 'contentUpdate', '_questions', '_question_index', '_questions_by_varname')
     def __init__(self, name=None, header=None, contentUpdate=None, questions=[]) :
         self.name = name
         self.header = header
         self.contentUpdate=contentUpdate
-        self.questions = questions
+        # Question objects or their serialized dicts
+        self._questions = list(questions)
+        self._question_index = None
+        self._questions_by_varname = None
     @classmethod
     def from_dict(cls, d) :
-        return CType(d['name'], d['header'], d['contentUpdate'],[Question.deserialize(q) for q in d['questions']])
+        return CType(d['name'], d['header'], d['contentUpdate'], d['questions'])
     def to_dict(self) :
         return {'name' : self.name,
                 'header' : self.header,
@@ -20,8 +26,31 @@ class CType(object) :
             worker_conditions[workerid] = {q.varname : q.satisfies_condition(responses) for q in self.questions}
         return worker_conditions
 
+    def _question(self, i) :
+        q = self._questions[i]
+        if isinstance(q, dict) :
+            q = self._questions[i] = Question.deserialize(q)
+        return q
+
+    @property
+    def questions(self) :
+        return [self._question(i) for i in range(len(self._questions))]
+
+    def get_question(self, varname) :
+        """Deserializes only the question varname, raises KeyError if there is none."""
+        if self._question_index is None :
+            self._question_index = {q['varname'] if isinstance(q, dict) else q.varname : i
+                                    for i, q in enumerate(self._questions)}
+        return self._question(self._question_index[varname])
+
+    @property
+    def questions_by_varname(self) :
+        if self._questions_by_varname is None :
+            self._questions_by_varname = {q.varname : q for q in self.questions}
+        return self._questions_by_varname
+
     def sanitize_response(self, response) :
-        questions = {q.varname : q for q in self.questions}
+        questions = self.questions_by_varname
 
         sanitize_response = response
         module_responses = sanitize_response['responses']
@@ -35,16 +64,20 @@ class CType(object) :
         return sanitize_response
                 
     def validate(self, response) :
-        """Validates a response for this module as given by JSON from the client."""
-        questions = {q.varname : q for q in self.questions}
-        valids = set()
+        """Validates a response for this module as given by JSON from the client.
+           The display condition of each question is evaluated only once."""
+        questions = self.questions_by_varname
+        shown = {}
         module_responses = response['responses']
         for r in module_responses :
-            if r.get('varname', None) not in questions :
+            varname = r.get('varname', None)
+            if varname not in questions :
                 return False
-            if not questions[r['varname']].validate(r, module_responses) :
+            if varname not in shown :
+                shown[varname] = questions[varname].satisfies_condition(module_responses)
+            if not questions[varname].validate(r, module_responses, shown=shown[varname]) :
                 return False
-            valids.add(r['varname'])
+        valids = set(shown.keys())
         if valids != set(questions.keys()) :
             return False
         return True
@@ -188,6 +188,12 @@ class MTurkConnection:
         result = await loop.run_in_executor(None, begin_run_sync, self, max_assignments, url) 
         return result
 
+    @staticmethod
+    def bonus_amount(percent, bonus):
+        """The bonus in dollars paid for percent of the bonus points, where bonus is
+           the bonus for all of them, between 0.01 and 10 dollars."""
+        return min(10, max(0.01, round(percent * bonus, 2)))
+
     async def end_run_async(self,bonus={}, already_paid=[]):
         def end_run_sync(self, bonus={}, already_paid=[]):
             if not self.hit_id and not self.running:
@@ -216,7 +222,7 @@ class MTurkConnection:
                         print("Error in end_run: worker_id %s present on mturk but not in bonus dict." % workerid)
                     else :
                         try:
-                            bonus_amt = min(10, max(0.01, round(bonus[workerid] * self.bonus, 2)))
+                            bonus_amt = self.bonus_amount(bonus[workerid], self.bonus)
                             self.client.send_bonus(WorkerId=workerid,
                                                BonusAmount=str(bonus_amt),
                                                AssignmentId=assignmentid,
@@ -2,13 +2,12 @@ import re
 import validators
 from helpers import CustomEncoder, Lexer, Status
 import jsonpickle
-from PIL import Image
 import imagehash
-import base64
-import io
 from helpers import jaccard_machine
+from helpers.image_machine import ImageError, split_data_url
 
 class Question(object) :
+    __slots__ = ('varname', 'questiontext', 'helptext', 'options', 'bonus', 'bonuspoints', 'condition', 'valuetype', '_lexer')
     def __init__(self, varname=None, condition=None, questiontext=None, helptext=None, options=None, valuetype=None, bonus=None, bonuspoints=None):
         def validate_bonus(bonus) :
             if bonus == None or bonus == 'linear':
@@ -46,6 +45,7 @@ class Question(object) :
         self.bonuspoints = validate_bonuspoints(bonuspoints)
         self.condition = condition
         self.valuetype = valuetype
+        self._lexer = None
     @classmethod
     def deserialize(cls, d) :
         if d['valuetype']=="categorical":
@@ -87,10 +87,16 @@ class Question(object) :
         bonus_dict['bonuspoints'] = self.bonuspoints
         return bonus_dict
 
+    def get_lexer(self):
+        # decoding the condition is expensive, so it is done at most once per question
+        if self._lexer is None and self.condition is not None:
+            self._lexer = jsonpickle.decode(self.condition)
+        return self._lexer
+
     def satisfies_condition(self, module_responses,varnameValuetype=None):
         if (self.condition==None):
             return True
-        lex=jsonpickle.decode(self.condition)
+        lex=self.get_lexer()
         if varnameValuetype!=None:
             #check whether this variable was reachable
             for v in lex.varlist:
@@ -113,15 +119,19 @@ class Question(object) :
         return response
     def valid_response(self, response):
         return True
-    def validate(self, response, module_responses) :
+    def validate(self, response, module_responses, shown=None) :
         """Takes a question response as transmitted via JSON and validates it 
            given its own response and that to the rest of the question list.
            The method calls satisfies_condition(), which checks whether the
            display condition for the question is met and valid_response(), which
            checks that the response to the question itself is valid. The latter
-           method can be overridden in classes that inherit from Question."""
+           method can be overridden in classes that inherit from Question.
+           If the caller has already evaluated the display condition it can
+           pass the result as shown."""
 
-        if not self.satisfies_condition(module_responses):
+        if shown is None:
+            shown = self.satisfies_condition(module_responses)
+        if not shown:
             return True
         else:
             return self.valid_response(response)
@@ -151,6 +161,7 @@ class Question(object) :
 # Allows question-specific deserialization (not currently used).
 # Otherwise unnecessary.
 class AbstractQuestion(Question):
+    __slots__ = ('content',)
     def __init__(self, content=[], **kwargs) :
         Question.__init__(self, **kwargs)
         self.content = content
@@ -159,6 +170,7 @@ class AbstractQuestion(Question):
         return cls(**d)
 
 class CategoricalQuestion(AbstractQuestion):
+    __slots__ = ()
     typeName = 'categorical'
     @staticmethod
     def parse_content_from_xml(question_content):
@@ -170,6 +182,7 @@ class CategoricalQuestion(AbstractQuestion):
         return response.get('response', False)
 
 class NumericQuestion(AbstractQuestion):
+    __slots__ = ()
     typeName = 'numeric'
     @staticmethod
     def parse_content_from_xml(question_content=None):
@@ -182,6 +195,7 @@ class NumericQuestion(AbstractQuestion):
             return False
     
 class TextQuestion(AbstractQuestion) :
+    __slots__ = ()
     typeName = 'text'
     @staticmethod
     def parse_content_from_xml(question_content=None):
@@ -193,6 +207,7 @@ class TextQuestion(AbstractQuestion) :
         return response.get('response', False)
 
 class AutoCompleteQuestion(AbstractQuestion) :
+    __slots__ = ()
     typeName = 'autocomplete'
     @staticmethod
     def parse_content_from_xml(question_content=None):
@@ -202,6 +217,7 @@ class AutoCompleteQuestion(AbstractQuestion) :
 
 
 class ApproximateTextQuestion(AbstractQuestion) :
+    __slots__ = ()
     typeName = 'approximatetext'
     @staticmethod
     def parse_content_from_xml(question_content=None):
@@ -217,6 +233,7 @@ class ApproximateTextQuestion(AbstractQuestion) :
         return  jaccard.getTokens(response[len("approximatetext:"):])
 
 class URLQuestion(TextQuestion) :
+    __slots__ = ()
     typeName = 'url'
     @staticmethod
     def stem_url(url):
@@ -240,28 +257,24 @@ class URLQuestion(TextQuestion) :
         return validators.url(response.get('response', False), public = True)
 
 class CommentQuestion(TextQuestion) :
+    __slots__ = ()
     typeName = 'comment'
-    def validate(self, response, module_responses):
+    def validate(self, response, module_responses, shown=None):
         return True
 
 class ImageUploadQuestion(TextQuestion) :
+    __slots__ = ()
     typeName = 'imageupload'
     def sanitize_response(self, response):
-        resp=response['response']
-        try:
-            image=resp[resp.index('base64,')+7:]
-            decoded = io.BytesIO(base64.b64decode(image))
-            response['response']="imagehash:"+str(imagehash.average_hash(Image.open(decoded)))
-            response['response_raw']=resp
-        except:            
-            print('Could not decode image %s' % response['varname'])
+        # decoding and hashing happens in a worker process, see CResponseController.process_uploads
         return response
-    def validate(self, response, module_responses):
-        resp=response['response']
+    def validate(self, response, module_responses, shown=None):
+        # either a reference to an image uploaded through /HIT/upload or a data URL
+        if response['response'].startswith("blob:"):
+            return len(response['response']) > len("blob:")
         try:
-            image=resp[resp.index('base64,')+7:]
-            decoded = io.BytesIO(base64.b64decode(image))
-        except:            
+            split_data_url(response['response'])
+        except ImageError:
             return False
         return True
     def getBonusValue(self,response):
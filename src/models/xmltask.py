@@ -3,11 +3,132 @@ try:
 except ImportError:
     import xml.etree.ElementTree as ET
 
+from .cdocument import CDocument
 from .question import Question
 from helpers import CustomEncoder, Lexer, Status
+import copy
+import json
 import jsonpickle
+import jsonpickle.pickler
+import re
 from itertools import product
 
+# characters that would change how an expanded condition is split into fragments
+CONDITION_SPECIAL = re.compile(r'[\s()&|=!<>+,"{}]')
+CONDITION_KEYWORDS = ('==', '!=', '>=', '<=', 'notinset{', 'inset{', 'exists{')
+
+def placeholder_pattern(dimensions):
+    ''' Inputs: dimensions, type list of lists of {placeholder: value}
+        Output: compiled regex matching any placeholder of the iterator, or None '''
+    keys = set()
+    for dimension in dimensions:
+        for instance in dimension:
+            keys.update(instance)
+    if not keys:
+        return None
+    # longest first, so that a placeholder is never matched by one of its prefixes
+    return re.compile("(" + "|".join(re.escape(k) for k in sorted(keys, key=len, reverse=True)) + ")")
+
+class IteratorTemplate(object):
+    """A string containing iterator placeholders such as {dimension:key}. The string is
+       split into literal text and placeholders once, so that each combination of the
+       iterator is produced by a single join."""
+    def __init__(self, text, placeholders):
+        if text is None or placeholders is None:
+            self.parts = [text]
+        else:
+            self.parts = placeholders.split(text)
+    def keys(self):
+        return self.parts[1::2]
+    def substitute(self, binding):
+        if len(self.parts) == 1:
+            return self.parts[0]
+        out = list(self.parts)
+        for i in range(1, len(out), 2):
+            out[i] = binding.get(out[i], out[i])
+        return "".join(out)
+
+class IteratorCondition(object):
+    """The condition of an iterator question, parsed once per question. The parsed
+       Lexer is flattened once into the structure that jsonpickle encodes. When the
+       placeholders only occur in variable and set names, each instance substitutes
+       the names in a copy of that structure. Conditions where a value could change
+       how the expanded string parses are parsed per instance."""
+    def __init__(self, text, placeholders):
+        self.source = IteratorTemplate(text, placeholders)
+        self.keys = set(self.source.keys())
+        self.flattened = None
+        self.encoded = None
+        self.parsed = {}
+        self.safe = {}
+        lex = Lexer()
+        status = Status()
+        if not lex.can_import(text, status):
+            if not self.keys:
+                raise Exception(status.error)
+            # the instances report their own errors
+            return
+        if not self.keys:
+            self.encoded = jsonpickle.encode(lex)
+            return
+        names, values = [], []
+        def collect(l):
+            for cond in l.conditions:
+                names.extend(cond.variables)
+                values.extend(cond.values_string)
+            for frag in l.fragments:
+                collect(frag)
+        collect(lex)
+        # every placeholder has to be part of a name
+        if len(self.source.keys()) != sum(len(placeholders.findall(n)) for n in names) \
+           or any(placeholders.search(v) for v in values):
+            return
+        self.flattened = jsonpickle.pickler.Pickler().flatten(lex)
+        self.counts = [text.count(k) for k in CONDITION_KEYWORDS]
+        self.names = {n : IteratorTemplate(n, placeholders) for n in set(names) if placeholders.search(n)}
+        self.fixed = set(names) - set(self.names)
+    def instantiate(self, binding):
+        ''' Inputs: binding, type {placeholder: value}
+            Output: jsonpickle encoded Lexer for the condition with the values bound '''
+        if self.encoded is not None:
+            return self.encoded
+        text = self.source.substitute(binding)
+        if self.flattened is not None and self.is_safe(binding, text):
+            names = {n : t.substitute(binding) for n, t in self.names.items()}
+            return json.dumps(self.substitute(self.flattened, names))
+        if text not in self.parsed:
+            lex = Lexer()
+            status = Status()
+            if not lex.can_import(text, status):
+                raise Exception(status.error)
+            self.parsed[text] = jsonpickle.encode(lex)
+        return self.parsed[text]
+    def substitute(self, node, names):
+        ''' Output: a copy of the flattened Lexer node with the names replaced '''
+        if isinstance(node, dict):
+            return {k : self.substitute(v, names) for k, v in node.items()}
+        if isinstance(node, list):
+            return [self.substitute(v, names) for v in node]
+        if isinstance(node, str):
+            return names.get(node, node)
+        return node
+    def is_safe(self, binding, text):
+        ''' Output: whether parsing the expanded condition gives the parsed template with
+                    the values substituted into the names '''
+        for key in self.keys:
+            if key in binding:
+                value = binding[key]
+                if value not in self.safe:
+                    self.safe[value] = value != "" and not CONDITION_SPECIAL.search(value)
+                if not self.safe[value]:
+                    return False
+        # a value may complete an operator with the text around it
+        if [text.count(k) for k in CONDITION_KEYWORDS] != self.counts:
+            return False
+        # distinct names have to stay distinct, otherwise the variable lists change
+        substituted = set(t.substitute(binding) for t in self.names.values())
+        return len(substituted) == len(self.names) and substituted.isdisjoint(self.fixed)
+
 class XMLTask(object) :
     def __init__(self, xml_path=None) :
         self.reader = ET.parse(xml_path)
@@ -20,9 +141,9 @@ class XMLTask(object) :
         self.docs = self.get_documents()
         self.sets = self.root.find('sets')
     def get_modules(self):
-        def get_help_text(ent) :
-            ment = ent.find('helptext')
-            return ment.text if ment != None else None
+        # appended surveys may leave out the sections they do not extend
+        if self.modules == None:
+            return
         encounteredModuleNames=set()    
         for module in self.modules.iter('module'):
             if module.find('name').text in encounteredModuleNames:
@@ -34,70 +155,68 @@ class XMLTask(object) :
                           'questions' : []}
             encounteredVarNames=set()                  
             for question in module.find('questions').iter('question'):
-                #check if there is an iterator
-                dimensions=[[{}]]
-                iterator=question.find('iterator')
-                if iterator !=None:
-                    dimensions=[]
-                    for dimension in iterator.find('dimensions').iter('dimension'):
-                        singleDimension=[]
-                        dimName=dimension.find('name').text
-                        for instance in dimension.find('instances').iter('instance'):
-                            singleInstance={}
-                            for kvpair in instance.find('kvpairs').iter('kvpair'):
-                                key=kvpair.find('key').text
-                                value=kvpair.find('value').text
-                                singleInstance["{"+dimName+":"+key+"}"]=value
-                            singleDimension.append(singleInstance)
-                        dimensions.append(singleDimension)                            
-                #now iterate over the product of all dimensions
-                for D in product(*dimensions):
-                    varname=question.find('varname').text
-                    for instance in D:
-                        for key in instance:
-                            varname=varname.replace(key,instance[key])
+                for question_out in self.expand_question(question):
                     #now do the question
-                    if varname in encounteredVarNames:
-                        raise Exception("Variable "+varname+" in module "+module.find('name').text+" is defined more than once.")
-                    encounteredVarNames.add(varname)
-                    lexedCondition=None                        
-                    if question.find('condition') != None:
-                        conditionStr=question.find('condition').text
-                        for instance in D:
-                            for key in instance:
-                                conditionStr=conditionStr.replace(key,instance[key])
-                        lex = Lexer()
-                        status = Status()
-                        if not lex.can_import(conditionStr, status):
-                            raise Exception(status.error)
-                        lexedCondition=jsonpickle.encode(lex)
-                    questionText=question.find('questiontext').text
-                    for instance in D:
-                        for key in instance:
-                            questionText=questionText.replace(key,instance[key])
-                    helpText=get_help_text(question)
-                    if helpText!=None:
-                        for instance in D:
-                            for key in instance:
-                                helpText=helpText.replace(key,instance[key])
-                    options=self.get_options(question)
-                    if options!=None:
-                        for i in options:
-                            for instance in D:
-                                for key in instance:
-                                    if type(options[i]) is not list:
-                                        options[i]=options[i].replace(key,instance[key])
-                    module_out['questions'].append({'varname' : varname,
-                                                'condition' : lexedCondition,
-                                                'questiontext' : questionText,
-                                                'helptext' : helpText,
-                                                'bonus' : question.find('bonus').text if question.find('bonus') != None else None,
-                                                'bonuspoints' : float(question.find('bonuspoints').text) if question.find('bonuspoints') != None else 1.0,
-                                                'valuetype' : question.find('valuetype').text,
-                                                'options' : options,
-                                                'content' : Question.parse_content_from_xml(question.find('valuetype').text,
-                                                                                            question.find('content'))})
+                    if question_out['varname'] in encounteredVarNames:
+                        raise Exception("Variable "+question_out['varname']+" in module "+module.find('name').text+" is defined more than once.")
+                    encounteredVarNames.add(question_out['varname'])
+                    module_out['questions'].append(question_out)
             yield module_out
+    def get_dimensions(self, question):
+        ''' Output: one list per iterator dimension with a {placeholder: value} dict per
+                    instance. Questions without an iterator have a single empty instance. '''
+        iterator=question.find('iterator')
+        if iterator==None:
+            return [[{}]]
+        dimensions=[]
+        for dimension in iterator.find('dimensions').iter('dimension'):
+            singleDimension=[]
+            dimName=dimension.find('name').text
+            for instance in dimension.find('instances').iter('instance'):
+                singleInstance={}
+                for kvpair in instance.find('kvpairs').iter('kvpair'):
+                    key=kvpair.find('key').text
+                    value=kvpair.find('value').text
+                    singleInstance["{"+dimName+":"+key+"}"]=value
+                singleDimension.append(singleInstance)
+            dimensions.append(singleDimension)
+        return dimensions
+    def expand_question(self, question):
+        ''' Yields the question once for every combination of its iterator's instances.
+            The templates are compiled and the condition is parsed once per question. '''
+        dimensions=self.get_dimensions(question)
+        placeholders=placeholder_pattern(dimensions)
+        helptext=question.find('helptext')
+        varname=IteratorTemplate(question.find('varname').text, placeholders)
+        questionText=IteratorTemplate(question.find('questiontext').text, placeholders)
+        helpText=IteratorTemplate(helptext.text if helptext != None else None, placeholders)
+        condition=None
+        if question.find('condition') != None:
+            condition=IteratorCondition(question.find('condition').text, placeholders)
+        options=self.get_options(question)
+        optionTemplates={i : IteratorTemplate(options[i], placeholders) for i in options if type(options[i]) is not list}
+        bonus=question.find('bonus').text if question.find('bonus') != None else None
+        bonuspoints=float(question.find('bonuspoints').text) if question.find('bonuspoints') != None else 1.0
+        valuetype=question.find('valuetype').text
+        content=Question.parse_content_from_xml(valuetype, question.find('content'))
+        for D in product(*dimensions):
+            # a placeholder is replaced by the first dimension that defines it
+            binding={}
+            for instance in reversed(D):
+                binding.update(instance)
+            # the instances must not share the options and content, which are mutable
+            instanceOptions=copy.deepcopy(options)
+            for i in optionTemplates:
+                instanceOptions[i]=optionTemplates[i].substitute(binding)
+            yield {'varname' : varname.substitute(binding),
+                   'condition' : condition.instantiate(binding) if condition != None else None,
+                   'questiontext' : questionText.substitute(binding),
+                   'helptext' : helpText.substitute(binding),
+                   'bonus' : bonus,
+                   'bonuspoints' : bonuspoints,
+                   'valuetype' : valuetype,
+                   'options' : instanceOptions,
+                   'content' : copy.deepcopy(content)}
     def get_options(self, qelt) :
         opts = {}
         optelt = qelt.find('options')
@@ -109,17 +228,22 @@ class XMLTask(object) :
                 opts[child.tag] = child.text
         return opts
     def get_tasks(self):
+        if self.tasks == None:
+            return
+        hashes = {name : CDocument.hash_content(doc) for name, doc in self.docs.items()}
         for task in self.tasks.iter('task'):
-            # first see if there is a corresponding document
+            # first see if there is a corresponding document, which is referenced by its hash
             content = task.find('content').text.strip()
-            content = self.docs.get(content, content)
-            yield {'content' : content,
+            yield {'content' : None if content in hashes else content,
+                   'document' : hashes.get(content),
                    'taskid' : task.find('taskid').text,
                    'modules' : task.find('modules').text.split()}
     def get_hits(self):
         def get_exclusions(hittag):
             exctag = hittag.find('exclusions')
             return exctag.text.split() if exctag != None else []
+        if self.hits == None:
+            return
         for hit in self.hits.iter('hit'):
             tasks=hit.find('tasks').text.split()
             taskConditionList=[None] * len(tasks)
@@ -161,5 +285,5 @@ class XMLTask(object) :
         docs = {}
         if self.documents :
             for doc in self.documents.iter('document') :
-                docs[doc.find('name').text.strip()] = doc.find('content').text
+                docs[doc.find('name').text.strip()] = doc.find('content').text or ""
         return docs
@@ -0,0 +1,48 @@
+"""The storage engines of the survey database. The controllers reach every
+collection through the repository of its kind (storage.base), which offers the
+queries they make; MongoDB (storage.mongo) and SQLite (storage.sqlite)
+implement them."""
+import os
+
+import pymongo
+
+from .base import Database, DuplicateKeyError, StorageError
+from .mongo import MongoDatabase
+from .sqlite import SQLiteDatabase
+
+ENGINES = ('mongodb', 'sqlite')
+
+def sqlite_path(db_name, path):
+    return os.path.join(path, db_name + '.sqlite3')
+
+def open_database(db_name, engine="mongodb", uri=None, path=None, read_only=False):
+    """Opens the database db_name. MongoDB is reached through uri (the local server
+       by default), SQLite keeps the database in the file <db_name>.sqlite3 in the
+       directory path. With read_only no indexes are created on MongoDB, so that a
+       read-only user or a secondary can be used; read SQLite from a snapshot."""
+    if engine == "mongodb":
+        return MongoDatabase(pymongo.MongoClient(uri)[db_name], read_only=read_only)
+    if engine == "sqlite":
+        os.makedirs(path, exist_ok=True)
+        return SQLiteDatabase(sqlite_path(db_name, path))
+    raise StorageError("Unknown storage engine %s, expected one of %s" % (engine, ", ".join(ENGINES)))
+
+def drop_database(db_name, engine="mongodb", uri=None, path=None):
+    if engine == "mongodb":
+        pymongo.MongoClient(uri).drop_database(db_name)
+    elif engine == "sqlite":
+        SQLiteDatabase(sqlite_path(db_name, path)).drop()
+    else:
+        raise StorageError("Unknown storage engine %s, expected one of %s" % (engine, ", ".join(ENGINES)))
+
+def snapshot_database(db_name, path, target):
+    """Copies the SQLite database db_name in the directory path to the directory
+       target. The copy is consistent even while a server writes to the database."""
+    if not os.path.exists(sqlite_path(db_name, path)):
+        raise StorageError("There is no SQLite database %s" % sqlite_path(db_name, path))
+    os.makedirs(target, exist_ok=True)
+    database = SQLiteDatabase(sqlite_path(db_name, path))
+    try:
+        database.backup(sqlite_path(db_name, target))
+    finally:
+        database.close()
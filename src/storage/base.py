@@ -0,0 +1,398 @@
+import abc
+import contextlib
+
+from pymongo.errors import DuplicateKeyError
+
+
+class StorageError(Exception):
+    pass
+
+
+class Database(abc.ABC):
+    """A database of a storage engine. Every collection holds one kind of document
+       and is reached through the repository of its kind, which offers the queries
+       the controllers make: db.chits is the repository of the collection chits and
+       db.collection('chits', 'chits_<generation>') that of another collection of
+       the same kind. Repositories are created once per collection, together with
+       its indexes."""
+    # kind -> repository class, filled in by the engines
+    repositories = {}
+    # whether ResponseRepository.changes() works
+    change_streams = False
+    def __init__(self):
+        self._collections = {}
+    def collection(self, kind, name=None):
+        name = name or kind
+        repository = self._collections.get(name)
+        if repository is None:
+            repository = self._collections[name] = self.repositories[kind](self, name)
+        return repository
+    def __getattr__(self, kind):
+        if kind in self.repositories:
+            return self.collection(kind)
+        raise AttributeError(kind)
+    def drop_collection(self, name):
+        self._collections.pop(name, None)
+        self._drop(name)
+    @abc.abstractmethod
+    def _drop(self, name):
+        pass
+    @abc.abstractmethod
+    def collection_names(self):
+        pass
+    def batch(self):
+        """Groups the writes made in the block into one transaction on the engines
+           that have them."""
+        return contextlib.nullcontext()
+    def gridfs(self, collection):
+        raise StorageError("Storing images in GridFS needs the mongodb storage engine, use the filesystem storage")
+    def close(self):
+        pass
+
+
+class Repository(abc.ABC):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+    @abc.abstractmethod
+    def count(self):
+        pass
+
+
+class AdminRepository(Repository):
+    @abc.abstractmethod
+    def emails(self):
+        pass
+    @abc.abstractmethod
+    def get(self, email):
+        pass
+    @abc.abstractmethod
+    def insert(self, doc):
+        """Raises DuplicateKeyError if the email is taken."""
+    @abc.abstractmethod
+    def remove(self, email):
+        pass
+
+
+class TypeRepository(Repository):
+    """The modules of a survey, keyed by name."""
+    @abc.abstractmethod
+    def insert_many(self, docs):
+        pass
+    @abc.abstractmethod
+    def names(self):
+        pass
+    @abc.abstractmethod
+    def get(self, name):
+        pass
+    @abc.abstractmethod
+    def get_many(self, names):
+        pass
+    @abc.abstractmethod
+    def all(self):
+        pass
+
+
+class TaskRepository(Repository):
+    """The tasks of a survey, keyed by taskid. fields restricts the fields read."""
+    @abc.abstractmethod
+    def insert_many(self, docs):
+        pass
+    @abc.abstractmethod
+    def ids(self):
+        pass
+    @abc.abstractmethod
+    def get(self, taskid):
+        pass
+    @abc.abstractmethod
+    def get_many(self, taskids, fields=None):
+        pass
+    @abc.abstractmethod
+    def all(self, fields=None):
+        pass
+
+
+class HitRepository(Repository):
+    """The cHITs of a survey, keyed by hitid. completed_hits lists the
+       {worker_id, turk_verify_code} of every worker who completed the cHIT and
+       num_completed_hits counts them."""
+    @abc.abstractmethod
+    def insert_many(self, docs):
+        pass
+    @abc.abstractmethod
+    def ids(self):
+        pass
+    @abc.abstractmethod
+    def get(self, hitid, fields=None):
+        pass
+    @abc.abstractmethod
+    def get_many(self, hitids, fields=None):
+        pass
+    @abc.abstractmethod
+    def all(self, fields=None):
+        pass
+    @abc.abstractmethod
+    def has_available(self):
+        """Whether a cHIT was not completed yet."""
+    @abc.abstractmethod
+    def next_available(self, exclusions, outstanding):
+        """Returns the hitid of the first uncompleted cHIT that excludes none of
+           exclusions and is not in outstanding, or None."""
+    @abc.abstractmethod
+    def stats(self):
+        """Returns the number of cHITs, completions and tasks of all cHITs."""
+    @abc.abstractmethod
+    def add_completed(self, hitid, hit_info):
+        pass
+    @abc.abstractmethod
+    def completed_ids(self):
+        pass
+    @abc.abstractmethod
+    def completed_workers(self):
+        pass
+    @abc.abstractmethod
+    def has_completion(self, worker_ids, turk_verify_code):
+        """Whether a worker in worker_ids completed a cHIT with turk_verify_code."""
+
+
+class ResponseRepository(Repository):
+    """write_concern is a dict of the MongoDB write concern, e.g. {'w' : 'majority',
+       'j' : True}; the engines without one ignore it."""
+    @abc.abstractmethod
+    def insert(self, doc, write_concern=None):
+        pass
+    @abc.abstractmethod
+    def insert_many(self, docs, write_concern=None):
+        """Inserts the responses in one write. If it fails, the responses it did not
+           store are inserted one by one. Returns, in the order of docs, None for a
+           stored response and the exception for one that could not be stored."""
+    @abc.abstractmethod
+    def all(self):
+        pass
+    @abc.abstractmethod
+    def count_by_worker(self, workerid):
+        pass
+    @abc.abstractmethod
+    def hitids_by_worker(self, workerid):
+        """The hitid of every response of the worker."""
+    @abc.abstractmethod
+    def latest(self, workerid, hitid, taskid, fields=None):
+        """The last submitted response of the worker to a task of a cHIT, or its
+           given fields, None if there is none."""
+    @abc.abstractmethod
+    def get_by_requestid(self, requestid):
+        """The hitid and taskid of the response stored with requestid, None if there
+           is none. A second response with the same requestid is refused with
+           DuplicateKeyError."""
+    @abc.abstractmethod
+    def since(self, after, before, limit):
+        """Returns at most limit (key, response) pairs of the responses that follow
+           after, a (submitted, key) pair or None, and were submitted before before,
+           if it is not None, ordered by submitted and key. The key orders the
+           responses submitted at the same time."""
+    def changes(self, resume, limit=None):
+        """Returns ([(key, response)], position) for the responses stored after the
+           position resume in the change stream, from its current end if resume is
+           None, and the position that follows them. Raises StorageError if the
+           engine has no change streams or the stream no longer reaches back to
+           resume."""
+        raise StorageError("Change streams need a MongoDB replica set")
+    @abc.abstractmethod
+    def questions(self):
+        """Yields the (workerid, module, varname) of every question response,
+           without reading the answers."""
+    @abc.abstractmethod
+    def image_refs(self):
+        """The distinct references of the images the responses keep."""
+
+
+class DocumentRepository(Repository):
+    """Documents are keyed by content hash (_id) and keep the names they were
+       uploaded under."""
+    @abc.abstractmethod
+    def add_many(self, docs):
+        """Inserts the documents; the names of those that exist are added to them."""
+    @abc.abstractmethod
+    def get(self, hash):
+        pass
+    @abc.abstractmethod
+    def get_by_name(self, name):
+        pass
+    @abc.abstractmethod
+    def get_hashes(self, names):
+        """Returns a dict name -> hash for the names that exist."""
+
+
+class ChitLoadRepository(Repository):
+    """The record of which worker was handed which cHIT when."""
+    @abc.abstractmethod
+    def insert(self, doc):
+        pass
+    @abc.abstractmethod
+    def remove_older(self, cutoff):
+        """Removes the loads before cutoff. Returns the number removed."""
+
+
+class StatusRepository(Repository):
+    """The task each worker is on, keyed by workerid, and when they moved on to it."""
+    @abc.abstractmethod
+    def put(self, workerid, hitid, taskindex, updated):
+        pass
+    @abc.abstractmethod
+    def get(self, workerid):
+        pass
+    @abc.abstractmethod
+    def remove(self, workerid):
+        pass
+    @abc.abstractmethod
+    def hitids(self):
+        pass
+    @abc.abstractmethod
+    def hitids_by_worker(self):
+        """Returns a dict workerid -> hitid."""
+    @abc.abstractmethod
+    def hitids_of(self, workerids):
+        """The hitids of the workers in workerids."""
+    @abc.abstractmethod
+    def set_missing_updated(self, updated):
+        """Sets the update time of the statuses stored without one."""
+    @abc.abstractmethod
+    def remove_older(self, cutoff):
+        """Removes the statuses updated before cutoff. Returns the number removed."""
+
+
+class PingRepository(Repository):
+    """The last ping of the worker holding a cHIT, keyed by hitid."""
+    @abc.abstractmethod
+    def ping(self, hitid, time):
+        pass
+    @abc.abstractmethod
+    def ping_many(self, hitids, time):
+        pass
+    @abc.abstractmethod
+    def remove_older(self, cutoff, keep):
+        """Removes the pings before cutoff of the cHITs not in keep. Returns the
+           number removed."""
+    @abc.abstractmethod
+    def stale_hit(self, chits, cutoff, exclusions):
+        """Returns the hitid of the uncompleted cHIT in chits, a HitRepository of the
+           same database, that excludes none of exclusions and whose last ping is
+           the oldest before cutoff, or None."""
+
+
+class PaidBonusRepository(Repository):
+    @abc.abstractmethod
+    def insert(self, doc):
+        pass
+    @abc.abstractmethod
+    def all(self):
+        pass
+
+
+class BonusInfoRepository(Repository):
+    @abc.abstractmethod
+    def replace(self, docs):
+        pass
+    @abc.abstractmethod
+    def all(self):
+        pass
+
+
+class SetRepository(Repository):
+    @abc.abstractmethod
+    def insert_many(self, docs):
+        pass
+    @abc.abstractmethod
+    def names(self):
+        pass
+    @abc.abstractmethod
+    def has_member(self, name, member):
+        pass
+
+
+class EventRepository(Repository):
+    @abc.abstractmethod
+    def insert(self, doc):
+        pass
+    @abc.abstractmethod
+    def all(self):
+        """The events by date."""
+    @abc.abstractmethod
+    def last(self, limit):
+        """The last limit events by date."""
+    @abc.abstractmethod
+    def trim(self, keep):
+        """Removes all but the last keep events. Returns the number removed."""
+
+
+class SurveyRepository(Repository):
+    """Documents keyed by _id: the pointer to the current generation ('current')
+       and the metadata of each generation."""
+    @abc.abstractmethod
+    def get(self, key):
+        pass
+    @abc.abstractmethod
+    def create(self, doc):
+        """Raises DuplicateKeyError if the _id exists."""
+    @abc.abstractmethod
+    def put(self, doc):
+        pass
+    @abc.abstractmethod
+    def remove(self, key):
+        pass
+    @abc.abstractmethod
+    def swap_generation(self, old, new, time):
+        """Sets the generation of 'current' to new if it is old and appends old to
+           its retired generations. Returns whether it was swapped."""
+    @abc.abstractmethod
+    def remove_retired(self, generation):
+        pass
+
+
+class MTurkConnectionRepository(Repository):
+    """The settings of the run; there is a single connection."""
+    @abc.abstractmethod
+    def get(self):
+        pass
+    @abc.abstractmethod
+    def update(self, fields):
+        """Sets fields on the connection, which is created if there is none."""
+    @abc.abstractmethod
+    def all(self):
+        pass
+
+
+class UploadRepository(Repository):
+    """The images uploaded through /HIT/upload, keyed by blobid."""
+    @abc.abstractmethod
+    def insert(self, doc):
+        pass
+    @abc.abstractmethod
+    def get(self, blobid, workerid):
+        pass
+    @abc.abstractmethod
+    def refs(self):
+        pass
+    @abc.abstractmethod
+    def remove_older(self, cutoff):
+        """Removes the uploads created before cutoff."""
+
+
+# the repository interface of every kind of collection
+KINDS = {'admin' : AdminRepository,
+         'ctypes' : TypeRepository,
+         'ctasks' : TaskRepository,
+         'chits' : HitRepository,
+         'cresponses' : ResponseRepository,
+         'cdocs' : DocumentRepository,
+         'chitloads' : ChitLoadRepository,
+         'currentstatus' : StatusRepository,
+         'workerpings' : PingRepository,
+         'paid_bonus' : PaidBonusRepository,
+         'bonus_info' : BonusInfoRepository,
+         'sets' : SetRepository,
+         'events' : EventRepository,
+         'survey' : SurveyRepository,
+         'mturkconnections' : MTurkConnectionRepository,
+         'cuploads' : UploadRepository}
+
@@ -0,0 +1,441 @@
+"""The repositories on MongoDB, with the queries the controllers made before
+there were other engines. Documents are returned without their ObjectId."""
+import bson
+import gridfs
+import pymongo
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+
+from . import base
+
+# the documents' _id is only returned where it is the key
+NO_ID = {'_id' : 0}
+
+
+def projection(fields):
+    d = dict(NO_ID)
+    d.update((f, 1) for f in fields)
+    return d
+
+
+class MongoDatabase(base.Database):
+    """Wraps a pymongo (or mongomock) database. With read_only the repositories
+       create no indexes."""
+    def __init__(self, database, read_only=False):
+        super().__init__()
+        self.database = database
+        self.read_only = read_only
+    def _drop(self, name):
+        self.database.drop_collection(name)
+    def collection_names(self):
+        return self.database.list_collection_names()
+    def gridfs(self, collection):
+        return gridfs.GridFS(self.database, collection=collection)
+    @property
+    def change_streams(self):
+        """Whether the server is a replica set or a sharded cluster of MongoDB 4.2
+           or later, whose change streams report their position when empty."""
+        if '_change_streams' not in self.__dict__:
+            try:
+                hello = self.database.command('ismaster')
+            except NotImplementedError:
+                # mongomock runs no commands
+                hello = {}
+            self._change_streams = (('setName' in hello or hello.get('msg') == 'isdbgrid')
+                                    and hello.get('maxWireVersion', 0) >= 8)
+        return self._change_streams
+    def close(self):
+        self.database.client.close()
+
+
+class MongoRepository(base.Repository):
+    def __init__(self, database, name):
+        super().__init__(database, name)
+        self.collection = database.database[name]
+        if not database.read_only:
+            self.create_indexes()
+    def create_indexes(self):
+        pass
+    def count(self):
+        return self.collection.count()
+    def insert_docs(self, docs):
+        """Inserts the documents and raises DuplicateKeyError on a duplicate key."""
+        if not docs:
+            return
+        try:
+            self.collection.insert_many([dict(d) for d in docs])
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            if errors and errors[0]['code'] == 11000:
+                raise base.DuplicateKeyError(errors[0]['errmsg'], 11000)
+            raise
+
+
+class AdminRepository(MongoRepository, base.AdminRepository):
+    def create_indexes(self):
+        self.collection.ensure_index('email', unique=True)
+    def emails(self):
+        return [r['email'] for r in self.collection.find({}, {'email' : True})]
+    def get(self, email):
+        return self.collection.find_one({'email' : email}, NO_ID)
+    def insert(self, doc):
+        self.collection.insert(dict(doc))
+    def remove(self, email):
+        self.collection.remove({'email' : email})
+
+
+class TypeRepository(MongoRepository, base.TypeRepository):
+    def create_indexes(self):
+        self.collection.ensure_index('name', unique=True)
+    def insert_many(self, docs):
+        self.insert_docs(docs)
+    def names(self):
+        return [r['name'] for r in self.collection.find({}, {'name' : True})]
+    def get(self, name):
+        return self.collection.find_one({'name' : name}, NO_ID)
+    def get_many(self, names):
+        return list(self.collection.find({'name' : {'$in' : list(names)}}, NO_ID))
+    def all(self):
+        return list(self.collection.find({}, NO_ID))
+
+
+class TaskRepository(MongoRepository, base.TaskRepository):
+    def create_indexes(self):
+        self.collection.ensure_index('taskid', unique=True)
+    def insert_many(self, docs):
+        self.insert_docs(docs)
+    def ids(self):
+        return [r['taskid'] for r in self.collection.find({}, {'taskid' : 1})]
+    def get(self, taskid):
+        return self.collection.find_one({'taskid' : taskid}, NO_ID)
+    def get_many(self, taskids, fields=None):
+        return list(self.collection.find({'taskid' : {'$in' : list(taskids)}},
+                                         projection(fields) if fields else NO_ID))
+    def all(self, fields=None):
+        return list(self.collection.find({}, projection(fields) if fields else NO_ID))
+
+
+class HitRepository(MongoRepository, base.HitRepository):
+    def create_indexes(self):
+        self.collection.ensure_index('hitid', unique=True)
+        self.collection.ensure_index('num_completed_hits')
+    def insert_many(self, docs):
+        self.insert_docs(docs)
+    def ids(self):
+        return [d['hitid'] for d in self.collection.find({}, {'hitid' : True})]
+    def get(self, hitid, fields=None):
+        return self.collection.find_one({'hitid' : hitid}, projection(fields) if fields else NO_ID)
+    def get_many(self, hitids, fields=None):
+        return list(self.collection.find({'hitid' : {'$in' : list(hitids)}},
+                                         projection(fields) if fields else NO_ID))
+    def all(self, fields=None):
+        return list(self.collection.find({}, projection(fields) if fields else NO_ID))
+    def has_available(self):
+        return self.collection.find_one({'num_completed_hits' : {'$lt' : 1}}, {'_id' : 1}) is not None
+    def next_available(self, exclusions, outstanding):
+        d = self.collection.find_one({'$and' :
+                                      [{'num_completed_hits' : {'$lt' : 1}},
+                                       {'exclusions' : {'$nin' : list(exclusions)}},
+                                       {'hitid' : {'$nin' : list(outstanding)}}]},
+                                     {'hitid' : 1})
+        return d['hitid'] if d else None
+    def stats(self):
+        res = self.collection.aggregate([{'$group' : {'_id' : None,
+                                                      'num_completed_hits' : {'$sum' : '$num_completed_hits'},
+                                                      'num_hits' : {'$sum' : 1},
+                                                      'num_tasks' : {'$sum' : {'$size' : '$tasks'}}}}])
+        for d in res:
+            return {'num_completed_hits' : d['num_completed_hits'],
+                    'num_hits' : d['num_hits'],
+                    'num_tasks' : d['num_tasks']}
+        return {'num_completed_hits' : 0, 'num_hits' : 0, 'num_tasks' : 0}
+    def add_completed(self, hitid, hit_info):
+        self.collection.update({'hitid' : hitid},
+                               {'$push' : {'completed_hits' : hit_info},
+                                '$inc' : {'num_completed_hits' : 1}})
+    def completed_ids(self):
+        return [r['hitid'] for r in self.collection.find({'num_completed_hits' : {'$gte' : 1}}, {'hitid' : 1})]
+    def completed_workers(self):
+        worker_ids = set()
+        for r in self.collection.find({'num_completed_hits' : {'$gte' : 1}}, {'completed_hits' : 1}):
+            for hit in r['completed_hits']:
+                worker_ids.add(hit['worker_id'])
+        return worker_ids
+    def has_completion(self, worker_ids, turk_verify_code):
+        hit_infos = [{'worker_id' : w, 'turk_verify_code' : turk_verify_code} for w in worker_ids]
+        return self.collection.find_one({'$and' :
+                                         [{'num_completed_hits' : {'$gte' : 1}},
+                                          {'completed_hits' : {'$in' : hit_infos}}]},
+                                        {'_id' : 1}) is not None
+
+
+class ResponseRepository(MongoRepository, base.ResponseRepository):
+    def create_indexes(self):
+        # also serves the lookups by workerid alone
+        self.collection.ensure_index([('workerid', pymongo.ASCENDING), ('hitid', pymongo.ASCENDING),
+                                      ('taskid', pymongo.ASCENDING), ('submitted', pymongo.ASCENDING)])
+        # only responses with images are indexed, see image_refs()
+        self.collection.ensure_index('images', sparse=True)
+        self.collection.ensure_index([('submitted', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+        # a retried submission is stored once; responses without a request id are not indexed
+        self.collection.ensure_index('requestid', unique=True, sparse=True)
+    def writer(self, write_concern):
+        if not write_concern:
+            return self.collection
+        return self.collection.with_options(write_concern=pymongo.WriteConcern(**write_concern))
+    def insert(self, doc, write_concern=None):
+        self.writer(write_concern).insert(dict(doc))
+    def insert_many(self, docs, write_concern=None):
+        # the ids are set here, so that the responses a failed batch stored are found
+        docs = [dict(d, _id=bson.ObjectId()) for d in docs]
+        collection = self.writer(write_concern)
+        try:
+            collection.insert_many(docs)
+            return [None] * len(docs)
+        except PyMongoError:
+            pass
+        # an ordered insert keeps the responses before the failing one
+        stored = set(d['_id'] for d in self.collection.find({'_id' : {'$in' : [d['_id'] for d in docs]}},
+                                                            {'_id' : 1}))
+        errors = []
+        for doc in docs:
+            try:
+                if doc['_id'] not in stored:
+                    collection.insert(doc)
+                errors.append(None)
+            except PyMongoError as e:
+                errors.append(e)
+        return errors
+    def all(self):
+        return self.collection.find({}, NO_ID)
+    def count_by_worker(self, workerid):
+        return self.collection.find({'workerid' : workerid}).count()
+    def hitids_by_worker(self, workerid):
+        return [r['hitid'] for r in self.collection.find({'workerid' : workerid}, {'hitid' : 1})]
+    def latest(self, workerid, hitid, taskid, fields=None):
+        # the index on (workerid, hitid, taskid, submitted) is read backwards
+        for d in self.collection.find({'workerid' : workerid, 'hitid' : hitid, 'taskid' : taskid},
+                                      projection(fields) if fields else NO_ID).sort('submitted',
+                                                                                   pymongo.DESCENDING).limit(1):
+            return d
+        return None
+    def get_by_requestid(self, requestid):
+        return self.collection.find_one({'requestid' : requestid}, projection(('hitid', 'taskid')))
+    def since(self, after, before, limit):
+        spec = {}
+        if before is not None:
+            spec['submitted'] = {'$lt' : before}
+        if after is not None:
+            spec['$or'] = [{'submitted' : {'$gt' : after[0]}}, {'submitted' : after[0], '_id' : {'$gt' : after[1]}}]
+        return [(d.pop('_id'), d) for d in self.collection.find(spec).sort([('submitted', pymongo.ASCENDING),
+                                                                            ('_id', pymongo.ASCENDING)]).limit(limit)]
+    # how long an empty read of the change stream waits for a response
+    change_wait_ms = 100
+    def changes(self, resume, limit=None):
+        if not self.database.change_streams:
+            return super().changes(resume, limit)
+        try:
+            stream = self.collection.watch([{'$match' : {'operationType' : 'insert'}}], resume_after=resume,
+                                           max_await_time_ms=self.change_wait_ms)
+        except OperationFailure as e:
+            # the oplog no longer reaches back to resume
+            raise base.StorageError("Cannot resume the change stream of %s: %s" % (self.name, e))
+        with stream:
+            responses = []
+            while limit is None or len(responses) < limit:
+                change = stream.try_next()
+                if change is None:
+                    break
+                d = change['fullDocument']
+                responses.append((d.pop('_id'), d))
+            return responses, stream.resume_token
+    def questions(self):
+        for d in self.collection.find({}, {'_id' : 0, 'workerid' : 1, 'response.name' : 1,
+                                           'response.responses.varname' : 1}):
+            for module in d['response']:
+                for question_response in module['responses']:
+                    yield d['workerid'], module['name'], question_response['varname']
+    def image_refs(self):
+        return set(self.collection.distinct('images'))
+
+
+class DocumentRepository(MongoRepository, base.DocumentRepository):
+    def create_indexes(self):
+        self.collection.ensure_index('names')
+    def add_many(self, docs):
+        docs = {d['_id'] : d for d in docs}
+        existing = set(d['_id'] for d in self.collection.find({'_id' : {'$in' : list(docs)}}, {'_id' : 1}))
+        for h in existing:
+            self.collection.update({'_id' : h}, {'$addToSet' : {'names' : {'$each' : docs[h]['names']}}})
+        self.insert_docs([d for h, d in docs.items() if h not in existing])
+    def get(self, hash):
+        return self.collection.find_one({'_id' : hash})
+    def get_by_name(self, name):
+        d = self.collection.find_one({'names' : name})
+        if d is None:
+            # surveys loaded before documents were stored by hash keep {name, content}
+            d = self.collection.find_one({'name' : name})
+        return d
+    def get_hashes(self, names):
+        names = set(names)
+        return {name : d['_id'] for d in self.collection.find({'names' : {'$in' : list(names)}}, {'names' : 1})
+                for name in d['names'] if name in names}
+
+
+class ChitLoadRepository(MongoRepository, base.ChitLoadRepository):
+    def create_indexes(self):
+        self.collection.ensure_index('time')
+    def insert(self, doc):
+        self.collection.insert(dict(doc))
+    def remove_older(self, cutoff):
+        return self.collection.remove({'time' : {'$lt' : cutoff}})['n']
+
+
+class StatusRepository(MongoRepository, base.StatusRepository):
+    def create_indexes(self):
+        self.collection.ensure_index('workerid', unique=True)
+        self.collection.ensure_index('updated')
+    def put(self, workerid, hitid, taskindex, updated):
+        self.collection.update({'workerid' : workerid},
+                               {'workerid' : workerid,
+                                'hitid' : hitid,
+                                'taskindex' : taskindex,
+                                'updated' : updated},
+                               True)
+    def get(self, workerid):
+        return self.collection.find_one({'workerid' : workerid}, projection(('workerid', 'hitid', 'taskindex')))
+    def remove(self, workerid):
+        self.collection.remove({'workerid' : workerid})
+    def hitids(self):
+        return [r['hitid'] for r in self.collection.find({}, {'hitid' : 1})]
+    def hitids_of(self, workerids):
+        return [r['hitid'] for r in self.collection.find({'workerid' : {'$in' : list(workerids)}}, {'hitid' : 1})]
+    def hitids_by_worker(self):
+        return {r['workerid'] : r['hitid'] for r in self.collection.find({}, {'workerid' : 1, 'hitid' : 1})}
+    def set_missing_updated(self, updated):
+        self.collection.update({'updated' : {'$exists' : False}}, {'$set' : {'updated' : updated}}, multi=True)
+    def remove_older(self, cutoff):
+        return self.collection.remove({'updated' : {'$lt' : cutoff}})['n']
+
+
+class PingRepository(MongoRepository, base.PingRepository):
+    def create_indexes(self):
+        self.collection.ensure_index('hitid')
+        self.collection.ensure_index('lastping')
+    def ping(self, hitid, time):
+        self.collection.update({'hitid' : hitid},
+                               {'hitid' : hitid,
+                                'lastping' : time},
+                               True)
+    def ping_many(self, hitids, time):
+        self.collection.update({'hitid' : {'$in' : list(hitids)}},
+                               {'$set' : {'lastping' : time}},
+                               multi=True)
+        pinged = set(d['hitid'] for d in self.collection.find({'hitid' : {'$in' : list(hitids)}}, {'hitid' : 1}))
+        for hitid in set(hitids) - pinged:
+            self.ping(hitid, time)
+    def remove_older(self, cutoff, keep):
+        return self.collection.remove({'lastping' : {'$lt' : cutoff}, 'hitid' : {'$nin' : list(keep)}})['n']
+    def stale_hit(self, chits, cutoff, exclusions):
+        # the pings are found through the lastping index and joined with the cHITs
+        res = self.collection.aggregate([
+            {'$match' : {'lastping' : {'$lt' : cutoff}}},
+            {'$sort' : {'lastping' : 1}},
+            {'$lookup' : {'from' : chits.name,
+                          'localField' : 'hitid',
+                          'foreignField' : 'hitid',
+                          'as' : 'chit'}},
+            {'$unwind' : '$chit'},
+            {'$match' : {'chit.num_completed_hits' : {'$lt' : 1},
+                         'chit.exclusions' : {'$nin' : list(exclusions)}}},
+            {'$limit' : 1},
+            {'$project' : {'_id' : 0, 'hitid' : 1}}])
+        for d in res:
+            return d['hitid']
+        return None
+
+
+class PaidBonusRepository(MongoRepository, base.PaidBonusRepository):
+    def insert(self, doc):
+        self.collection.insert(dict(doc))
+    def all(self):
+        return list(self.collection.find({}, NO_ID))
+
+
+class BonusInfoRepository(MongoRepository, base.BonusInfoRepository):
+    def replace(self, docs):
+        self.collection.drop()
+        self.insert_docs(docs)
+    def all(self):
+        return list(self.collection.find({}, NO_ID))
+
+
+class SetRepository(MongoRepository, base.SetRepository):
+    def create_indexes(self):
+        self.collection.ensure_index([('name', pymongo.ASCENDING), ('member', pymongo.ASCENDING)])
+    def insert_many(self, docs):
+        self.insert_docs(docs)
+    def names(self):
+        return [r['name'] for r in self.collection.find({}, {'name' : 1})]
+    def has_member(self, name, member):
+        return self.collection.find_one({'name' : name, 'member' : member}, {'_id' : 1}) is not None
+
+
+class EventRepository(MongoRepository, base.EventRepository):
+    def create_indexes(self):
+        self.collection.ensure_index('date')
+    def insert(self, doc):
+        self.collection.insert(dict(doc))
+    def all(self):
+        return list(self.collection.find({}, NO_ID).sort('date'))
+    def last(self, limit):
+        # read backwards through the date index
+        return list(self.collection.find({}, NO_ID).sort('date', pymongo.DESCENDING).limit(limit))[::-1]
+    def trim(self, keep):
+        for d in self.collection.find({}, {'date' : 1}).sort('date', pymongo.DESCENDING).skip(keep).limit(1):
+            return self.collection.remove({'date' : {'$lte' : d['date']}})['n']
+        return 0
+
+
+class SurveyRepository(MongoRepository, base.SurveyRepository):
+    def get(self, key):
+        return self.collection.find_one({'_id' : key})
+    def create(self, doc):
+        self.collection.insert(dict(doc))
+    def put(self, doc):
+        self.collection.update({'_id' : doc['_id']}, doc, upsert=True)
+    def remove(self, key):
+        self.collection.remove({'_id' : key})
+    def swap_generation(self, old, new, time):
+        res = self.collection.update({'_id' : 'current', 'generation' : old},
+                                     {'$set' : {'generation' : new, 'uploaded' : time},
+                                      '$push' : {'retired' : {'generation' : old, 'retired' : time}}})
+        return res['n'] == 1
+    def remove_retired(self, generation):
+        self.collection.update({'_id' : 'current'},
+                               {'$pull' : {'retired' : {'generation' : generation}}})
+
+
+class MTurkConnectionRepository(MongoRepository, base.MTurkConnectionRepository):
+    def get(self):
+        return self.collection.find_one({}, NO_ID)
+    def update(self, fields):
+        self.collection.update({}, {'$set' : fields}, upsert=True)
+    def all(self):
+        return list(self.collection.find({}, NO_ID))
+
+
+class UploadRepository(MongoRepository, base.UploadRepository):
+    def create_indexes(self):
+        self.collection.ensure_index('blobid', unique=True)
+        self.collection.ensure_index('created')
+    def insert(self, doc):
+        self.collection.insert(dict(doc))
+    def get(self, blobid, workerid):
+        return self.collection.find_one({'blobid' : blobid, 'workerid' : workerid}, NO_ID)
+    def refs(self):
+        return [u['ref'] for u in self.collection.find({}, {'ref' : 1})]
+    def remove_older(self, cutoff):
+        self.collection.remove({'created' : {'$lt' : cutoff}})
+
+
+MongoDatabase.repositories = {kind : globals()[interface.__name__] for kind, interface in base.KINDS.items()}
@@ -0,0 +1,527 @@
+"""The repositories on an SQLite file, which needs no database server. Every
+collection is a table with a column for each field the repository queries,
+indexed where the queries need it; the rest of a document is kept as JSON in
+the column doc. Datetimes are stored as ISO text, which sorts in time order."""
+import base64
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+from . import base
+
+
+def timestamp(time):
+    return time.isoformat(sep=' ', timespec='microseconds')
+
+def _default(o):
+    if isinstance(o, datetime.datetime):
+        return {'$date' : timestamp(o)}
+    if isinstance(o, bytes):
+        return {'$binary' : base64.b64encode(o).decode('ascii')}
+    raise TypeError("%s is not JSON serializable" % type(o).__name__)
+
+def _object_hook(d):
+    if len(d) == 1:
+        if '$date' in d:
+            return datetime.datetime.fromisoformat(d['$date'])
+        if '$binary' in d:
+            return base64.b64decode(d['$binary'])
+    return d
+
+def encode(value):
+    return json.dumps(value, default=_default, separators=(',', ':'))
+
+def decode(s):
+    return json.loads(s, object_hook=_object_hook)
+
+def json_list(values):
+    """A parameter for IN (SELECT value FROM json_each(?))"""
+    return json.dumps(list(values))
+
+
+class SQLiteDatabase(base.Database):
+    """A database in the file path. Every thread has its own connection; the file
+       is in WAL mode, so readers are not blocked by a writer."""
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # transactions are begun explicitly, see transaction()
+            connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30.0)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+    @contextlib.contextmanager
+    def transaction(self):
+        """Nested transactions are savepoints of the outermost one."""
+        connection = self.connection
+        depth = self._local.depth
+        connection.execute("BEGIN IMMEDIATE" if depth == 0 else "SAVEPOINT s%d" % depth)
+        self._local.depth += 1
+        try:
+            yield connection
+        except BaseException:
+            self._local.depth = depth
+            # tables created in the transaction are gone, so their repositories are created again
+            self._collections.clear()
+            if depth == 0:
+                connection.execute("ROLLBACK")
+            else:
+                connection.execute("ROLLBACK TO s%d" % depth)
+                connection.execute("RELEASE s%d" % depth)
+            raise
+        self._local.depth = depth
+        connection.execute("COMMIT" if depth == 0 else "RELEASE s%d" % depth)
+    def batch(self):
+        return self.transaction()
+    def backup(self, path):
+        """Copies the database to the file path. The copy is consistent even while
+           the database is written."""
+        target = sqlite3.connect(path)
+        try:
+            self.connection.backup(target)
+        finally:
+            target.close()
+    def tables(self, name):
+        """The table of the collection name and its side tables, name$<...>."""
+        rows = self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND "
+                                       "(name = ? OR substr(name, 1, ?) = ?)",
+                                       (name, len(name) + 1, name + '$'))
+        return [r[0] for r in rows]
+    def _drop(self, name):
+        with self.transaction() as connection:
+            for table in self.tables(name):
+                connection.execute('DROP TABLE IF EXISTS "%s"' % table)
+    def collection_names(self):
+        rows = self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND "
+                                       "instr(name, '$') = 0 AND substr(name, 1, 7) != 'sqlite_'")
+        return [r[0] for r in rows]
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+    def drop(self):
+        self.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+class SQLiteRepository(base.Repository):
+    """The SQL of the subclasses names the table {table} and its side tables and
+       indexes "{name}$<...>"."""
+    # the statements that create the table and its indexes
+    schema = ()
+    def __init__(self, database, name):
+        super().__init__(database, name)
+        self.table = '"%s"' % name
+        with database.transaction():
+            for statement in self.schema:
+                self.execute(statement)
+    def execute(self, sql, parameters=()):
+        try:
+            return self.database.connection.execute(sql.format(table=self.table, name=self.name), parameters)
+        except sqlite3.IntegrityError as e:
+            if str(e).startswith("UNIQUE constraint failed"):
+                raise base.DuplicateKeyError(str(e))
+            raise
+    def executemany(self, sql, parameters):
+        try:
+            return self.database.connection.executemany(sql.format(table=self.table, name=self.name), parameters)
+        except sqlite3.IntegrityError as e:
+            if str(e).startswith("UNIQUE constraint failed"):
+                raise base.DuplicateKeyError(str(e))
+            raise
+    def fetch_docs(self, sql, parameters=()):
+        return [decode(r[0]) for r in self.execute(sql, parameters)]
+    def fetch_doc(self, sql, parameters=()):
+        r = self.execute(sql, parameters).fetchone()
+        return decode(r[0]) if r else None
+    def fetch_column(self, sql, parameters=()):
+        return [r[0] for r in self.execute(sql, parameters)]
+    @staticmethod
+    def doc_column(fields=None):
+        """The SQL of the document, or of its given fields"""
+        if not fields:
+            return "doc"
+        return "json_object(%s)" % ", ".join("'%s', doc -> '$.%s'" % (f, f) for f in fields)
+    def count(self):
+        return self.execute("SELECT count(*) FROM {table}").fetchone()[0]
+
+
+class AdminRepository(SQLiteRepository, base.AdminRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (email TEXT PRIMARY KEY, doc TEXT NOT NULL)",)
+    def emails(self):
+        return self.fetch_column("SELECT email FROM {table} ORDER BY rowid")
+    def get(self, email):
+        return self.fetch_doc("SELECT doc FROM {table} WHERE email = ?", (email,))
+    def insert(self, doc):
+        self.execute("INSERT INTO {table} (email, doc) VALUES (?, ?)", (doc['email'], encode(doc)))
+    def remove(self, email):
+        self.execute("DELETE FROM {table} WHERE email = ?", (email,))
+
+
+class TypeRepository(SQLiteRepository, base.TypeRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (name TEXT NOT NULL UNIQUE, doc TEXT NOT NULL)",)
+    def insert_many(self, docs):
+        self.executemany("INSERT INTO {table} (name, doc) VALUES (?, ?)",
+                         [(d['name'], encode(d)) for d in docs])
+    def names(self):
+        return self.fetch_column("SELECT name FROM {table} ORDER BY rowid")
+    def get(self, name):
+        return self.fetch_doc("SELECT doc FROM {table} WHERE name = ?", (name,))
+    def get_many(self, names):
+        return self.fetch_docs("SELECT doc FROM {table} WHERE name IN (SELECT value FROM json_each(?)) "
+                               "ORDER BY rowid", (json_list(names),))
+    def all(self):
+        return self.fetch_docs("SELECT doc FROM {table} ORDER BY rowid")
+
+
+class TaskRepository(SQLiteRepository, base.TaskRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (taskid TEXT NOT NULL UNIQUE, doc TEXT NOT NULL)",)
+    def insert_many(self, docs):
+        self.executemany("INSERT INTO {table} (taskid, doc) VALUES (?, ?)",
+                         [(d['taskid'], encode(d)) for d in docs])
+    def ids(self):
+        return self.fetch_column("SELECT taskid FROM {table} ORDER BY rowid")
+    def get(self, taskid):
+        return self.fetch_doc("SELECT doc FROM {table} WHERE taskid = ?", (taskid,))
+    def get_many(self, taskids, fields=None):
+        return self.fetch_docs("SELECT %s FROM {table} WHERE taskid IN (SELECT value FROM json_each(?)) "
+                               "ORDER BY rowid" % self.doc_column(fields), (json_list(taskids),))
+    def all(self, fields=None):
+        return self.fetch_docs("SELECT %s FROM {table} ORDER BY rowid" % self.doc_column(fields))
+
+
+class HitRepository(SQLiteRepository, base.HitRepository):
+    """completed_hits, which grows with every completion, is kept out of doc."""
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (hitid TEXT NOT NULL UNIQUE, "
+              "num_completed_hits INTEGER NOT NULL, exclusions TEXT NOT NULL, "
+              "completed_hits TEXT NOT NULL, doc TEXT NOT NULL)",
+              'CREATE INDEX IF NOT EXISTS "{name}$num_completed_hits" ON {table} (num_completed_hits)')
+    # excludes none of the exclusions of parameter 1
+    not_excluded = ("NOT EXISTS (SELECT 1 FROM json_each({table}.exclusions) "
+                    "WHERE value IN (SELECT value FROM json_each(?)))")
+    def insert_many(self, docs):
+        rows = []
+        for d in docs:
+            doc = dict(d)
+            completed_hits = doc.pop('completed_hits', [])
+            doc.pop('num_completed_hits', None)
+            rows.append((d['hitid'], len(completed_hits), encode(d.get('exclusions', [])),
+                         encode(completed_hits), encode(doc)))
+        self.executemany("INSERT INTO {table} (hitid, num_completed_hits, exclusions, completed_hits, doc) "
+                         "VALUES (?, ?, ?, ?, ?)", rows)
+    def select(self, fields):
+        """The SQL of the columns read by read()"""
+        if not fields:
+            return "doc, completed_hits, num_completed_hits"
+        doc_fields = set(fields) - {'completed_hits', 'num_completed_hits'}
+        return "%s, %s, num_completed_hits" % (self.doc_column(sorted(doc_fields)) if doc_fields else "json_object()",
+                                              'completed_hits' if 'completed_hits' in fields else 'NULL')
+    def read(self, row, fields):
+        d = decode(row[0])
+        if not fields or 'completed_hits' in fields:
+            d['completed_hits'] = decode(row[1])
+        if not fields or 'num_completed_hits' in fields:
+            d['num_completed_hits'] = row[2]
+        return d
+    def ids(self):
+        return self.fetch_column("SELECT hitid FROM {table} ORDER BY rowid")
+    def get(self, hitid, fields=None):
+        r = self.execute("SELECT %s FROM {table} WHERE hitid = ?" % self.select(fields), (hitid,)).fetchone()
+        return self.read(r, fields) if r else None
+    def get_many(self, hitids, fields=None):
+        rows = self.execute("SELECT %s FROM {table} WHERE hitid IN (SELECT value FROM json_each(?)) "
+                            "ORDER BY rowid" % self.select(fields), (json_list(hitids),))
+        return [self.read(r, fields) for r in rows]
+    def all(self, fields=None):
+        return [self.read(r, fields) for r in self.execute("SELECT %s FROM {table} ORDER BY rowid" % self.select(fields))]
+    def has_available(self):
+        return self.execute("SELECT 1 FROM {table} WHERE num_completed_hits = 0 LIMIT 1").fetchone() is not None
+    def next_available(self, exclusions, outstanding):
+        # the index on num_completed_hits returns the uncompleted cHITs in rowid order
+        r = self.execute("SELECT hitid FROM {table} WHERE num_completed_hits = 0 AND " + self.not_excluded +
+                         " AND hitid NOT IN (SELECT value FROM json_each(?)) ORDER BY rowid LIMIT 1",
+                         (json_list(exclusions), json_list(outstanding))).fetchone()
+        return r[0] if r else None
+    def stats(self):
+        r = self.execute("SELECT count(*), total(num_completed_hits), total(json_array_length(doc, '$.tasks')) "
+                         "FROM {table}").fetchone()
+        return {'num_completed_hits' : int(r[1]), 'num_hits' : r[0], 'num_tasks' : int(r[2])}
+    def add_completed(self, hitid, hit_info):
+        self.execute("UPDATE {table} SET completed_hits = json_insert(completed_hits, '$[#]', json(?)), "
+                     "num_completed_hits = num_completed_hits + 1 WHERE hitid = ?", (encode(hit_info), hitid))
+    def completed_ids(self):
+        return self.fetch_column("SELECT hitid FROM {table} WHERE num_completed_hits >= 1 ORDER BY rowid")
+    def completed_workers(self):
+        return set(self.fetch_column("SELECT DISTINCT c.value ->> '$.worker_id' FROM {table}, "
+                                     "json_each({table}.completed_hits) AS c WHERE num_completed_hits >= 1"))
+    def has_completion(self, worker_ids, turk_verify_code):
+        return self.execute("SELECT 1 FROM {table}, json_each({table}.completed_hits) AS c "
+                            "WHERE num_completed_hits >= 1 AND c.value ->> '$.turk_verify_code' = ? "
+                            "AND c.value ->> '$.worker_id' IN (SELECT value FROM json_each(?)) LIMIT 1",
+                            (turk_verify_code, json_list(worker_ids))).fetchone() is not None
+
+
+class ResponseRepository(SQLiteRepository, base.ResponseRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (workerid TEXT, hitid TEXT, taskid TEXT, "
+              "submitted TEXT, images TEXT, requestid TEXT UNIQUE, doc TEXT NOT NULL)",
+              'CREATE INDEX IF NOT EXISTS "{name}$workerid" ON {table} (workerid, hitid, taskid, submitted)',
+              # only responses with images are indexed, see image_refs()
+              'CREATE INDEX IF NOT EXISTS "{name}$images" ON {table} (images) WHERE images IS NOT NULL',
+              # orders the responses by (submitted, rowid), see since()
+              'CREATE INDEX IF NOT EXISTS "{name}$submitted" ON {table} (submitted)')
+    insert_sql = ("INSERT INTO {table} (workerid, hitid, taskid, submitted, images, requestid, doc) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?)")
+    @staticmethod
+    def row(doc):
+        return (doc['workerid'], doc['hitid'], doc['taskid'], timestamp(doc['submitted']),
+                encode(doc['images']) if doc.get('images') else None, doc.get('requestid'), encode(doc))
+    def insert(self, doc, write_concern=None):
+        self.execute(self.insert_sql, self.row(doc))
+    def insert_many(self, docs, write_concern=None):
+        try:
+            with self.database.transaction():
+                self.executemany(self.insert_sql, [self.row(d) for d in docs])
+            return [None] * len(docs)
+        except (sqlite3.Error, base.DuplicateKeyError):
+            # the transaction stored none of them
+            pass
+        errors = []
+        for doc in docs:
+            try:
+                self.insert(doc)
+                errors.append(None)
+            except (sqlite3.Error, base.DuplicateKeyError) as e:
+                errors.append(e)
+        return errors
+    def all(self):
+        return (decode(r[0]) for r in self.execute("SELECT doc FROM {table} ORDER BY rowid"))
+    def count_by_worker(self, workerid):
+        return self.execute("SELECT count(*) FROM {table} WHERE workerid = ?", (workerid,)).fetchone()[0]
+    def hitids_by_worker(self, workerid):
+        return self.fetch_column("SELECT hitid FROM {table} WHERE workerid = ? ORDER BY rowid", (workerid,))
+    def latest(self, workerid, hitid, taskid, fields=None):
+        return self.fetch_doc("SELECT %s FROM {table} WHERE workerid = ? AND hitid = ? AND taskid = ? "
+                              "ORDER BY submitted DESC, rowid DESC LIMIT 1" % self.doc_column(fields),
+                              (workerid, hitid, taskid))
+    def get_by_requestid(self, requestid):
+        return self.fetch_doc("SELECT %s FROM {table} WHERE requestid = ?" % self.doc_column(('hitid', 'taskid')),
+                              (requestid,))
+    def since(self, after, before, limit):
+        where, params = [], []
+        if before is not None:
+            where.append("submitted < ?")
+            params.append(timestamp(before))
+        if after is not None:
+            where.append("(submitted, rowid) > (?, ?)")
+            params.extend((timestamp(after[0]), after[1]))
+        return [(r[0], decode(r[1])) for r in
+                self.execute("SELECT rowid, doc FROM {table} %s ORDER BY submitted, rowid LIMIT ?"
+                             % ("WHERE " + " AND ".join(where) if where else ""), params + [limit])]
+    def questions(self):
+        return self.execute("SELECT r.workerid, m.value ->> '$.name', q.value ->> '$.varname' "
+                            "FROM {table} AS r, json_each(r.doc, '$.response') AS m, "
+                            "json_each(m.value, '$.responses') AS q ORDER BY r.rowid, m.key, q.key")
+    def image_refs(self):
+        return set(self.fetch_column("SELECT DISTINCT i.value FROM {table}, json_each({table}.images) AS i "
+                                     "WHERE {table}.images IS NOT NULL"))
+
+
+class DocumentRepository(SQLiteRepository, base.DocumentRepository):
+    """The names of the documents are kept in the side table {name}$names."""
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (hash TEXT PRIMARY KEY, size INTEGER NOT NULL, content BLOB NOT NULL)",
+              'CREATE TABLE IF NOT EXISTS "{name}$names" (name TEXT NOT NULL, hash TEXT NOT NULL, UNIQUE (name, hash))')
+    def add_many(self, docs):
+        with self.database.transaction():
+            self.executemany("INSERT OR IGNORE INTO {table} (hash, size, content) VALUES (?, ?, ?)",
+                             [(d['_id'], d['size'], bytes(d['content'])) for d in docs])
+            self.executemany('INSERT OR IGNORE INTO "{name}$names" (name, hash) VALUES (?, ?)',
+                             [(name, d['_id']) for d in docs for name in d['names']])
+    def get(self, hash):
+        r = self.execute("SELECT hash, size, content FROM {table} WHERE hash = ?", (hash,)).fetchone()
+        if r is None:
+            return None
+        return {'_id' : r[0],
+                'names' : self.fetch_column('SELECT name FROM "{name}$names" WHERE hash = ? ORDER BY rowid', (hash,)),
+                'size' : r[1],
+                'content' : r[2]}
+    def get_by_name(self, name):
+        r = self.execute('SELECT hash FROM "{name}$names" WHERE name = ? ORDER BY rowid LIMIT 1', (name,)).fetchone()
+        return self.get(r[0]) if r else None
+    def get_hashes(self, names):
+        return dict(self.execute('SELECT name, hash FROM "{name}$names" '
+                                 'WHERE name IN (SELECT value FROM json_each(?)) ORDER BY rowid DESC',
+                                 (json_list(names),)).fetchall())
+
+
+class ChitLoadRepository(SQLiteRepository, base.ChitLoadRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (time TEXT, doc TEXT NOT NULL)",
+              'CREATE INDEX IF NOT EXISTS "{name}$time" ON {table} (time)')
+    def insert(self, doc):
+        self.execute("INSERT INTO {table} (time, doc) VALUES (?, ?)", (timestamp(doc['time']), encode(doc)))
+    def remove_older(self, cutoff):
+        return self.execute("DELETE FROM {table} WHERE time < ?", (timestamp(cutoff),)).rowcount
+
+
+class StatusRepository(SQLiteRepository, base.StatusRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (workerid TEXT PRIMARY KEY, hitid TEXT, taskindex INTEGER, "
+              "updated TEXT)",
+              'CREATE INDEX IF NOT EXISTS "{name}$updated" ON {table} (updated)')
+    def put(self, workerid, hitid, taskindex, updated):
+        self.execute("INSERT INTO {table} (workerid, hitid, taskindex, updated) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (workerid) DO UPDATE SET hitid = excluded.hitid, taskindex = excluded.taskindex, "
+                     "updated = excluded.updated",
+                     (workerid, hitid, taskindex, timestamp(updated)))
+    def get(self, workerid):
+        r = self.execute("SELECT workerid, hitid, taskindex FROM {table} WHERE workerid = ?", (workerid,)).fetchone()
+        return {'workerid' : r[0], 'hitid' : r[1], 'taskindex' : r[2]} if r else None
+    def remove(self, workerid):
+        self.execute("DELETE FROM {table} WHERE workerid = ?", (workerid,))
+    def hitids(self):
+        return self.fetch_column("SELECT hitid FROM {table}")
+    def hitids_of(self, workerids):
+        return self.fetch_column("SELECT hitid FROM {table} WHERE workerid IN (SELECT value FROM json_each(?))",
+                                 (json_list(workerids),))
+    def hitids_by_worker(self):
+        return dict(self.execute("SELECT workerid, hitid FROM {table}").fetchall())
+    def set_missing_updated(self, updated):
+        self.execute("UPDATE {table} SET updated = ? WHERE updated IS NULL", (timestamp(updated),))
+    def remove_older(self, cutoff):
+        return self.execute("DELETE FROM {table} WHERE updated < ?", (timestamp(cutoff),)).rowcount
+
+
+class PingRepository(SQLiteRepository, base.PingRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (hitid TEXT PRIMARY KEY, lastping TEXT NOT NULL)",
+              'CREATE INDEX IF NOT EXISTS "{name}$lastping" ON {table} (lastping)')
+    def ping(self, hitid, time):
+        self.execute("INSERT INTO {table} (hitid, lastping) VALUES (?, ?) "
+                     "ON CONFLICT (hitid) DO UPDATE SET lastping = excluded.lastping", (hitid, timestamp(time)))
+    def ping_many(self, hitids, time):
+        with self.database.transaction():
+            self.executemany("INSERT INTO {table} (hitid, lastping) VALUES (?, ?) "
+                             "ON CONFLICT (hitid) DO UPDATE SET lastping = excluded.lastping",
+                             [(hitid, timestamp(time)) for hitid in set(hitids)])
+    def remove_older(self, cutoff, keep):
+        return self.execute("DELETE FROM {table} WHERE lastping < ? AND hitid NOT IN (SELECT value FROM json_each(?))",
+                            (timestamp(cutoff), json_list(keep))).rowcount
+    def stale_hit(self, chits, cutoff, exclusions):
+        r = self.execute("SELECT p.hitid FROM {table} AS p JOIN %s ON %s.hitid = p.hitid "
+                         "WHERE p.lastping < ? AND %s.num_completed_hits < 1 AND %s "
+                         "ORDER BY p.lastping LIMIT 1" % (chits.table, chits.table, chits.table,
+                                                          chits.not_excluded.format(table=chits.table)),
+                         (timestamp(cutoff), json_list(exclusions))).fetchone()
+        return r[0] if r else None
+
+
+class PaidBonusRepository(SQLiteRepository, base.PaidBonusRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (doc TEXT NOT NULL)",)
+    def insert(self, doc):
+        self.execute("INSERT INTO {table} (doc) VALUES (?)", (encode(doc),))
+    def all(self):
+        return self.fetch_docs("SELECT doc FROM {table} ORDER BY rowid")
+
+
+class BonusInfoRepository(SQLiteRepository, base.BonusInfoRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (doc TEXT NOT NULL)",)
+    def replace(self, docs):
+        with self.database.transaction():
+            self.execute("DELETE FROM {table}")
+            self.executemany("INSERT INTO {table} (doc) VALUES (?)", [(encode(d),) for d in docs])
+    def all(self):
+        return self.fetch_docs("SELECT doc FROM {table} ORDER BY rowid")
+
+
+class SetRepository(SQLiteRepository, base.SetRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (name TEXT, member TEXT)",
+              'CREATE INDEX IF NOT EXISTS "{name}$name" ON {table} (name, member)')
+    def insert_many(self, docs):
+        self.executemany("INSERT INTO {table} (name, member) VALUES (?, ?)", [(d['name'], d['member']) for d in docs])
+    def names(self):
+        return self.fetch_column("SELECT name FROM {table} ORDER BY rowid")
+    def has_member(self, name, member):
+        return self.execute("SELECT 1 FROM {table} WHERE name = ? AND member = ? LIMIT 1",
+                            (name, member)).fetchone() is not None
+
+
+class EventRepository(SQLiteRepository, base.EventRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (date TEXT NOT NULL, doc TEXT NOT NULL)",
+              'CREATE INDEX IF NOT EXISTS "{name}$date" ON {table} (date)')
+    def insert(self, doc):
+        self.execute("INSERT INTO {table} (date, doc) VALUES (?, ?)", (timestamp(doc['date']), encode(doc)))
+    def all(self):
+        return self.fetch_docs("SELECT doc FROM {table} ORDER BY date, rowid")
+    def last(self, limit):
+        return self.fetch_docs("SELECT doc FROM {table} ORDER BY date DESC, rowid DESC LIMIT ?", (limit,))[::-1]
+    def trim(self, keep):
+        return self.execute("DELETE FROM {table} WHERE rowid NOT IN "
+                            "(SELECT rowid FROM {table} ORDER BY date DESC, rowid DESC LIMIT ?)", (keep,)).rowcount
+
+
+class SurveyRepository(SQLiteRepository, base.SurveyRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, doc TEXT NOT NULL)",)
+    def get(self, key):
+        return self.fetch_doc("SELECT doc FROM {table} WHERE key = ?", (key,))
+    def create(self, doc):
+        self.execute("INSERT INTO {table} (key, doc) VALUES (?, ?)", (doc['_id'], encode(doc)))
+    def put(self, doc):
+        self.execute("INSERT OR REPLACE INTO {table} (key, doc) VALUES (?, ?)", (doc['_id'], encode(doc)))
+    def remove(self, key):
+        self.execute("DELETE FROM {table} WHERE key = ?", (key,))
+    def swap_generation(self, old, new, time):
+        # the compare-and-set is a single statement
+        cursor = self.execute("UPDATE {table} SET doc = json_insert(json_set(doc, '$.generation', ?, '$.uploaded', json(?)), "
+                              "'$.retired[#]', json(?)) WHERE key = 'current' AND doc ->> '$.generation' = ?",
+                              (new, encode(time), encode({'generation' : old, 'retired' : time}), old))
+        return cursor.rowcount == 1
+    def remove_retired(self, generation):
+        self.execute("UPDATE {table} SET doc = json_set(doc, '$.retired', "
+                     "(SELECT json_group_array(json(value)) FROM json_each(doc, '$.retired') "
+                     "WHERE value ->> '$.generation' IS NOT ?)) WHERE key = 'current'", (generation,))
+
+
+class MTurkConnectionRepository(SQLiteRepository, base.MTurkConnectionRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY CHECK (id = 1), doc TEXT NOT NULL)",)
+    def get(self):
+        return self.fetch_doc("SELECT doc FROM {table} WHERE id = 1")
+    def update(self, fields):
+        with self.database.transaction():
+            doc = self.get() or {}
+            doc.update(fields)
+            self.execute("INSERT OR REPLACE INTO {table} (id, doc) VALUES (1, ?)", (encode(doc),))
+    def all(self):
+        return self.fetch_docs("SELECT doc FROM {table}")
+
+
+class UploadRepository(SQLiteRepository, base.UploadRepository):
+    schema = ("CREATE TABLE IF NOT EXISTS {table} (blobid TEXT PRIMARY KEY, workerid TEXT, ref TEXT NOT NULL, "
+              "created TEXT NOT NULL, doc TEXT NOT NULL)",
+              'CREATE INDEX IF NOT EXISTS "{name}$created" ON {table} (created)')
+    def insert(self, doc):
+        self.execute("INSERT INTO {table} (blobid, workerid, ref, created, doc) VALUES (?, ?, ?, ?, ?)",
+                     (doc['blobid'], doc['workerid'], doc['ref'], timestamp(doc['created']), encode(doc)))
+    def get(self, blobid, workerid):
+        return self.fetch_doc("SELECT doc FROM {table} WHERE blobid = ? AND workerid = ?", (blobid, workerid))
+    def refs(self):
+        return self.fetch_column("SELECT ref FROM {table}")
+    def remove_older(self, cutoff):
+        self.execute("DELETE FROM {table} WHERE created < ?", (timestamp(cutoff),))
+
+
+SQLiteDatabase.repositories = {kind : globals()[interface.__name__] for kind, interface in base.KINDS.items()}
@@ -0,0 +1,54 @@
+# The models read the configuration in config/app_config.py. The database and
+# survey the test modules share are set up here.
+
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import controllers
+import storage
+
+SURVEY = os.path.join(os.path.dirname(__file__), 'test_xml_1.xml')
+# a response to the demographics module of SURVEY
+RESPONSE = [{'name' : 'demographics',
+             'responses' : [{'varname' : 'age', 'response' : '30'},
+                            {'varname' : 'thoughts', 'response' : 'none'},
+                            {'varname' : 'married', 'response' : 'yes'},
+                            {'varname' : 'bias', 'response' : '1'},
+                            {'varname' : 'level_category', 'response' : 'hard_science_interesting'}]}]
+
+
+def temporary_directory(test):
+    """Returns a new directory that is removed after test."""
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory)
+    return directory
+
+
+def open_test_database(test, directory=None):
+    """Opens the SQLite database 'test' in directory, by default in a temporary
+       directory. The database is closed after test."""
+    database = storage.open_database('test', 'sqlite', path=directory or temporary_directory(test))
+    test.addCleanup(database.close)
+    return database
+
+
+def open_mongomock_database():
+    """Returns a MongoDB engine on an in-memory mongomock database."""
+    import mongomock
+    return storage.MongoDatabase(mongomock.MongoClient().db)
+
+
+def load_test_survey(database, survey=SURVEY):
+    """Loads survey into a new generation, stores its metadata and activates it.
+       Returns the survey controller and the GenerationalDatabase of database."""
+    survey_controller = controllers.SurveyController(database)
+    db = controllers.GenerationalDatabase(database, survey_controller)
+    xmltask_controller = controllers.XMLTaskController(db)
+    generation = survey_controller.create_generation()
+    ctypes, tasks, hits = xmltask_controller.load(db.pinned(generation), xmltask_controller.read_survey(survey))
+    survey_controller.create_metadata(ctypes, tasks, hits, generation)
+    survey_controller.activate(generation)
+    return survey_controller, db
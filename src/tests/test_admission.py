@@ -0,0 +1,89 @@
+# Checks that the admission limiter of the worker endpoints queues requests up to its
+# limits and sheds the others at once with a Retry-After.
+
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import tornado.testing
+import tornado.web
+import handlers
+import helpers
+
+
+class TestAdmissionLimiter(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.metrics = helpers.Metrics()
+        self.limiter = helpers.AdmissionLimiter('view', self.metrics, concurrency=1, queue=1,
+                                                deadline=0.2, retry_after=3.0)
+
+    @tornado.testing.gen_test
+    async def test_queue(self):
+        await self.limiter.acquire()
+        waiting = asyncio.ensure_future(self.limiter.acquire())
+        await asyncio.sleep(0)
+        with self.assertRaises(helpers.Overloaded) as shed:
+            await self.limiter.acquire()
+        self.assertEqual(shed.exception.retry_after, 3.0)
+        self.assertFalse(waiting.done())
+        self.limiter.release()
+        await waiting
+        self.assertEqual(self.limiter.active, 1)
+        self.limiter.release()
+        self.assertEqual(self.limiter.active, 0)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['admission_view_shed'], 1)
+        self.assertEqual(snapshot['admission_view_wait_seconds']['count'], 2)
+
+    @tornado.testing.gen_test
+    async def test_deadline(self):
+        with self.assertRaises(helpers.Overloaded):
+            await self.limiter.acquire(waited=0.5)
+        await self.limiter.acquire()
+        with self.assertRaises(helpers.Overloaded):
+            await self.limiter.acquire(waited=0.1)
+        self.assertEqual(len(self.limiter.waiters), 0)
+        # the slot is free again for the next request
+        self.limiter.release()
+        await self.limiter.acquire()
+        self.assertEqual(self.metrics.snapshot()['admission_view_shed'], 2)
+
+
+class SlowHandler(handlers.BaseHandler):
+    admission_endpoint = 'view'
+    async def post(self):
+        await asyncio.sleep(0.3)
+        self.return_json({})
+
+
+class TestAdmission(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        app = tornado.web.Application([(r'/slow', SlowHandler)])
+        app.metrics = helpers.Metrics()
+        app.admission = {'view' : helpers.AdmissionLimiter('view', app.metrics, concurrency=1, queue=0,
+                                                           deadline=1.0, retry_after=1.5)}
+        return app
+
+    @tornado.testing.gen_test
+    async def test_overloaded(self):
+        first = self.http_client.fetch(self.get_url('/slow'), method='POST', body='')
+        while not self._app.admission['view'].active:
+            await asyncio.sleep(0.01)
+        second = await self.http_client.fetch(self.get_url('/slow'), method='POST', body='', raise_error=False)
+        self.assertEqual(second.code, 503)
+        self.assertEqual(second.headers['Retry-After'], '2')
+        self.assertEqual(json.loads(second.body), {'error' : True, 'explanation' : 'overloaded', 'retry_after' : 1.5})
+        self.assertEqual((await first).code, 200)
+        self.assertEqual(self._app.admission['view'].active, 0)
+
+    @tornado.testing.gen_test
+    async def test_upload_shed(self):
+        self._app.add_handlers('.*', [(r'/HIT/upload', handlers.ImageUploadHandler)])
+        self._app.admission['upload'] = helpers.AdmissionLimiter('upload', self._app.metrics, concurrency=0, queue=0)
+        response = await self.http_client.fetch(self.get_url('/HIT/upload'), method='POST', body=b'x' * 1024,
+                                                headers={'Content-Type' : 'image/png'}, raise_error=False)
+        self.assertEqual(response.code, 503)
+        self.assertEqual(self._app.metrics.snapshot()['admission_upload_shed'], 1)
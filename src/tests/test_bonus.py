@@ -0,0 +1,98 @@
+# Checks that the bonus computed task by task in worker processes is the bonus of the
+# sequential computation over all tasks, and that the dry run reports it without writing
+# to the database.
+
+import copy
+import datetime
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import tornado.testing
+import bonus_dryrun
+import controllers
+import helpers
+from tests import RESPONSE, load_test_survey, open_test_database, temporary_directory
+
+
+def response(age, married):
+    r = copy.deepcopy(RESPONSE)
+    r[0]['responses'][0]['response'] = age
+    r[0]['responses'][2]['response'] = married
+    return r
+
+
+class TestBonus(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = temporary_directory(self)
+        self.storage_config = {'engine' : 'sqlite', 'path' : directory}
+        self.survey_controller, self.db = load_test_survey(open_test_database(self, directory))
+        self.cresponse_controller = controllers.CResponseController(self.db)
+        answers = {'W1' : ('30', 'yes'), 'W2' : ('30', 'no'), 'W3' : ('41', 'yes'), 'W4' : ('30', 'yes')}
+        hits = {'1' : ['W1', 'W2'], '2' : ['W3'], '3' : ['W4']}
+        for hitid, workers in hits.items():
+            for workerid in workers:
+                self.db.chits.add_completed(hitid, {'worker_id' : workerid, 'turk_verify_code' : workerid})
+                for taskid in self.db.chits.get(hitid)['tasks']:
+                    self.cresponse_controller.create({'submitted' : datetime.datetime.utcnow(),
+                                                      'response' : response(*answers[workerid]),
+                                                      'workerid' : workerid, 'hitid' : hitid, 'taskid' : taskid})
+        self.metrics = helpers.Metrics()
+
+    @tornado.testing.gen_test(timeout=60)
+    async def test_compute(self):
+        metadata = self.survey_controller.get_metadata()
+        expected = helpers.calculate_worker_bonus_info(metadata['max_bonus_points'],
+                                                       self.cresponse_controller.getBonusDetails(
+                                                           metadata, controllers.CTypeController(self.db),
+                                                           controllers.SetController(self.db)),
+                                                       metadata['crosswalk'])
+        bonus_controller = controllers.BonusController(self.db, self.survey_controller, self.metrics, 'test',
+                                                       self.storage_config, workers=2, chunks_per_worker=1)
+        self.assertEqual(len(bonus_controller.chunks(list(metadata['task_modules']))), 2)
+        worker_bonus_info = await bonus_controller.compute()
+        self.assertEqual(sorted(worker_bonus_info), ['W1', 'W2', 'W3', 'W4'])
+        for workerid, info in expected.items():
+            self.assertEqual(sorted(worker_bonus_info[workerid]['exp']), sorted(info['exp']))
+            for key in ('pct', 'earn', 'poss', 'rawpct', 'best', 'worst'):
+                self.assertAlmostEqual(worker_bonus_info[workerid][key], info[key])
+        self.assertEqual(self.metrics.snapshot()['bonus_workers'], 4)
+
+    @tornado.testing.gen_test
+    async def test_no_tasks(self):
+        bonus_controller = controllers.BonusController(self.db, self.survey_controller, self.metrics, 'test',
+                                                       self.storage_config)
+        metadata = dict(self.survey_controller.get_metadata(), task_modules={})
+        self.assertEqual(await bonus_controller.compute(metadata), {})
+
+    def test_metadata_not_stored(self):
+        generation = self.survey_controller.get_generation()
+        metadata = self.survey_controller.get_metadata()
+        # as for a survey uploaded before the metadata was stored
+        self.db.survey.remove('metadata:' + generation)
+        self.assertEqual(self.survey_controller.get_metadata(store=False), metadata)
+        self.assertIsNone(self.db.survey.get('metadata:' + generation))
+        self.assertEqual(self.survey_controller.get_metadata(), metadata)
+        self.assertIsNotNone(self.db.survey.get('metadata:' + generation))
+
+    @tornado.testing.gen_test(timeout=60)
+    async def test_dry_run(self):
+        self.db.mturkconnections.update({'bonus' : 2.0})
+        self.db.paid_bonus.insert({'workerid' : 'W1', 'amount' : 2.0})
+        summary, worker_bonus_info = await bonus_dryrun.dry_run('test', self.storage_config, workers=2)
+        self.assertEqual(summary['workers'], 4)
+        self.assertEqual({w : info['amount'] for w, info in worker_bonus_info.items()},
+                         {'W1' : 1.5, 'W2' : 1.0, 'W3' : 0.25, 'W4' : 0.75})
+        self.assertEqual(summary['payout']['total'], 3.5)
+        self.assertEqual(summary['payout']['unpaid'], 2.0)
+        self.assertEqual(self.db.bonus_info.count(), 0)
+
+        output = os.path.join(self.storage_config['path'], 'bonus.jsonl')
+        bonus_dryrun.write_results(output, summary, worker_bonus_info)
+        with open(output) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[0]['payout'], summary['payout'])
+        self.assertEqual([line['workerid'] for line in lines[1:]], ['W1', 'W2', 'W3', 'W4'])
+        self.assertEqual(lines[2]['amount'], 1.0)
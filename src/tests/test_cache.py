@@ -0,0 +1,103 @@
+# Tests of the payloads cached per survey generation: helpers.GenerationCache and
+# the documents served by hash or name with ETags (handlers.DocumentViewHandler).
+
+import gzip
+import unittest
+
+import tornado.testing
+import tornado.web
+
+import controllers
+import handlers
+import helpers
+from tests import open_mongomock_database
+
+
+class GenerationCacheTest(unittest.TestCase):
+    def test_get(self):
+        cache = helpers.GenerationCache(max_entries=2)
+        calls = []
+        def compute(value):
+            return lambda : calls.append(value) or value
+        self.assertEqual(cache.get('g1', 'a', compute(1)), 1)
+        self.assertEqual(cache.get('g1', 'a', compute(2)), 1)
+        self.assertEqual(calls, [1])
+        # a new generation empties the cache
+        self.assertEqual(cache.get('g2', 'a', compute(3)), 3)
+        self.assertEqual(calls, [1, 3])
+
+    def test_lru(self):
+        cache = helpers.GenerationCache(max_entries=2)
+        cache.get('g1', 'a', lambda : 1)
+        cache.get('g1', 'b', lambda : 2)
+        cache.get('g1', 'a', lambda : None)
+        cache.get('g1', 'c', lambda : 3)
+        # b was the least recently used entry
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertEqual(cache.get('g1', 'b', lambda : 4), 4)
+
+
+class DocumentViewTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        # the legacy documents of test_legacy only exist on MongoDB
+        db = open_mongomock_database()
+        application = tornado.web.Application([(r'/document/(.+)', handlers.DocumentViewHandler)])
+        application.survey_controller = controllers.SurveyController(db, ttl=0.0)
+        application.payload_cache = helpers.GenerationCache()
+        application.cdocument_controller = controllers.CDocumentController(db)
+        application.survey_controller.activate(application.survey_controller.create_generation())
+        application.cdocument_controller.create('small', '<p>small</p>')
+        application.cdocument_controller.create('large', '<p>%s</p>' % ('large ' * 1000))
+        self.application = application
+        return application
+
+    def test_etag(self):
+        response = self.fetch('/document/small')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b'<p>small</p>')
+        etag = response.headers['Etag']
+        response = self.fetch('/document/small', headers={'If-None-Match' : etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b'')
+        self.assertEqual(self.fetch('/document/unknown').code, 404)
+
+    def test_gzip(self):
+        response = self.fetch('/document/large', decompress_response=False,
+                              headers={'Accept-Encoding' : 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.body), b'<p>%s</p>' % (b'large ' * 1000))
+        plain = self.fetch('/document/large', decompress_response=False)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        # the two encodings must not share an ETag
+        self.assertNotEqual(plain.headers['Etag'], response.headers['Etag'])
+        response = self.fetch('/document/large', decompress_response=False,
+                              headers={'Accept-Encoding' : 'gzip', 'If-None-Match' : response.headers['Etag']})
+        self.assertEqual(response.code, 304)
+
+    def test_hash(self):
+        response = self.fetch('/document/small', decompress_response=False)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        document = self.application.cdocument_controller.get_hashes(['small'])['small']
+        self.assertEqual(response.headers['Etag'], '"%s"' % document)
+        response = self.fetch('/document/' + document)
+        self.assertEqual(response.body, b'<p>small</p>')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+    def test_legacy(self):
+        # a document stored by name, before documents were stored by hash
+        self.application.cdocument_controller.db.cdocs.collection.insert({'name' : 'old', 'content' : '<p>old</p>'})
+        self.assertEqual(self.fetch('/document/old').body, b'<p>old</p>')
+
+    def test_new_generation(self):
+        etag = self.fetch('/document/small').headers['Etag']
+        # a new survey replaces the documents
+        self.application.survey_controller.activate(self.application.survey_controller.create_generation())
+        self.application.cdocument_controller.db.drop_collection('cdocs')
+        self.application.cdocument_controller.create('small', '<p>changed</p>')
+        response = self.fetch('/document/small', headers={'If-None-Match' : etag})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b'<p>changed</p>')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# Tests of the assignment of cHITs whose workers stopped pinging,
+# CHITController.get_stale_chit, and of reading cHITs with a projection into the
+# slotted CHIT model.
+
+import datetime
+import unittest
+
+from controllers import CHITController
+from models import CHIT
+from tests import open_test_database
+
+
+class StaleChitTest(unittest.TestCase):
+    def setUp(self):
+        self.db = open_test_database(self)
+        self.chit_controller = CHITController(self.db)
+        for hitid, exclusions in (('H1', []), ('H2', ['H9']), ('H3', []), ('H4', [])):
+            self.chit_controller.create({'hitid' : hitid, 'tasks' : ['t1'], 'exclusions' : exclusions})
+        self.chit_controller.add_completed_hit(chit=self.chit_controller.get_chit_by_id('H3'), worker_id='W3')
+
+    def ping(self, hitid, seconds_ago):
+        self.db.workerpings.ping(hitid, datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds_ago))
+
+    def test_none(self):
+        self.assertIsNone(self.chit_controller.get_stale_chit())
+        self.ping('H1', 10)
+        self.assertIsNone(self.chit_controller.get_stale_chit())
+
+    def test_oldest(self):
+        self.ping('H1', 60)
+        self.ping('H2', 120)
+        self.ping('H4', 10)
+        self.assertEqual(self.chit_controller.get_stale_chit(), 'H2')
+        self.assertEqual(self.chit_controller.get_stale_chit(stale_seconds=90.0), 'H2')
+        self.assertIsNone(self.chit_controller.get_stale_chit(stale_seconds=180.0))
+
+    def test_skipped(self):
+        # completed cHITs, excluded cHITs and pings of cHITs of another survey are skipped
+        self.ping('H3', 300)
+        self.ping('H5', 240)
+        self.ping('H2', 120)
+        self.ping('H1', 60)
+        self.assertEqual(self.chit_controller.get_stale_chit(), 'H2')
+        self.assertEqual(self.chit_controller.get_stale_chit(exclusions=['H9']), 'H1')
+
+
+class DeserializeTest(unittest.TestCase):
+    def setUp(self):
+        self.chit_controller = CHITController(open_test_database(self))
+        self.chit_controller.create({'hitid' : 'H1', 'tasks' : ['t1', 't2'], 'exclusions' : ['H2'],
+                                     'taskconditions' : [None, 'q1==1']})
+        self.chit_controller.add_completed_hit(chit=self.chit_controller.get_chit_by_id('H1'), worker_id='W1')
+
+    def test_full(self):
+        chit = self.chit_controller.get_chit_by_id('H1')
+        self.assertFalse(hasattr(chit, '__dict__'))
+        d = chit.serialize()
+        self.assertEqual([c['worker_id'] for c in d.pop('completed_hits')], ['W1'])
+        self.assertEqual(d, {'hitid' : 'H1', 'tasks' : ['t1', 't2'], 'taskconditions' : [None, 'q1==1'],
+                             'exclusions' : ['H2'], 'num_completed_hits' : 1})
+        # fields unknown to the model, like _id, are ignored
+        self.assertEqual(CHIT.deserialize({'_id' : 1, 'hitid' : 'H3'}).hitid, 'H3')
+
+    def test_fields(self):
+        chit = self.chit_controller.get_chit_by_id('H1', CHIT.view_fields)
+        self.assertEqual((chit.hitid, chit.tasks, chit.taskconditions), ('H1', ['t1', 't2'], [None, 'q1==1']))
+        # the fields that were not read stay unset
+        with self.assertRaises(AttributeError):
+            chit.completed_hits
+        with self.assertRaises(AttributeError):
+            chit.other = 1
+        # a field missing from the document is None
+        self.assertIsNone(CHIT.deserialize({'hitid' : 'H3'}, CHIT.view_fields).tasks)
+        self.assertIsNone(self.chit_controller.get_chit_by_id('H9', CHIT.view_fields))
+
+
+if __name__ == '__main__':
+    unittest.main()
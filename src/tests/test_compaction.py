@@ -0,0 +1,114 @@
+# Checks that the event log, chitloads, pings and worker statuses stay bounded: the
+# indexed event queries, the compaction, its removal of unused images and its
+# metrics.
+
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import controllers
+import helpers
+from helpers import metrics_machine
+from tests import open_mongomock_database, open_test_database, temporary_directory
+
+
+class TestCompaction(unittest.TestCase):
+    def setUp(self):
+        self.database = open_test_database(self)
+        self.db = controllers.GenerationalDatabase(self.database, controllers.SurveyController(self.database))
+        self.event_controller = controllers.EventController(self.db)
+        self.chit_controller = controllers.CHITController(self.db)
+        self.currentstatus_controller = controllers.CurrentStatusController(self.db)
+        self.workerping_controller = controllers.WorkerPingController(self.db)
+        self.metrics = helpers.Metrics()
+        self.compaction_controller = self.compaction()
+
+    def compaction(self, **kwargs):
+        return controllers.CompactionController(self.db, self.event_controller, self.chit_controller,
+                                                self.currentstatus_controller, self.workerping_controller,
+                                                self.metrics, max_events=3, abandoned_seconds=3600.0, **kwargs)
+
+    def ago(self, **kwargs):
+        return datetime.datetime.utcnow() - datetime.timedelta(**kwargs)
+
+    def test_events(self):
+        for i in range(5):
+            self.db.events.insert({'date' : datetime.datetime(2026, 1, 1, 12, i), 'event' : 'e%d' % i})
+        self.assertEqual([e['event'] for e in self.event_controller.get_events(2)], ['e3', 'e4'])
+        self.assertEqual(len(self.event_controller.get_events()), 5)
+        self.assertEqual(self.event_controller.trim(3), 2)
+        self.assertEqual([e['event'] for e in self.event_controller.get_events()], ['e2', 'e3', 'e4'])
+        self.assertEqual(self.event_controller.trim(3), 0)
+
+    def test_abandoned(self):
+        self.currentstatus_controller.create_or_update(workerid='W1', hitid='1', taskindex=0)
+        self.currentstatus_controller.create_or_update(workerid='W2', hitid='2', taskindex=0)
+        self.db.currentstatus.put('W1', '1', 0, self.ago(hours=2))
+        for hitid in ('1', '2', '3'):
+            self.db.workerpings.ping(hitid, self.ago(hours=2))
+        self.db.chitloads.insert({'workerid' : 'W1', 'hitid' : '1', 'time' : self.ago(days=8)})
+        self.db.chitloads.insert({'workerid' : 'W2', 'hitid' : '2', 'time' : self.ago(days=1)})
+        self.event_controller.add_event("Uploaded")
+        removed = self.compaction_controller.compact()
+        self.assertEqual(removed, {'events' : 0, 'chitloads' : 1, 'currentstatus' : 1, 'workerpings' : 2})
+        self.assertEqual(self.currentstatus_controller.outstanding_hits(), ['2'])
+        # the ping of the cHIT held by W2 is kept, so that it still becomes stale
+        self.assertEqual(self.db.workerpings.count(), 1)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['compaction_removed_workerpings'], 2)
+        self.assertEqual(snapshot['documents_events'], 1)
+        self.assertEqual(snapshot['documents_chitloads'], 1)
+        self.assertEqual(snapshot['compaction_seconds']['count'], 1)
+
+    def test_abandoned_before_updated(self):
+        # statuses stored before they recorded the time
+        database = open_mongomock_database()
+        database.currentstatus.collection.insert({'workerid' : 'W1', 'hitid' : '1', 'taskindex' : 0})
+        currentstatus_controller = controllers.CurrentStatusController(database)
+        self.assertEqual(currentstatus_controller.remove_abandoned(3600.0), 0)
+        self.assertGreater(database.currentstatus.collection.find_one({'workerid' : 'W1'})['updated'],
+                           self.ago(minutes=1))
+
+    def test_images(self):
+        cimage_controller = controllers.CImageController(self.database, storage="filesystem",
+                                                         path=temporary_directory(self),
+                                                         upload_seconds=3600.0)
+        compaction_controller = self.compaction(cresponse_controller=controllers.CResponseController(self.db),
+                                                cimage_controller=cimage_controller)
+        used, orphan, fresh = [cimage_controller.create(b'image %d' % i, 'image/png') for i in range(3)]
+        self.db.cresponses.insert({'submitted' : self.ago(hours=1), 'workerid' : 'W1', 'hitid' : '1', 'taskid' : 't1',
+                                   'response' : [], 'images' : [used]})
+        old = (self.ago(hours=2) - datetime.datetime(1970, 1, 1)).total_seconds()
+        for ref in (used, orphan):
+            os.utime(os.path.join(cimage_controller.path, ref[len('file:'):]), (old, old))
+        self.assertEqual(compaction_controller.compact()['images'], 1)
+        self.assertEqual(sorted(os.listdir(cimage_controller.path)),
+                         sorted(ref[len('file:'):] for ref in (used, fresh)))
+        self.assertEqual(self.metrics.snapshot()['compaction_removed_images'], 1)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = metrics_machine.Histogram(bounds=(1, 2, 5))
+        self.assertIsNone(histogram.quantile(0.5))
+        for value in (0.5, 0.5, 1.5, 4, 9):
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.4), 1)
+        self.assertEqual(histogram.quantile(0.6), 2)
+        self.assertEqual(histogram.quantile(0.99), 9)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 5)
+        self.assertEqual(snapshot['buckets'], [[1, 2], [2, 1], [5, 1], ['inf', 1]])
+
+    def test_registry(self):
+        metrics = helpers.Metrics()
+        self.assertIs(metrics.counter('shed'), metrics.counter('shed'))
+        metrics.counter('shed').inc()
+        metrics.gauge('size').set(3)
+        self.assertEqual(metrics.snapshot(), {'shed' : 1, 'size' : 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
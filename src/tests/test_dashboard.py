@@ -0,0 +1,115 @@
+# Checks that the dashboard aggregator reads the run status once for all admins and
+# keeps it current from the handler hooks between the resyncs.
+
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import tornado.testing
+import controllers
+from tests import load_test_survey, open_test_database
+
+
+class TestDashboard(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        survey_controller, db = load_test_survey(open_test_database(self))
+        self.chit_controller = controllers.CHITController(db)
+        self.cresponse_controller = controllers.CResponseController(db)
+        self.currentstatus_controller = controllers.CurrentStatusController(db)
+        self.event_controller = controllers.EventController(db)
+        self.event_controller.add_event("Uploaded: test_xml_1.xml")
+        self.dashboard = controllers.DashboardController(self.chit_controller, self.cresponse_controller,
+                                                         self.currentstatus_controller, self.event_controller)
+        self.reads = 0
+        read_state = self.dashboard.read_state
+        def counted():
+            self.reads += 1
+            return read_state()
+        self.dashboard.read_state = counted
+
+    @tornado.testing.gen_test
+    async def test_fan_out(self):
+        first, second = [], []
+        await self.dashboard.refresh()
+        self.assertEqual(self.reads, 0)
+        self.assertIsNone(self.dashboard.subscribe(first.append))
+        self.dashboard.subscribe(second.append)
+        await self.dashboard.refresh()
+        await self.dashboard.refresh()
+        self.assertEqual(self.reads, 1)
+        self.assertEqual(len(first), 1)
+        self.assertIs(first[0], second[0])
+        status = json.loads(first[0])
+        self.assertEqual(status['hitinfo'], {'num_completed_hits' : 0, 'num_hits' : 3, 'num_tasks' : 4,
+                                             'num_completed_tasks' : 0})
+        self.assertEqual(status['events'][0]['event'], "Uploaded: test_xml_1.xml")
+        self.assertEqual(json.loads(self.dashboard.subscribe([].append)), status)
+
+    @tornado.testing.gen_test
+    async def test_hooks(self):
+        messages = []
+        self.dashboard.subscribe(messages.append)
+        await self.dashboard.refresh()
+        self.dashboard.hit_taken('W1', '1')
+        self.dashboard.hit_taken('W2', '2')
+        self.dashboard.response_submitted()
+        await self.dashboard.refresh()
+        status = json.loads(messages[-1])
+        self.assertEqual(status['hitstatus'], {'outstanding' : ['1', '2'], 'completed' : []})
+        self.assertEqual(status['hitinfo']['num_completed_tasks'], 1)
+        self.dashboard.hit_completed('1')
+        self.dashboard.hit_released('W1')
+        await self.dashboard.refresh()
+        status = json.loads(messages[-1])
+        self.assertEqual(status['hitstatus'], {'outstanding' : ['2'], 'completed' : ['1']})
+        self.assertEqual(status['hitinfo']['num_completed_hits'], 1)
+        self.assertEqual(len(messages), 3)
+        await self.dashboard.refresh()
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(self.reads, 1)
+
+    @tornado.testing.gen_test
+    async def test_hooks_during_resync(self):
+        messages = []
+        self.dashboard.subscribe(messages.append)
+        await self.dashboard.refresh()
+        read_state = self.dashboard.read_state
+        io_loop = self.io_loop
+        def slow():
+            # a worker takes a cHIT and submits while the status is being read
+            io_loop.add_callback(self.dashboard.hit_taken, 'W1', '1')
+            io_loop.add_callback(self.dashboard.response_submitted)
+            time.sleep(0.1)
+            return read_state()
+        self.dashboard.read_state = slow
+        self.dashboard.resynced -= self.dashboard.resync_seconds
+        await self.dashboard.refresh()
+        status = json.loads(messages[-1])
+        self.assertEqual(status['hitstatus']['outstanding'], ['1'])
+        self.assertEqual(status['hitinfo']['num_completed_tasks'], 1)
+        self.assertIsNone(self.dashboard.pending)
+
+    @tornado.testing.gen_test
+    async def test_resync(self):
+        messages = []
+        self.dashboard.subscribe(messages.append)
+        await self.dashboard.refresh()
+        # changes made by another server process
+        self.currentstatus_controller.create_or_update(workerid='W3', hitid='3', taskindex=0)
+        self.cresponse_controller.create({'submitted' : datetime.datetime.utcnow(), 'response' : [],
+                                          'workerid' : 'W3', 'hitid' : '3', 'taskid' : '1'})
+        self.dashboard.resynced -= self.dashboard.resync_seconds
+        await self.dashboard.refresh()
+        status = json.loads(messages[-1])
+        self.assertEqual(status['hitstatus']['outstanding'], ['3'])
+        self.assertEqual(status['hitinfo']['num_completed_tasks'], 1)
+        self.assertEqual(self.reads, 2)
+        # the status is dropped once nobody watches
+        self.dashboard.unsubscribe(messages.append)
+        await self.dashboard.refresh()
+        self.assertIsNone(self.dashboard.state)
+        self.dashboard.response_submitted()
@@ -0,0 +1,115 @@
+# Checks the response exports: the tab-separated question responses, the
+# incremental export and the long and wide Parquet tables, which are skipped
+# without pyarrow.
+
+import csv
+import datetime
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import controllers
+from helpers import export_machine
+from tests import open_test_database
+
+
+def responses(i):
+    return [{'name' : 'm1', 'responses' : [{'varname' : 'q1', 'response' : 'Zürich %d' % i},
+                                           {'varname' : 'q2', 'response' : None}]},
+            {'name' : 'm2', 'responses' : [{'varname' : 'q1', 'response' : ['a', 'b']}]}]
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.db = open_test_database(self)
+        self.controller = controllers.CResponseController(self.db)
+        for i in range(6):
+            self.controller.create({'submitted' : datetime.datetime(2026, 1, 1, 12, i),
+                                    'workerid' : 'W%d' % (i % 3), 'hitid' : 'h%d' % (i % 2),
+                                    'taskid' : 't%d' % i, 'response' : responses(i)})
+
+    def test_tsv(self):
+        output = io.StringIO()
+        self.controller.write_question_responses_to_csv(csv.writer(output, delimiter='\t'),
+                                                        completed_workers=['W0', 'W1'])
+        rows = list(csv.reader(io.StringIO(output.getvalue()), delimiter='\t'))
+        self.assertEqual(rows[0], ['hitid', 'taskid', 'workerid', 'module', 'varname', 'response'])
+        self.assertEqual(len(rows), 1 + 4 * 3)
+        self.assertEqual(rows[1], ['h0', 't0', 'W0', 'm1', 'q1', 'Zürich 0'])
+        self.assertEqual(rows[2], ['h0', 't0', 'W0', 'm1', 'q2', ''])
+        self.assertEqual(rows[3], ['h0', 't0', 'W0', 'm2', 'q1', '["a", "b"]'])
+
+    def test_incremental(self):
+        controller = controllers.CResponseController(self.db, settle_seconds=0)
+        # responses submitted at the same time are ordered by their key
+        for i in range(3):
+            controller.create({'submitted' : datetime.datetime(2026, 1, 1, 12, 2), 'workerid' : 'W9',
+                               'hitid' : 'h9', 'taskid' : 'tie%d' % i, 'response' : []})
+        seen = []
+        token = None
+        while True:
+            responses, token = controller.responses_since(token, limit=4)
+            seen.extend(d['taskid'] for d in responses)
+            if len(responses) < 4:
+                break
+        self.assertEqual(seen, ['t0', 't1', 't2', 'tie0', 'tie1', 'tie2', 't3', 't4', 't5'])
+        self.assertEqual(controller.responses_since(token), ([], token))
+        controller.create({'submitted' : datetime.datetime(2026, 1, 1, 12, 9), 'workerid' : 'W9',
+                           'hitid' : 'h9', 'taskid' : 'late', 'response' : []})
+        responses, token = controller.responses_since(token)
+        self.assertEqual([d['taskid'] for d in responses], ['late'])
+
+    def test_incremental_settles(self):
+        controller = controllers.CResponseController(self.db, settle_seconds=60)
+        controller.create({'submitted' : datetime.datetime.utcnow(), 'workerid' : 'W9',
+                           'hitid' : 'h9', 'taskid' : 'now', 'response' : []})
+        responses, token = controller.responses_since(None)
+        self.assertNotIn('now', [d['taskid'] for d in responses])
+        self.assertEqual(len(responses), 6)
+        with self.assertRaises(ValueError):
+            controller.responses_since('not a token')
+        # a token of a replaced survey starts the export over
+        other = controllers.CResponseController.decode_token(token)
+        other['collection'] = 'cresponses_old'
+        self.assertEqual(len(controller.responses_since(controllers.CResponseController.encode_token(other))[0]), 6)
+        # a change stream position is continued from its watermark without a replica set
+        other['collection'] = 'cresponses'
+        other['resume'] = {'_data' : '00'}
+        self.assertEqual(controller.responses_since(controllers.CResponseController.encode_token(other)), ([], token))
+
+    @unittest.skipIf(export_machine.pyarrow is None, "pyarrow is not installed")
+    def test_parquet(self):
+        import pyarrow.parquet
+        sink = io.BytesIO()
+        self.controller.write_question_responses_to_parquet(sink, completed_workers=['W0', 'W1'])
+        table = pyarrow.parquet.read_table(io.BytesIO(sink.getvalue()))
+        self.assertEqual(table.num_rows, 4 * 3)
+        self.assertEqual(str(table.schema.field('workerid').type), 'dictionary<values=string, indices=int32, ordered=0>')
+        self.assertEqual(table.slice(0, 1).to_pylist(),
+                         [{'hitid' : 'h0', 'taskid' : 't0', 'workerid' : 'W0',
+                           'submitted' : datetime.datetime(2026, 1, 1, 12, 0),
+                           'module' : 'm1', 'varname' : 'q1', 'response' : 'Zürich 0'}])
+
+    @unittest.skipIf(export_machine.pyarrow is None, "pyarrow is not installed")
+    def test_wide_parquet(self):
+        import pyarrow.parquet
+        sink = io.BytesIO()
+        self.controller.write_wide_question_responses_to_parquet(sink, completed_workers=['W2'])
+        table = pyarrow.parquet.read_table(io.BytesIO(sink.getvalue()))
+        self.assertEqual(table.column_names, ['hitid', 'taskid', 'workerid', 'submitted', 'm1.q1', 'm1.q2', 'm2.q1'])
+        self.assertEqual(table.column('taskid').to_pylist(), ['t2', 't5'])
+        self.assertEqual(table.column('m1.q1').to_pylist(), ['Zürich 2', 'Zürich 5'])
+        self.assertEqual(table.column('m1.q2').to_pylist(), [None, None])
+
+    @unittest.skipIf(export_machine.pyarrow is None, "pyarrow is not installed")
+    def test_batches(self):
+        schema = export_machine.long_schema()
+        rows = list(self.controller.question_responses(['W0', 'W1', 'W2']))
+        batches = list(export_machine.record_batches(rows, schema, batch_size=5))
+        self.assertEqual([b.num_rows for b in batches], [5, 5, 5, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
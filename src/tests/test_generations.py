@@ -0,0 +1,176 @@
+# Tests of the survey generations: loading a survey into a staging generation
+# (XMLTaskController.read_survey and load), the compare-and-set in
+# SurveyController.activate and the dropping of retired generations in
+# SurveyController.collect_garbage, and appending to the live generation
+# through /admin/xmlupload (handlers.XMLUploadHandler).
+
+import os
+import unittest
+
+import tornado.escape
+import tornado.testing
+import tornado.web
+
+import controllers
+import handlers
+import Settings
+from controllers import GenerationalDatabase, SurveyController, XMLTaskController
+from tests import SURVEY, open_test_database
+
+# a task showing content1.html, which only the running survey contains
+APPENDED = b"""<xml>
+  <tasks><task><content>content1.html</content><taskid>3</taskid><modules>demographics</modules></task></tasks>
+  <hits><hit><hitid>4</hitid><tasks>3</tasks></hit></hits>
+</xml>"""
+
+
+class Interleaved(object):
+    """The survey repository of another process: before_get runs once, after the
+       pointer was read and before the caller acts on it."""
+    def __init__(self, repository, before_get):
+        self.repository = repository
+        self.before_get = before_get
+    def get(self, key):
+        d = self.repository.get(key)
+        if self.before_get is not None:
+            before, self.before_get = self.before_get, None
+            before()
+        return d
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
+
+
+class InterleavedDatabase(object):
+    def __init__(self, database, before_get):
+        self.database = database
+        self.survey = Interleaved(database.survey, before_get)
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+
+class GenerationTest(unittest.TestCase):
+    def setUp(self):
+        self.database = open_test_database(self)
+        self.survey_controller = SurveyController(self.database, ttl=0.0)
+        self.db = GenerationalDatabase(self.database, self.survey_controller)
+
+    def load(self):
+        generation = self.survey_controller.create_generation()
+        survey = XMLTaskController(self.db).read_survey(SURVEY)
+        ctypes, tasks, hits = XMLTaskController(self.db).load(self.db.pinned(generation), survey)
+        self.survey_controller.create_metadata(ctypes, tasks, hits, generation)
+        return generation
+
+    def retired(self):
+        return sorted(r['generation'] for r in self.database.survey.get('current')['retired'])
+
+    def test_load(self):
+        generation = self.load()
+        # the staging generation is not visible before it is activated
+        self.assertEqual(self.survey_controller.get_generation(), '')
+        self.assertEqual(self.db.chits.count(), 0)
+        self.survey_controller.activate(generation)
+        self.assertEqual(self.survey_controller.get_generation(), generation)
+        self.assertEqual(self.db.ctypes.count(), 1)
+        self.assertEqual(self.db.ctasks.ids(), ['1', '2'])
+        self.assertEqual(self.db.chits.count(), 3)
+        self.assertEqual(self.db.chits.name, 'chits_' + generation)
+        # shared collections are not part of a generation
+        self.assertEqual(self.db.mturkconnections.name, 'mturkconnections')
+        self.assertEqual(self.survey_controller.get_metadata()['generation'], generation)
+
+    def test_missing_parts(self):
+        with self.assertRaises(controllers.SurveyError):
+            XMLTaskController(self.db).read_survey(os.path.join(os.path.dirname(__file__), 'test_xml_2.xml'))
+
+    def test_activate(self):
+        self.survey_controller.activate('g1')
+        self.survey_controller.activate('g2')
+        self.assertEqual(self.survey_controller.get_generation(), 'g2')
+        # the plain collections of surveys loaded before generations are retired first
+        self.assertEqual(self.retired(), ['', 'g1'])
+
+    def test_activate_race(self):
+        self.survey_controller.activate('g1')
+        other = SurveyController(self.database)
+        # another process activates g3 after this one read the pointer to g1
+        survey_controller = SurveyController(InterleavedDatabase(self.database, lambda : other.activate('g3')))
+        survey_controller.activate('g2')
+        self.assertEqual(self.survey_controller.get_generation(), 'g2')
+        # neither g1 nor g3 is lost, so both are dropped later
+        self.assertEqual(self.retired(), ['', 'g1', 'g3'])
+
+    def test_first_activate_race(self):
+        other = SurveyController(self.database)
+        survey_controller = SurveyController(InterleavedDatabase(self.database, lambda : other.activate('g1')))
+        survey_controller.activate('g2')
+        self.assertEqual(self.survey_controller.get_generation(), 'g2')
+        self.assertEqual(self.retired(), ['', 'g1'])
+
+    def test_collect_garbage(self):
+        # a survey loaded before generations were introduced
+        self.database.chits.insert_many([{'hitid' : 'old', 'tasks' : [], 'exclusions' : []}])
+        self.database.mturkconnections.update({'hitpayment' : 1.0})
+        first = self.load()
+        self.survey_controller.activate(first)
+        second = self.load()
+        self.survey_controller.activate(second)
+        self.survey_controller.collect_garbage()
+        # the generations were retired less than gc_delay seconds ago
+        self.assertIn('chits', self.database.collection_names())
+        self.assertIn('chits_' + first, self.database.collection_names())
+        self.survey_controller.gc_delay = 0.0
+        self.survey_controller.collect_garbage()
+        names = self.database.collection_names()
+        self.assertNotIn('chits', names)
+        self.assertNotIn('chits_' + first, names)
+        self.assertIn('chits_' + second, names)
+        self.assertIn('mturkconnections', names)
+        self.assertEqual(self.retired(), [])
+        self.assertIsNone(self.database.survey.get('metadata:' + first))
+        self.assertIsNotNone(self.database.survey.get('metadata:' + second))
+        self.assertEqual(self.db.chits.count(), 3)
+
+
+class AppendTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        database = open_test_database(self)
+        application = tornado.web.Application([(r'/admin/xmlupload/?', handlers.XMLUploadHandler)])
+        application.survey_controller = SurveyController(database, ttl=0.0)
+        application.db = GenerationalDatabase(database, application.survey_controller)
+        application.xmltask_controller = XMLTaskController(application.db)
+        application.event_controller = controllers.EventController(database)
+        self.application = application
+        return application
+
+    def upload(self, body, append):
+        boundary = 'boundary'
+        body = (b'--boundary\r\nContent-Disposition: form-data; name="file"; filename="survey.xml"\r\n\r\n' +
+                body + b'\r\n--boundary--\r\n')
+        response = self.fetch('/admin/xmlupload' + ('?append=1' if append else ''), method='POST', body=body,
+                              headers={'Content-Type' : 'multipart/form-data; boundary=' + boundary})
+        return tornado.escape.json_decode(response.body)
+
+    def test_append(self):
+        before = set(os.listdir(Settings.TMP_PATH))
+        with open(SURVEY, 'rb') as f:
+            self.assertEqual(self.upload(f.read(), False), {'success' : True})
+        self.assertEqual(self.upload(APPENDED, True), {'success' : True, 'appended' : True})
+        db = self.application.db
+        task = db.ctasks.get('3')
+        self.assertIsNone(task['content'])
+        self.assertEqual(task['document'], db.ctasks.get('1')['document'])
+        self.assertEqual(db.chits.get('4')['tasks'], ['3'])
+        self.assertIn('4', self.application.survey_controller.get_metadata()['chit_bonus_points'])
+        # rejected appends leave the survey alone
+        self.assertIn('already part of the running survey', self.upload(APPENDED, True)['error'])
+        # a document that is neither in the file nor live
+        unknown = APPENDED.replace(b'content1', b'unknown').replace(b'>3<', b'>5<').replace(b'>4<', b'>6<')
+        self.assertEqual(self.upload(unknown, True)['error'], 'Error: Document unknown.html of task 5 is not defined.')
+        self.assertIsNone(db.ctasks.get('5'))
+        # the uploaded files are removed
+        self.assertEqual(set(os.listdir(Settings.TMP_PATH)), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# Tests of the process pool that hashes uploaded images, helpers.ImageProcessor:
+# workers that hang or die are replaced and later images are still processed.
+
+import base64
+import io
+import os
+import time
+import unittest
+
+import tornado.testing
+from PIL import Image
+
+from helpers import ImageError, ImageProcessor
+
+
+def data_url(color='red'):
+    image = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(image, 'PNG')
+    return 'data:image/png;base64,' + base64.b64encode(image.getvalue()).decode('ascii')
+
+
+class ImageProcessorTest(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.processor = ImageProcessor(workers=1, timeout=2.0)
+        self.addCleanup(lambda : self.processor.pool[0].shutdown(wait=False))
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_process(self):
+        info = yield self.processor.process_data_url(data_url())
+        self.assertEqual(info['content_type'], 'image/png')
+        self.assertEqual(len(info['hash']), 16)
+        with self.assertRaises(ImageError):
+            yield self.processor.process_data_url('data:image/png;base64,' + base64.b64encode(b'no image').decode())
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_hang(self):
+        pool = self.processor.pool
+        start = time.monotonic()
+        with self.assertRaises(ImageError):
+            yield self.processor.run(time.sleep, 60)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertIsNot(self.processor.pool, pool)
+        # the only worker hung, so this is processed by the new pool
+        info = yield self.processor.process_data_url(data_url())
+        self.assertEqual(info['content_type'], 'image/png')
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_crash(self):
+        pool = self.processor.pool
+        with self.assertRaises(ImageError):
+            yield self.processor.run(os._exit, 1)
+        self.assertIsNot(self.processor.pool, pool)
+        info = yield self.processor.process_data_url(data_url('blue'))
+        self.assertEqual(info['content_type'], 'image/png')
+
+
+if __name__ == '__main__':
+    unittest.main()
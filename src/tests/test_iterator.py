@@ -0,0 +1,87 @@
+# Checks that iterator conditions instantiated from the compiled template encode to
+# the same Lexer as parsing each expanded condition.
+
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import jsonpickle
+from helpers.lexer_machine import Lexer, Status
+from models.xmltask import IteratorCondition, IteratorTemplate, XMLTask, placeholder_pattern
+
+VALUES = ['a', 'b1', 'x y', 'in', 'ins', 'not', 'exists', '=', '!', '"', '(', '1', 'q', 'é', '*', ',', '{', 'set', '']
+CONDITIONS = ['q_{d:k}=="yes"', 'q_{d:k}>=2 & r{e:j}==1', 'exists{q{d:k}}', 'inset{q{d:k},{e:j}}',
+              '(a{d:k}==1|b{e:j}!=2)', 'q1=={d:k}', 'q1=="{d:k}"', '{d:k}==1', 'exists{{d:k}et{x}}',
+              '{d:k}{e:j}==1', 'q{d:k}+r{e:j}>=3', 'q{d:k}==1 & q{e:j}==2', 'notinset{x{d:k},s}',
+              'q1==1', 'q{d:k}{d:k}==1', 'q{d:k}', 'exists{q{d:k}']
+
+
+def expected(text):
+    lex = Lexer()
+    status = Status()
+    if not lex.can_import(text, status):
+        return status.error
+    return jsonpickle.encode(lex)
+
+
+def instantiate(condition, binding):
+    try:
+        return condition.instantiate(binding)
+    except Exception as x:
+        return str(x)
+
+
+class TestIteratorCondition(unittest.TestCase):
+    def test_matches_parsing_each_instance(self):
+        rnd = random.Random(42)
+        for _ in range(2000):
+            text = rnd.choice(CONDITIONS)
+            if rnd.random() < 0.5:
+                text += rnd.choice(['&', '|']) + rnd.choice(CONDITIONS)
+            dimensions = [[{'{d:k}' : rnd.choice(VALUES)} for _ in range(3)],
+                          [{'{e:j}' : rnd.choice(VALUES)} for _ in range(2)]]
+            placeholders = placeholder_pattern(dimensions)
+            try:
+                condition = IteratorCondition(text, placeholders)
+            except Exception as x:
+                self.assertEqual(str(x), expected(text))
+                continue
+            for d in dimensions[0]:
+                for e in dimensions[1]:
+                    binding = dict(d, **e)
+                    expanded = IteratorTemplate(text, placeholders).substitute(binding)
+                    self.assertEqual(instantiate(condition, binding), expected(expanded), expanded)
+
+    def test_template_without_placeholders(self):
+        self.assertEqual(IteratorTemplate("plain text", None).substitute({}), "plain text")
+        self.assertIsNone(IteratorTemplate(None, placeholder_pattern([[{'{d:k}' : 'x'}]])).substitute({}))
+        condition = IteratorCondition('q1==1', None)
+        self.assertEqual(condition.instantiate({}), expected('q1==1'))
+
+    def test_instances_do_not_share_content(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.xml', delete=False) as f:
+            f.write('<xml><modules><module><header>M</header><name>m</name><questions><question>'
+                    '<varname>q_{d:k}</varname><iterator><dimensions><dimension><name>d</name><instances>'
+                    '<instance><kvpairs><kvpair><key>k</key><value>a</value></kvpair></kvpairs></instance>'
+                    '<instance><kvpairs><kvpair><key>k</key><value>b</value></kvpair></kvpairs></instance>'
+                    '</instances></dimension></dimensions></iterator>'
+                    '<condition>exists{q_{d:k}x}</condition>'
+                    '<questiontext>{d:k}?</questiontext><valuetype>categorical</valuetype>'
+                    '<content><categories><category><text>Yes</text><value>yes</value></category></categories></content>'
+                    '</question></questions></module></modules><tasks/><hits/></xml>')
+        self.addCleanup(os.remove, f.name)
+        xmltask = XMLTask(f.name)
+        first, second = xmltask.expand_question(next(xmltask.modules.iter('question')))
+        self.assertEqual((first['varname'], second['varname']), ('q_a', 'q_b'))
+        self.assertEqual(first['condition'], expected('exists{q_ax}'))
+        self.assertEqual(second['condition'], expected('exists{q_bx}'))
+        self.assertEqual(first['content'], second['content'])
+        self.assertIsNot(first['content'], second['content'])
+        self.assertIsNot(first['options'], second['options'])
+
+
+if __name__ == '__main__':
+    unittest.main()
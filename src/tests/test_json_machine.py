@@ -0,0 +1,58 @@
+# Tests of the response serialization, helpers.json_machine: dumps with and
+# without orjson and the composition of pre-serialized parts.
+
+import json
+import unittest
+from unittest import mock
+
+from helpers import json_machine
+
+DATA = {'task' : {'taskid' : 't1', 'content' : 'café <p>', 'modules' : ['a', 'b']},
+        'task_num' : 0, 'ratio' : 0.5, 'done' : False, 'missing' : None}
+
+
+class DumpsTest(unittest.TestCase):
+    def check(self):
+        body = json_machine.dumps(DATA)
+        self.assertIsInstance(body, bytes)
+        # compact separators
+        self.assertNotIn(b'": ', body)
+        self.assertNotIn(b', "', body)
+        self.assertEqual(json.loads(body), json.loads(json.dumps(DATA)))
+        pretty = json_machine.dumps(DATA, pretty=True)
+        self.assertEqual(json.loads(pretty), json.loads(body))
+        self.assertIn(b'\n', pretty)
+        # the keys are sorted
+        self.assertLess(pretty.index(b'"missing"'), pretty.index(b'"task"'))
+        self.assertEqual(json_machine.dumps({1 : 'integer key'}), b'{"1":"integer key"}')
+        # integers beyond 64 bit
+        self.assertEqual(json_machine.dumps({'big' : 2 ** 70}), b'{"big":%d}' % 2 ** 70)
+        with self.assertRaises(TypeError):
+            json_machine.dumps({'set' : {1}})
+
+    @unittest.skipIf(json_machine.orjson is None, "orjson is not installed")
+    def test_orjson(self):
+        self.check()
+
+    def test_json(self):
+        with mock.patch.object(json_machine, 'orjson', None):
+            self.check()
+            self.assertEqual(json_machine.dumps([1, 'a']), b'[1,"a"]')
+
+
+class ComposeTest(unittest.TestCase):
+    def test_compose(self):
+        parts = [(key, json_machine.dumps(DATA[key])) for key in ('task', 'task_num', 'missing')]
+        body = json_machine.compose(parts)
+        self.assertEqual(json.loads(body), {key : DATA[key] for key in ('task', 'task_num', 'missing')})
+        # composed objects nest
+        self.assertEqual(json.loads(json_machine.compose([('next_task', body)])), {'next_task' : json.loads(body)})
+        self.assertEqual(json_machine.compose([]), b'{}')
+
+    def test_escaped_key(self):
+        with mock.patch.object(json_machine, 'orjson', None):
+            self.assertEqual(json.loads(json_machine.compose([('a"b', b'1')])), {'a"b' : 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# Tests of the single-pass condition parser, Lexer.can_import: the conditions and
+# fragments it builds and the errors it reports.
+
+import unittest
+
+from helpers.lexer_machine import Lexer, Status, tokenize
+
+
+def dump(lex):
+    return {'logical' : lex.logical,
+            'conditions' : [(c.op, c.variables, c.values_integers, c.values_string) for c in lex.conditions],
+            'fragments' : [dump(f) for f in lex.fragments]}
+
+
+def parse(condition_str):
+    lex = Lexer()
+    status = Status()
+    ok = lex.can_import(condition_str, status)
+    return ok, lex, status
+
+
+def single(*condition):
+    return {'logical' : 'NONE', 'conditions' : [condition], 'fragments' : []}
+
+
+# condition, the conditions and fragments, the variables and sets, and the serialization
+VALID = [
+    ('q1=="yes"', single('EQUAL', ['q1'], [], ['yes']), ['q1'], [], 'q1=="yes"'),
+    ('q1==1', single('EQUAL', ['q1'], [1], []), ['q1'], [], 'q1==1'),
+    ('q1!=2 & q2>=3',
+     {'logical' : 'AND',
+      'conditions' : [('NOTEQUAL', ['q1'], [2], []), ('GREATEREQUAL', ['q2'], [3], [])],
+      'fragments' : []},
+     ['q1', 'q2'], [], 'q1!=2&q2>=3'),
+    ('q1<=4 | q2=="no" | q3==5',
+     {'logical' : 'OR',
+      'conditions' : [('LESSEQUAL', ['q1'], [4], []), ('EQUAL', ['q2'], [], ['no']), ('EQUAL', ['q3'], [5], [])],
+      'fragments' : []},
+     ['q1', 'q2', 'q3'], [], 'q1<=4|q2=="no"|q3==5'),
+    ('(q1==1 & q2==2) | (q3==3 & (q4==4 | q5==5))',
+     {'logical' : 'OR',
+      'conditions' : [],
+      'fragments' : [{'logical' : 'AND',
+                      'conditions' : [('EQUAL', ['q1'], [1], []), ('EQUAL', ['q2'], [2], [])],
+                      'fragments' : []},
+                     {'logical' : 'AND',
+                      'conditions' : [('EQUAL', ['q3'], [3], [])],
+                      'fragments' : [{'logical' : 'OR',
+                                      'conditions' : [('EQUAL', ['q4'], [4], []), ('EQUAL', ['q5'], [5], [])],
+                                      'fragments' : []}]}]},
+     ['q1', 'q2', 'q3', 'q4', 'q5'], [], '(q1==1&q2==2)|(q3==3&(q4==4|q5==5))'),
+    ('a+b+c>=10', single('GREATEREQUAL', ['a', 'b', 'c'], [10], []), ['a', 'b', 'c'], [], 'a+b+c>=10'),
+    ('inset{q1,myset}', single('INSET', ['q1', 'myset'], [], []), ['q1'], ['myset'], 'inset{q1,myset}'),
+    ('notinset{$workerid, blocked} & exists{q2}',
+     {'logical' : 'AND',
+      'conditions' : [('NOTINSET', ['$workerid', 'blocked'], [], []), ('EXISTS', ['q2'], [], [])],
+      'fragments' : []},
+     ['$workerid', 'q2'], ['blocked'], None),
+    ('exists{prefix*}', single('EXISTS', ['prefix*'], [], []), ['prefix*'], [], None),
+    ('t1*m1*v1=="yes"', single('EQUAL', ['t1*m1*v1'], [], ['yes']), ['t1*m1*v1'], [], 't1*m1*v1=="yes"'),
+    # operators inside a string value are part of the value
+    ('q1=="a>=b"', single('EQUAL', ['q1'], [], ['a>=b']), ['q1'], [], None),
+    ('q1!="inset{x}"', single('NOTEQUAL', ['q1'], [], ['inset{x}']), ['q1'], [], None),
+    ('((q1==1))',
+     {'logical' : 'NONE', 'conditions' : [],
+      'fragments' : [{'logical' : 'NONE', 'conditions' : [], 'fragments' : [single('EQUAL', ['q1'], [1], [])]}]},
+     ['q1'], [], '((q1==1))'),
+    ('q1==1 |', {'logical' : 'OR', 'conditions' : [('EQUAL', ['q1'], [1], [])], 'fragments' : []},
+     ['q1'], [], 'q1==1'),
+    ('q1==1 && q2==2',
+     {'logical' : 'AND', 'conditions' : [('EQUAL', ['q1'], [1], []), ('EQUAL', ['q2'], [2], [])], 'fragments' : []},
+     ['q1', 'q2'], [], 'q1==1&q2==2'),
+    ('(a==1) & b==2 & (c==3)',
+     {'logical' : 'AND',
+      'conditions' : [('EQUAL', ['b'], [2], [])],
+      'fragments' : [single('EQUAL', ['a'], [1], []), single('EQUAL', ['c'], [3], [])]},
+     ['b', 'a', 'c'], [], 'b==2&(a==1)&(c==3)'),
+]
+
+# condition, error and error offset
+INVALID = [
+    ('a+b=="x"', 'x in a+b=="x" is a string but the left-hand side adds integer variables', -1),
+    ('q1==1 & q2==2 | q3==3', 'OR symbol at position 14 is preceded by AND condition', 14),
+    ('& q1==1', 'AND symbol at position 0 is not preceded by any conditions', 0),
+    ('| q1==1', 'OR symbol at position 0 is not preceded by any conditions', 0),
+    ('(q1==1', 'condition ending in position 6 has opening bracket but no closing bracket', 6),
+    ('q1==1)', 'bracket closes at position 5 but no corresponding open bracket', 5),
+    ('()', 'condition ending in position 1 is empty', 1),
+    ('', 'condition ending in position 0 is empty', 0),
+    ('   ', 'condition ending in position 3 is empty', 3),
+    ('q1=="unterminated', '"unterminated in q1=="unterminated is an invalid string', -1),
+    ('q1==unterminated"', 'unterminated" in q1==unterminated" is an invalid string', -1),
+    ('q1==""', ' in q1=="" is an invalid string', -1),
+    ('q1==', 'q1== is an invalid condition', -1),
+    ('q1==1==2', 'q1==1==2 is an invalid condition', -1),
+    ('q1>=1<=2', 'q1>=1<=2 is an invalid condition', -1),
+    ('inset{q1}', 'inset{q1} needs to have two arguments', -1),
+    ('inset q1,set}', 'inset q1,set} is an invalid condition', -1),
+    ('x inset{q1,set}', 'x inset{q1,set} is not a valid inset condition', -1),
+    ('notinset{q1,set', 'notinset{q1,set is not a valid notinset condition', -1),
+    ('exists{q1}==1', 'exists{q1}==1 is not a valid exists condition', -1),
+    ('q1 q2', 'q1 q2 is an invalid condition', -1),
+]
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_tokenize(self):
+        self.assertEqual(tokenize('(q1>="a")|notinset{x,s}'),
+                         [('(', 0, '('), ('TEXT', 1, 'q1'), ('>=', 3, '>='), ('TEXT', 5, '"a"'), (')', 8, ')'),
+                          ('|', 9, '|'), ('notinset{', 10, 'notinset{'), ('TEXT', 19, 'x,s}'), ('END', 23, '')])
+
+
+class LexerTest(unittest.TestCase):
+    def test_valid(self):
+        for condition_str, expected, varlist, setlist, serialized in VALID:
+            ok, lex, status = parse(condition_str)
+            self.assertTrue(ok, (condition_str, status.error))
+            self.assertIsNone(status.error)
+            self.assertEqual(dump(lex), expected, condition_str)
+            self.assertEqual(lex.varlist, varlist, condition_str)
+            self.assertEqual(lex.setlist, setlist, condition_str)
+            if serialized is not None:
+                self.assertEqual(lex.serialize(), serialized, condition_str)
+
+    def test_invalid(self):
+        for condition_str, error, error_offset in INVALID:
+            ok, lex, status = parse(condition_str)
+            self.assertFalse(ok, condition_str)
+            self.assertEqual(status.error, error, condition_str)
+            self.assertEqual(status.error_offset, error_offset, condition_str)
+
+    def test_check_conditions(self):
+        ok, lex, status = parse('(q1>=3 | q2=="yes") & a+b<=10')
+        self.assertTrue(ok)
+        self.assertTrue(lex.check_conditions({'q1' : '4', 'q2' : 'no', 'a' : '4', 'b' : '6'}, {}, Status()))
+        self.assertFalse(lex.check_conditions({'q1' : '2', 'q2' : 'no', 'a' : '4', 'b' : '6'}, {}, Status()))
+        self.assertFalse(lex.check_conditions({'q1' : '4', 'q2' : 'no', 'a' : '4', 'b' : '7'}, {}, Status()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# Tests of the survey bonus metadata stored at upload time,
+# SurveyController.create_metadata and decode_metadata.
+
+import unittest
+
+from controllers import SurveyController
+from models import CType
+from tests import open_test_database
+
+
+def question(varname, valuetype, bonuspoints=1.0, content=None):
+    return {'varname' : varname,
+            'condition' : None,
+            'questiontext' : varname,
+            'helptext' : None,
+            # questions without a bonus scheme earn no points
+            'bonus' : 'linear' if bonuspoints else None,
+            'bonuspoints' : bonuspoints,
+            'valuetype' : valuetype,
+            'options' : None,
+            'content' : content or []}
+
+
+# module names and varnames may contain dots
+MODULES = [{'name' : 'news.outlet', 'header' : 'Outlet', 'contentUpdate' : None,
+            'questions' : [question('slant', 'categorical', 2.0,
+                                    [{'text' : 'Left', 'value' : 'left', 'aprioripermissable' : True},
+                                     {'text' : 'Right', 'value' : 'right', 'aprioripermissable' : False},
+                                     {'text' : 'None', 'value' : 'none', 'aprioripermissable' : True}]),
+                           question('comment.text', 'text', 0)]},
+           {'name' : 'age', 'header' : 'Age', 'contentUpdate' : None,
+            'questions' : [question('age', 'numeric', 0.5)]}]
+TASKS = [{'taskid' : 't1', 'content' : None, 'modules' : ['news.outlet']},
+         {'taskid' : 't2', 'content' : None, 'modules' : ['news.outlet', 'age']}]
+HITS = [{'hitid' : 'h1', 'tasks' : ['t1']},
+        {'hitid' : 'h2', 'tasks' : ['t1', 't2']},
+        {'hitid' : 'h3', 'tasks' : []}]
+
+
+class MetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.db = open_test_database(self)
+        self.survey_controller = SurveyController(self.db, ttl=0.0)
+        self.survey_controller.activate(self.survey_controller.create_generation())
+
+    def check(self, metadata):
+        self.assertEqual(metadata['max_bonus_points'], 4.5)
+        self.assertEqual(metadata['chit_bonus_points'], {'h1' : 2.0, 'h2' : 4.5, 'h3' : 0})
+        self.assertEqual(metadata['crosswalk'],
+                         {'news.outlet' : {'slant' : {'valuetype' : 'categorical',
+                                                      'aprioripermissable' : ['left', 'none']},
+                                           'comment.text' : {'valuetype' : 'text',
+                                                             'aprioripermissable' : []}},
+                          'age' : {'age' : {'valuetype' : 'numeric', 'aprioripermissable' : []}}})
+        self.assertEqual(metadata['bonus_questions'], {'news.outlet' : ['slant'], 'age' : ['age']})
+        self.assertEqual(metadata['task_modules'], {'t1' : ['news.outlet'], 't2' : ['news.outlet', 'age']})
+
+    def test_create_metadata(self):
+        metadata = self.survey_controller.create_metadata([CType.from_dict(m) for m in MODULES], TASKS, HITS)
+        self.check(metadata)
+        self.assertEqual(metadata['generation'], self.survey_controller.get_generation())
+        # the stored document decodes to the same metadata
+        self.check(SurveyController.decode_metadata(
+            self.db.survey.get('metadata:' + metadata['generation'])))
+        self.assertEqual(SurveyController(self.db).get_metadata(), metadata)
+
+    def test_decode_metadata(self):
+        d = {'generation' : 'g1', 'max_bonus_points' : 1.0, 'chits' : [], 'modules' : [],
+             'tasks' : [{'taskid' : 't1', 'modules' : ['a']}, {'taskid' : 't1', 'modules' : ['b']}]}
+        # like ctasks.get, the first task with a taskid wins
+        self.assertEqual(SurveyController.decode_metadata(d)['task_modules'], {'t1' : ['a']})
+
+    def test_computed_for_old_surveys(self):
+        # a survey uploaded before the metadata was stored, into the plain collections
+        self.db = open_test_database(self)
+        self.survey_controller = SurveyController(self.db)
+        self.db.ctypes.insert_many(MODULES)
+        self.db.ctasks.insert_many(TASKS)
+        self.db.chits.insert_many(HITS)
+        self.check(self.survey_controller.get_metadata())
+        self.assertIsNotNone(self.db.survey.get('metadata:'))
+
+    def test_new_generation(self):
+        self.survey_controller.create_metadata([CType.from_dict(m) for m in MODULES], TASKS, HITS)
+        self.survey_controller.activate(self.survey_controller.create_generation())
+        self.survey_controller.create_metadata([CType.from_dict(MODULES[1])], TASKS[1:2], [{'hitid' : 'h4',
+                                                                                            'tasks' : ['t2']}])
+        metadata = SurveyController(self.db).get_metadata()
+        self.assertEqual(metadata['chit_bonus_points'], {'h4' : 0.5})
+        self.assertEqual(metadata['max_bonus_points'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# Checks that the response writer stores every response it acknowledges, in one
+# insert per batch in the group commit mode, and fails only the responses that
+# cannot be stored.
+
+import asyncio
+import datetime
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import pymongo
+import tornado.testing
+import controllers
+import helpers
+from tests import open_mongomock_database, open_test_database
+
+
+def response(taskid):
+    return {'submitted' : datetime.datetime.utcnow(), 'response' : [], 'workerid' : 'W1',
+            'hitid' : 'h1', 'taskid' : taskid}
+
+
+class TestResponseWriter(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = open_test_database(self)
+        self.controller = controllers.CResponseController(self.db)
+        self.metrics = helpers.Metrics()
+
+    @tornado.testing.gen_test
+    async def test_acknowledged(self):
+        writer = controllers.ResponseWriter(self.controller, self.metrics)
+        cresponse = await writer.write(response('t1'))
+        self.assertEqual(cresponse.taskid, 't1')
+        self.assertEqual(self.db.cresponses.count(), 1)
+        self.assertEqual(self.metrics.snapshot()['response_batch_size']['count'], 1)
+
+    @tornado.testing.gen_test
+    async def test_group_commit(self):
+        writer = controllers.ResponseWriter(self.controller, self.metrics, mode='group_commit', delay=0.01)
+        cresponses = await asyncio.gather(*[writer.write(response('t%d' % i)) for i in range(10)])
+        self.assertEqual([c.taskid for c in cresponses], ['t%d' % i for i in range(10)])
+        self.assertEqual(self.db.cresponses.count(), 10)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['response_batch_size']['count'], 1)
+        self.assertEqual(snapshot['response_batch_size']['max'], 10)
+        self.assertEqual(snapshot['response_write_seconds']['count'], 10)
+
+    @tornado.testing.gen_test
+    async def test_max_batch(self):
+        writer = controllers.ResponseWriter(self.controller, self.metrics, mode='group_commit', delay=10.0,
+                                            max_batch=4)
+        await asyncio.gather(*[writer.write(response('t%d' % i)) for i in range(8)])
+        self.assertEqual(self.db.cresponses.count(), 8)
+        self.assertEqual(self.metrics.snapshot()['response_batch_size']['count'], 2)
+
+    async def write_refused(self, controller):
+        writer = controllers.ResponseWriter(controller, self.metrics, mode='group_commit', delay=0.01)
+        return await asyncio.gather(*[writer.write(response(t)) for t in ('t0', 't1', 't2')],
+                                    return_exceptions=True)
+
+    @tornado.testing.gen_test
+    async def test_failure(self):
+        self.db.cresponses.execute("CREATE TRIGGER refuse BEFORE INSERT ON {table} WHEN NEW.taskid = 't1' "
+                                   "BEGIN SELECT RAISE(ABORT, 'refused'); END")
+        results = await self.write_refused(self.controller)
+        self.assertEqual(results[0].taskid, 't0')
+        self.assertIsInstance(results[1], sqlite3.Error)
+        self.assertEqual(results[2].taskid, 't2')
+        self.assertEqual(sorted(d['taskid'] for d in self.db.cresponses.all()), ['t0', 't2'])
+
+    @tornado.testing.gen_test
+    async def test_failure_mongodb(self):
+        database = open_mongomock_database()
+        database.cresponses.collection.ensure_index('taskid', unique=True)
+        database.cresponses.insert(response('t1'))
+        results = await self.write_refused(controllers.CResponseController(database))
+        self.assertEqual(results[0].taskid, 't0')
+        self.assertIsInstance(results[1], pymongo.errors.DuplicateKeyError)
+        self.assertEqual(results[2].taskid, 't2')
+        self.assertEqual(sorted(d['taskid'] for d in database.cresponses.all()), ['t0', 't1', 't2'])
+
+    def test_mode(self):
+        with self.assertRaises(ValueError):
+            controllers.ResponseWriter(self.controller, self.metrics, mode='fire_and_forget')
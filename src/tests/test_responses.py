@@ -0,0 +1,103 @@
+# Tests of the validation and sanitization pipeline of submitted responses,
+# CResponseController.process_response.
+
+import unittest
+
+import jsonpickle
+
+from controllers import CResponseController
+from helpers import Lexer, Status
+from models import CTask, CType
+
+
+def condition(condition_str):
+    lex = Lexer()
+    if not lex.can_import(condition_str, Status()):
+        raise ValueError(condition_str)
+    return jsonpickle.encode(lex)
+
+
+def question(varname, valuetype, condition_str=None):
+    return {'varname' : varname,
+            'condition' : condition(condition_str) if condition_str else None,
+            'questiontext' : varname,
+            'helptext' : None,
+            'bonus' : None,
+            'bonuspoints' : 1.0,
+            'valuetype' : valuetype,
+            'options' : None,
+            'content' : []}
+
+
+# details is only shown to workers who are married
+MODULE = {'name' : 'demographics',
+          'header' : 'Demographics',
+          'contentUpdate' : None,
+          'questions' : [question('age', 'numeric'),
+                         question('married', 'text'),
+                         question('details', 'text', 'married=="yes"')]}
+
+
+class TaskController(object):
+    def __init__(self, tasks):
+        self.tasks = tasks
+    def get_task_by_id(self, taskid):
+        return CTask.deserialize(self.tasks[taskid])
+
+
+class ModuleController(object):
+    def __init__(self, modules):
+        self.modules = modules
+    def get_by_names(self, names):
+        return {name : CType.from_dict(self.modules[name]) for name in names if name in self.modules}
+
+
+def response(age='30', married='no', details=''):
+    return [{'name' : 'demographics',
+             'responses' : [{'varname' : 'age', 'response' : age},
+                            {'varname' : 'married', 'response' : married},
+                            {'varname' : 'details', 'response' : details}]}]
+
+
+class ProcessResponseTest(unittest.TestCase):
+    def setUp(self):
+        self.cresponse_controller = CResponseController.__new__(CResponseController)
+        self.task_controller = TaskController({'task1' : {'taskid' : 'task1', 'content' : None,
+                                                          'modules' : ['demographics']},
+                                               'task2' : {'taskid' : 'task2', 'content' : None,
+                                                          'modules' : ['demographics', 'unknown']}})
+        self.module_controller = ModuleController({'demographics' : MODULE})
+
+    def process(self, r, taskid='task1'):
+        return self.cresponse_controller.process_response(taskid, r, self.task_controller, self.module_controller)
+
+    def test_valid(self):
+        result = self.process(response(married=' no '))
+        self.assertTrue(result['valid'])
+        # text responses are stripped
+        self.assertEqual(result['response'][0]['responses'][1]['response'], 'no')
+        self.assertEqual(set(result['timings']), {'resolve', 'validate', 'sanitize'})
+
+    def test_invalid(self):
+        for r in (response(age='thirty'),
+                  [{'name' : 'other', 'responses' : []}],
+                  [{'name' : 'demographics', 'responses' : response()[0]['responses'][:2]}],
+                  [{'name' : 'demographics',
+                    'responses' : response()[0]['responses'] + [{'varname' : 'extra', 'response' : '1'}]}]):
+            result = self.process(r)
+            self.assertFalse(result['valid'])
+            self.assertIsNone(result['response'])
+
+    def test_conditional(self):
+        # details may be left empty unless it was shown
+        self.assertTrue(self.process(response(married='no'))['valid'])
+        self.assertFalse(self.process(response(married='yes'))['valid'])
+        self.assertTrue(self.process(response(married='yes', details='since 2010'))['valid'])
+
+    def test_unknown_module(self):
+        r = response() + [{'name' : 'unknown', 'responses' : []}]
+        self.assertFalse(self.process(r, 'task2')['valid'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,336 @@
+# Tests of the storage engines (storage): the repositories of every kind of
+# collection, run on SQLite and on MongoDB (through mongomock), the transactions
+# of the SQLite engine and the indexes its queries use.
+
+import datetime
+import threading
+import unittest
+
+import mongomock
+import mongomock.gridfs
+
+import controllers
+import storage
+from models import CHIT
+from tests import RESPONSE, load_test_survey, open_mongomock_database, open_test_database
+
+# BSON keeps milliseconds
+T0 = datetime.datetime(2020, 1, 1, 12, 0, 0, 1000)
+
+def at(seconds):
+    return T0 + datetime.timedelta(seconds=seconds)
+
+
+class StorageTests(object):
+    """Run on the database self.database, set up by the subclasses."""
+    def hits(self):
+        self.database.chits.insert_many([{'hitid' : 'H%d' % i, 'tasks' : ['t1', 't2'], 'taskconditions' : [None, None],
+                                          'exclusions' : ['X'] if i == 2 else [], 'completed_hits' : [],
+                                          'num_completed_hits' : 0}
+                                         for i in range(1, 5)])
+        return self.database.chits
+
+    def test_duplicate_key(self):
+        self.database.admin.insert({'email' : 'a@example.com'})
+        with self.assertRaises(storage.DuplicateKeyError):
+            self.database.admin.insert({'email' : 'a@example.com'})
+        self.database.ctasks.insert_many([{'taskid' : 't1', 'modules' : []}])
+        with self.assertRaises(storage.DuplicateKeyError):
+            self.database.ctasks.insert_many([{'taskid' : 't1', 'modules' : []}])
+        self.assertEqual(self.database.admin.emails(), ['a@example.com'])
+        self.database.admin.remove('a@example.com')
+        self.assertIsNone(self.database.admin.get('a@example.com'))
+
+    def test_tasks(self):
+        tasks = self.database.ctasks
+        tasks.insert_many([{'taskid' : 't%d' % i, 'modules' : ['m%d' % i], 'content' : None, 'document' : 'h'}
+                           for i in range(3)])
+        self.assertEqual(tasks.ids(), ['t0', 't1', 't2'])
+        self.assertEqual(tasks.count(), 3)
+        self.assertEqual(tasks.get('t1'), {'taskid' : 't1', 'modules' : ['m1'], 'content' : None, 'document' : 'h'})
+        self.assertIsNone(tasks.get('t9'))
+        self.assertEqual(tasks.get_many(['t2', 't0', 't9'], ['modules']), [{'modules' : ['m0']}, {'modules' : ['m2']}])
+        self.assertEqual(tasks.all(['taskid']), [{'taskid' : 't0'}, {'taskid' : 't1'}, {'taskid' : 't2'}])
+
+    def test_hits(self):
+        chits = self.hits()
+        self.assertEqual(chits.ids(), ['H1', 'H2', 'H3', 'H4'])
+        self.assertTrue(chits.has_available())
+        self.assertEqual(chits.next_available([], []), 'H1')
+        self.assertEqual(chits.next_available([], ['H1']), 'H2')
+        # H2 excludes the workers of X
+        self.assertEqual(chits.next_available(['X'], ['H1']), 'H3')
+        chits.add_completed('H1', {'worker_id' : 'W1', 'turk_verify_code' : 'c1'})
+        chits.add_completed('H1', {'worker_id' : 'W2', 'turk_verify_code' : 'c2'})
+        chits.add_completed('H3', {'worker_id' : 'W1', 'turk_verify_code' : 'c3'})
+        self.assertEqual(chits.next_available(['X'], []), 'H4')
+        self.assertEqual(chits.completed_ids(), ['H1', 'H3'])
+        self.assertEqual(chits.completed_workers(), {'W1', 'W2'})
+        self.assertTrue(chits.has_completion(['w2', 'W2'], 'c2'))
+        self.assertFalse(chits.has_completion(['W1'], 'c2'))
+        self.assertEqual(chits.stats(), {'num_completed_hits' : 3, 'num_hits' : 4, 'num_tasks' : 8})
+        self.assertEqual(chits.get('H1')['completed_hits'], [{'worker_id' : 'W1', 'turk_verify_code' : 'c1'},
+                                                             {'worker_id' : 'W2', 'turk_verify_code' : 'c2'}])
+        self.assertEqual(chits.get('H1', CHIT.view_fields), {'hitid' : 'H1', 'tasks' : ['t1', 't2'],
+                                                             'taskconditions' : [None, None]})
+        self.assertEqual(chits.get('H1', ['num_completed_hits']), {'num_completed_hits' : 2})
+        self.assertEqual([d['hitid'] for d in chits.get_many(['H4', 'H2'], ['hitid'])], ['H2', 'H4'])
+        for hitid in ('H2', 'H4'):
+            chits.add_completed(hitid, {'worker_id' : 'W3', 'turk_verify_code' : 'c4'})
+        self.assertFalse(chits.has_available())
+        self.assertIsNone(chits.next_available([], []))
+
+    def test_stale_hit(self):
+        chits = self.hits()
+        chits.add_completed('H3', {'worker_id' : 'W1', 'turk_verify_code' : 'c1'})
+        pings = self.database.workerpings
+        for hitid, seconds in (('H3', 0), ('H5', 5), ('H2', 10), ('H1', 20), ('H4', 50)):
+            pings.ping(hitid, at(seconds))
+        self.assertEqual(pings.stale_hit(chits, at(30), []), 'H2')
+        self.assertEqual(pings.stale_hit(chits, at(30), ['X']), 'H1')
+        self.assertIsNone(pings.stale_hit(chits, at(10), []))
+        pings.ping('H2', at(40))
+        self.assertEqual(pings.stale_hit(chits, at(30), []), 'H1')
+
+    def test_responses(self):
+        responses = self.database.cresponses
+        for i, (workerid, hitid, taskid, seconds, images) in enumerate(
+                [('W1', 'H1', 't1', 20, None), ('W1', 'H1', 't1', 10, ['file:a']), ('W1', 'H1', 't2', 30, ['file:a', 'file:b']),
+                 ('W2', 'H2', 't1', 5, None)]):
+            d = {'submitted' : at(seconds), 'response' : RESPONSE, 'workerid' : workerid, 'hitid' : hitid, 'taskid' : taskid}
+            if images:
+                d['images'] = images
+            responses.insert(d)
+        self.assertEqual(responses.latest('W1', 'H1', 't1')['submitted'], at(20))
+        self.assertEqual(responses.latest('W1', 'H1', 't1', ['response']), {'response' : RESPONSE})
+        self.assertIsNone(responses.latest('W2', 'H1', 't1'))
+        self.assertEqual(responses.count_by_worker('W1'), 3)
+        self.assertEqual(responses.hitids_by_worker('W2'), ['H2'])
+        self.assertEqual(responses.image_refs(), {'file:a', 'file:b'})
+        self.assertEqual(len(list(responses.all())), 4)
+        self.assertEqual(list(responses.questions())[:2], [('W1', 'demographics', 'age'), ('W1', 'demographics', 'thoughts')])
+        self.assertEqual(len(list(responses.questions())), 4 * 5)
+
+    def test_response_requestid(self):
+        responses = self.database.cresponses
+        d = {'submitted' : at(10), 'response' : [], 'workerid' : 'W1', 'hitid' : 'H1', 'taskid' : 't1'}
+        responses.insert(d)
+        responses.insert(d)
+        responses.insert(dict(d, requestid='W1:r1'))
+        with self.assertRaises(storage.DuplicateKeyError):
+            responses.insert(dict(d, taskid='t2', requestid='W1:r1'))
+        self.assertEqual(responses.get_by_requestid('W1:r1'), {'hitid' : 'H1', 'taskid' : 't1'})
+        self.assertIsNone(responses.get_by_requestid('W1:r2'))
+        self.assertEqual(responses.insert_many([dict(d, requestid='W1:r2'), dict(d, requestid='W1:r1'),
+                                                dict(d, requestid='W1:r3')])[:3:2], [None, None])
+        self.assertEqual(responses.count(), 5)
+
+    def test_responses_since(self):
+        responses = self.database.cresponses
+        for taskid, submitted in (('t1', at(10)), ('t2', at(5)), ('t3', at(10)), ('t4', at(10.5)), ('t5', at(20))):
+            responses.insert({'submitted' : submitted, 'response' : [], 'workerid' : 'W1', 'hitid' : 'H1', 'taskid' : taskid})
+        page = responses.since(None, None, 3)
+        self.assertEqual([d['taskid'] for key, d in page], ['t2', 't1', 't3'])
+        after = (page[-1][1]['submitted'], page[-1][0])
+        self.assertEqual([d['taskid'] for key, d in responses.since(after, None, 3)], ['t4', 't5'])
+        self.assertEqual([d['taskid'] for key, d in responses.since(after, at(20), 3)], ['t4'])
+        with self.assertRaises(storage.StorageError):
+            responses.changes(None)
+
+    def test_documents(self):
+        documents = controllers.CDocumentController(self.database)
+        documents.create_many({'a.html' : '<p>a</p>', 'b.html' : '<p>b</p>'})
+        documents.create_many({'c.html' : '<p>a</p>'})
+        hashes = documents.get_hashes(['a.html', 'c.html', 'x.html'])
+        self.assertEqual(hashes['a.html'], hashes['c.html'])
+        self.assertEqual(set(hashes), {'a.html', 'c.html'})
+        self.assertEqual(self.database.cdocs.count(), 2)
+        self.assertEqual(sorted(self.database.cdocs.get(hashes['a.html'])['names']), ['a.html', 'c.html'])
+        self.assertEqual(documents.get_document_by_name('c.html').body, b'<p>a</p>')
+        self.assertIsNone(documents.get_document_by_name('x.html'))
+
+    def test_survey(self):
+        survey = self.database.survey
+        survey.create({'_id' : 'current', 'generation' : 'g1', 'uploaded' : at(0), 'retired' : []})
+        with self.assertRaises(storage.DuplicateKeyError):
+            survey.create({'_id' : 'current', 'generation' : 'g2', 'uploaded' : at(0), 'retired' : []})
+        self.assertFalse(survey.swap_generation('g0', 'g2', at(1)))
+        self.assertTrue(survey.swap_generation('g1', 'g2', at(1)))
+        self.assertEqual(survey.get('current'), {'_id' : 'current', 'generation' : 'g2', 'uploaded' : at(1),
+                                                 'retired' : [{'generation' : 'g1', 'retired' : at(1)}]})
+        self.assertTrue(survey.swap_generation('g2', 'g3', at(2)))
+        survey.remove_retired('g1')
+        self.assertEqual(survey.get('current')['retired'], [{'generation' : 'g2', 'retired' : at(2)}])
+        survey.put({'_id' : 'metadata:g3', 'chits' : []})
+        survey.put({'_id' : 'metadata:g3', 'chits' : [1]})
+        self.assertEqual(survey.get('metadata:g3'), {'_id' : 'metadata:g3', 'chits' : [1]})
+        survey.remove('metadata:g3')
+        self.assertIsNone(survey.get('metadata:g3'))
+
+    def test_shared(self):
+        status = self.database.currentstatus
+        status.put('W1', 'H1', 0, at(0))
+        status.put('W1', 'H1', 1, at(10))
+        status.put('W2', 'H2', 0, at(5))
+        self.assertEqual(status.get('W1'), {'workerid' : 'W1', 'hitid' : 'H1', 'taskindex' : 1})
+        self.assertEqual(sorted(status.hitids()), ['H1', 'H2'])
+        self.assertEqual(status.remove_older(at(6)), 1)
+        self.assertEqual(status.hitids(), ['H1'])
+        status.remove('W1')
+        self.assertIsNone(status.get('W1'))
+        self.database.sets.insert_many([{'name' : 's', 'member' : '1'}, {'name' : 's', 'member' : '2'}])
+        s = controllers.SetController(self.database).get_set('s')
+        self.assertTrue(s.hasMember(2))
+        self.assertFalse(s.hasMember(3))
+        self.database.events.insert({'date' : at(10), 'event' : 'second'})
+        self.database.events.insert({'date' : at(0), 'event' : 'first'})
+        self.assertEqual([e['event'] for e in self.database.events.all()], ['first', 'second'])
+        self.assertEqual([e['event'] for e in self.database.events.last(1)], ['second'])
+        self.assertEqual(self.database.events.trim(1), 1)
+        self.assertEqual([e['event'] for e in self.database.events.all()], ['second'])
+        connections = self.database.mturkconnections
+        self.assertIsNone(connections.get())
+        connections.update({'hitid' : None, 'hitpayment' : 0.5})
+        connections.update({'hitid' : 'H', 'running' : True})
+        self.assertEqual(connections.get(), {'hitid' : 'H', 'hitpayment' : 0.5, 'running' : True})
+        self.assertEqual(len(connections.all()), 1)
+        self.database.bonus_info.replace([{'workerid' : 'W1'}, {'workerid' : 'W2'}])
+        self.database.bonus_info.replace([{'workerid' : 'W3'}])
+        self.assertEqual(self.database.bonus_info.all(), [{'workerid' : 'W3'}])
+        uploads = self.database.cuploads
+        uploads.insert({'blobid' : 'b1', 'workerid' : 'W1', 'ref' : 'file:1', 'created' : at(0)})
+        uploads.insert({'blobid' : 'b2', 'workerid' : 'W1', 'ref' : 'file:2', 'created' : at(10)})
+        self.assertIsNone(uploads.get('b1', 'W2'))
+        uploads.remove_older(at(5))
+        self.assertIsNone(uploads.get('b1', 'W1'))
+        self.assertEqual(uploads.refs(), ['file:2'])
+
+    def test_drop_collection(self):
+        self.hits()
+        chits = self.database.collection('chits', 'chits_g1')
+        chits.insert_many([{'hitid' : 'H1', 'tasks' : [], 'exclusions' : []}])
+        self.database.collection('cdocs', 'cdocs_g1')
+        self.assertTrue({'chits', 'chits_g1', 'cdocs_g1'} <= set(self.database.collection_names()))
+        self.database.drop_collection('chits_g1')
+        self.database.drop_collection('cdocs_g1')
+        self.assertFalse({'chits_g1', 'cdocs_g1'} & set(self.database.collection_names()))
+        self.assertEqual(self.database.collection('chits', 'chits_g1').count(), 0)
+        self.assertEqual(self.database.chits.count(), 4)
+
+    def test_survey_workflow(self):
+        survey_controller, db = load_test_survey(self.database)
+        chit_controller = controllers.CHITController(db)
+        response_controller = controllers.CResponseController(db)
+        self.assertEqual(chit_controller.get_agg_hit_info(), {'num_completed_hits' : 0, 'num_hits' : 3, 'num_tasks' : 4})
+        hitid = chit_controller.get_next_chit_id(workerid='W1')
+        chit = chit_controller.get_chit_by_id(hitid, CHIT.view_fields)
+        for taskid in chit.tasks:
+            response_controller.create({'submitted' : T0, 'response' : RESPONSE, 'workerid' : 'W1',
+                                        'hitid' : hitid, 'taskid' : taskid})
+        hit_info = chit_controller.add_completed_hit(chit=chit, worker_id='W1')
+        self.assertEqual(chit_controller.get_workers_with_completed_hits(), ['W1'])
+        self.assertTrue(controllers.CHITController.secret_code_matches(db=db, worker_id='W1',
+                                                                       secret_code=hit_info['turk_verify_code']))
+        self.assertEqual(response_controller.get_reponse_info_by_worker('W1'), {'count' : len(chit.tasks)})
+        self.assertEqual(chit_controller.get_next_chit_id(outstanding_hits=['2']), '3')
+        self.assertEqual(survey_controller.get_metadata()['chit_bonus_points'].keys(), {'1', '2', '3'})
+
+
+class SQLiteStorageTest(StorageTests, unittest.TestCase):
+    def setUp(self):
+        self.database = open_test_database(self)
+
+    def plan(self, repository, sql, parameters):
+        rows = repository.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+        return " ".join(r[-1] for r in rows)
+
+    def test_batch(self):
+        chits = self.hits()
+        with self.assertRaises(RuntimeError):
+            with self.database.batch():
+                chits.add_completed('H1', {'worker_id' : 'W1', 'turk_verify_code' : 'c1'})
+                with self.database.batch():
+                    self.database.ctasks.insert_many([{'taskid' : 't1', 'modules' : []}])
+                raise RuntimeError()
+        self.assertEqual(chits.get('H1')['num_completed_hits'], 0)
+        self.assertEqual(self.database.ctasks.count(), 0)
+        # a failing savepoint leaves the rest of the batch
+        with self.database.batch():
+            self.database.ctasks.insert_many([{'taskid' : 't1', 'modules' : []}])
+            with self.assertRaises(storage.DuplicateKeyError):
+                with self.database.batch():
+                    self.database.ctasks.insert_many([{'taskid' : 't2', 'modules' : []}])
+                    self.database.ctasks.insert_many([{'taskid' : 't1', 'modules' : []}])
+        self.assertEqual(self.database.ctasks.ids(), ['t1'])
+
+    def test_readers_during_batch(self):
+        chits = self.hits()
+        seen = []
+        with self.database.batch():
+            chits.add_completed('H1', {'worker_id' : 'W1', 'turk_verify_code' : 'c1'})
+            # another thread reads the last committed state without waiting
+            reader = threading.Thread(target=lambda : seen.append(chits.next_available([], [])))
+            reader.start()
+            reader.join()
+        self.assertEqual(seen, ['H1'])
+        self.assertEqual(chits.next_available([], []), 'H2')
+
+    def test_indexes(self):
+        chits = self.hits()
+        self.assertIn('USING INDEX chits$num_completed_hits',
+                      self.plan(chits, "SELECT hitid FROM {table} WHERE num_completed_hits = 0 AND " +
+                                chits.not_excluded + " ORDER BY rowid LIMIT 1", ('[]',)))
+        self.assertNotIn('TEMP B-TREE', self.plan(chits, "SELECT hitid FROM {table} WHERE num_completed_hits = 0 "
+                                                  "ORDER BY rowid LIMIT 1", ()))
+        responses = self.database.cresponses
+        self.assertIn('USING INDEX cresponses$workerid',
+                      self.plan(responses, "SELECT doc FROM {table} WHERE workerid = ? AND hitid = ? AND taskid = ? "
+                                "ORDER BY submitted, rowid", ('W', 'H', 't')))
+        self.assertIn('COVERING INDEX cresponses$images',
+                      self.plan(responses, "SELECT DISTINCT i.value FROM {table}, json_each({table}.images) AS i "
+                                "WHERE {table}.images IS NOT NULL", ()))
+        pings = self.database.workerpings
+        self.assertIn('USING INDEX workerpings$lastping',
+                      self.plan(pings, "SELECT hitid FROM {table} WHERE lastping < ? ORDER BY lastping", ('',)))
+
+    def test_reopen(self):
+        self.hits()
+        database = storage.SQLiteDatabase(self.database.path)
+        self.addCleanup(database.close)
+        self.assertEqual(database.chits.ids(), ['H1', 'H2', 'H3', 'H4'])
+
+
+class MongoStorageTest(StorageTests, unittest.TestCase):
+    def setUp(self):
+        self.database = open_mongomock_database()
+
+    def test_gridfs(self):
+        mongomock.gridfs.enable_gridfs_integration()
+        fs = self.database.gridfs('images')
+        fileid = fs.put(b'data', content_type='image/png')
+        self.assertEqual(fs.get(fileid).read(), b'data')
+
+    def test_legacy_documents(self):
+        # surveys loaded before documents were stored by hash keep {name, content}
+        self.database.cdocs.collection.insert({'name' : 'old.html', 'content' : '<p>old</p>'})
+        self.assertEqual(controllers.CDocumentController(self.database).get_document_by_name('old.html').body,
+                         b'<p>old</p>')
+
+    def test_read_only(self):
+        database = storage.MongoDatabase(self.database.database, read_only=True)
+        self.assertEqual(database.chits.collection.index_information(), {})
+        self.assertIn('hitid_1', self.database.chits.collection.index_information())
+
+
+class OpenTest(unittest.TestCase):
+    def test_unknown_engine(self):
+        with self.assertRaises(storage.StorageError):
+            storage.open_database('test', 'redis')
+
+    def test_gridfs_needs_mongodb(self):
+        with self.assertRaises(storage.StorageError):
+            open_test_database(self).gridfs('images')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# Tests of the streaming image upload, /HIT/upload (handlers.ImageUploadHandler),
+# and of the submissions that refer to its blob ids.
+
+import datetime
+import io
+import os
+import unittest
+from unittest import mock
+
+import tornado.testing
+import tornado.web
+from PIL import Image
+
+import app_config
+import controllers
+import handlers
+import helpers
+import Settings
+from tests import open_test_database, temporary_directory
+
+SECRET = 'secret'
+
+
+def png(color='red'):
+    image = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(image, 'PNG')
+    return image.getvalue()
+
+
+class UploadTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.directory = temporary_directory(self)
+        self.db = open_test_database(self, self.directory)
+        application = tornado.web.Application([(r'/HIT/upload/?', handlers.ImageUploadHandler)],
+                                              cookie_secret=SECRET)
+        application.logging = Settings.logging
+        application.currentstatus_controller = controllers.CurrentStatusController(self.db)
+        application.cresponse_controller = controllers.CResponseController(self.db)
+        application.cimage_controller = controllers.CImageController(self.db, storage="filesystem",
+                                                                     path=os.path.join(self.directory, 'images'),
+                                                                     upload_seconds=3600.0)
+        application.image_processor = helpers.ImageProcessor(workers=1)
+        application.metrics = helpers.Metrics()
+        application.admission = {'upload' : helpers.AdmissionLimiter('upload', application.metrics)}
+        self.addCleanup(lambda : application.image_processor.pool[0].shutdown(wait=False))
+        for workerid in ('W1', 'W2'):
+            application.currentstatus_controller.create_or_update(workerid=workerid, hitid='H1', taskindex=0)
+        self.application = application
+        return application
+
+    def cookie(self, workerid):
+        return 'workerid=' + tornado.web.create_signed_value(SECRET, 'workerid', workerid).decode()
+
+    def upload(self, body, workerid='W1', content_type='image/png'):
+        return self.fetch('/HIT/upload', method='POST', body=body,
+                          headers={'Cookie' : self.cookie(workerid), 'Content-Type' : content_type})
+
+    def blob(self, workerid='W1', color='red'):
+        response = self.upload(png(color), workerid)
+        self.assertEqual(response.code, 200)
+        return tornado.escape.json_decode(response.body)['blob']
+
+    def test_upload(self):
+        blobid = self.blob()
+        upload = self.application.cimage_controller.get_upload(blobid, 'W1')
+        self.assertEqual(upload['content_type'], 'image/png')
+        self.assertEqual(self.application.cimage_controller.get(upload['ref']), ('image/png', png()))
+
+    def test_rejected(self):
+        self.assertEqual(self.upload(png(), workerid='W3').code, 403)
+        self.assertEqual(self.upload(b'text', content_type='text/plain').code, 415)
+        with mock.patch.dict(app_config.image_upload, max_bytes=64):
+            self.assertEqual(self.upload(png() + b'\0' * 64).code, 413)
+        before = set(os.listdir(Settings.TMP_PATH))
+        response = self.upload(b'no image')
+        self.assertEqual(tornado.escape.json_decode(response.body)['explanation'], 'invalid_image')
+        # the streamed file is removed when the request finishes
+        self.assertEqual(set(os.listdir(Settings.TMP_PATH)), before)
+
+    def process(self, blobid, workerid):
+        r = {'varname' : 'logo', 'response' : 'blob:' + blobid}
+        module_response = {'name' : 'm', 'responses' : [r]}
+        refs = self.io_loop.run_sync(lambda : self.application.cresponse_controller.process_uploads(
+            [(module_response, r)], self.application.image_processor, self.application.cimage_controller,
+            workerid=workerid))
+        return refs, module_response
+
+    def test_blob(self):
+        blobid = self.blob()
+        upload = self.application.cimage_controller.get_upload(blobid, 'W1')
+        refs, module_response = self.process(blobid, 'W1')
+        self.assertEqual(refs, [upload['ref']])
+        self.assertEqual(module_response['responses'],
+                         [{'varname' : 'logo', 'response' : 'imagehash:' + upload['imagehash']},
+                          {'varname' : 'logo_raw', 'response' : upload['ref']}])
+
+    def test_wrong_worker(self):
+        blobid = self.blob('W1')
+        self.assertIsNone(self.process(blobid, 'W2')[0])
+        self.assertIsNone(self.process('unknown', 'W1')[0])
+
+    def test_remove_unreferenced(self):
+        cimage_controller = self.application.cimage_controller
+        cresponse_controller = self.application.cresponse_controller
+        expired = self.blob(color='blue')
+        created = datetime.datetime.utcnow()
+        used, pending = [self.blob(color=color) for color in ('red', 'green')]
+        refs = {blobid : cimage_controller.get_upload(blobid, 'W1')['ref'] for blobid in (used, pending, expired)}
+        orphan = cimage_controller.create(png('white'), 'image/png')
+        fresh = cimage_controller.create(png('black'), 'image/png')
+        cresponse_controller.create({'submitted' : datetime.datetime.utcnow(), 'response' : [], 'workerid' : 'W1',
+                                     'hitid' : 'H1', 'taskid' : 't1', 'images' : [refs[used]]})
+        # the upload expired, as if it was created upload_seconds ago
+        self.db.cuploads.remove_older(created)
+        old = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds() - 7200
+        for ref in list(refs.values()) + [orphan]:
+            os.utime(os.path.join(cimage_controller.path, ref[len('file:'):]), (old, old))
+        self.assertEqual(cresponse_controller.get_image_refs(), {refs[used]})
+        self.assertEqual(cimage_controller.remove_unreferenced(cresponse_controller.get_image_refs()), 2)
+        self.assertEqual(sorted(os.listdir(cimage_controller.path)),
+                         sorted(ref[len('file:'):] for ref in (refs[used], refs[pending], fresh)))
+        self.assertIsNone(cimage_controller.get_upload(expired, 'W1'))
+        # pending uploads are only used within upload_seconds
+        cimage_controller.upload_seconds = 0.0
+        self.assertIsNone(cimage_controller.get_upload(pending, 'W1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+# Checks that the cHITs of workers connected over the worker socket stay theirs while
+# the server pings them and are handed out again shortly after the connection closes,
+# and that a retried submission is stored once and answered like the first attempt.
+
+import asyncio
+import datetime
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'config'))
+import tornado.gen
+import tornado.httpclient
+import tornado.testing
+import tornado.web
+import tornado.websocket
+import urllib.parse
+import app_config
+import controllers
+import handlers
+import helpers
+import Settings
+from tests import RESPONSE, load_test_survey, open_test_database
+
+SECRET = 'test'
+
+
+class WorkerApplication(tornado.web.Application):
+    """The parts of the Application the worker socket uses."""
+    def __init__(self, database):
+        tornado.web.Application.__init__(self, [(r'/worker/socket/?', handlers.WorkerSocketHandler),
+                                                (r'/HIT/submit/?', handlers.CResponseHandler)],
+                                         cookie_secret=SECRET)
+        self.survey_controller, self.db = load_test_survey(database)
+        self.currentstatus_controller = controllers.CurrentStatusController(self.db)
+        self.ctype_controller = controllers.CTypeController(self.db)
+        self.ctask_controller = controllers.CTaskController(self.db)
+        self.chit_controller = controllers.CHITController(self.db, stale_seconds=30.0)
+        self.cresponse_controller = controllers.CResponseController(self.db)
+        self.workerping_controller = controllers.WorkerPingController(self.db, stale_seconds=30.0)
+        self.dashboard_controller = controllers.DashboardController(self.chit_controller,
+                                                                    self.cresponse_controller,
+                                                                    self.currentstatus_controller,
+                                                                    controllers.EventController(self.db))
+        self.payload_cache = helpers.GenerationCache()
+        self.metrics = helpers.Metrics()
+        self.admission = {'submit' : helpers.AdmissionLimiter('submit', self.metrics)}
+        self.response_writer = controllers.ResponseWriter(self.cresponse_controller, self.metrics)
+        self.submission_results = helpers.ResultCache(ttl=60.0)
+        # the test survey has no image questions
+        self.image_processor = self.cimage_controller = None
+        self.worker_sockets = set()
+
+    @property
+    def logging(self):
+        return Settings.logging
+
+
+class TestWorkerPings(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        database = open_test_database(self)
+        db = controllers.GenerationalDatabase(database, controllers.SurveyController(database))
+        self.chit_controller = controllers.CHITController(db, stale_seconds=30.0)
+        self.chit_controller.create_many([{'hitid' : h, 'tasks' : ['t'], 'taskconditions' : [None]}
+                                          for h in ('1', '2', '3')])
+        self.ping_controller = controllers.WorkerPingController(db, stale_seconds=30.0)
+
+    def test_ping_many(self):
+        self.ping_controller.ping('1')
+        self.ping_controller.ping_many(['1', '2'])
+        self.assertIsNone(self.chit_controller.get_stale_chit())
+        self.ping_controller.expire('2', 1.0)
+        self.assertEqual(self.chit_controller.get_stale_chit(stale_seconds=28.0), '2')
+
+    def test_expire(self):
+        self.ping_controller.ping_many(['1', '2'])
+        self.ping_controller.expire('1', 5.0)
+        self.assertIsNone(self.chit_controller.get_stale_chit())
+        self.assertEqual(self.chit_controller.get_stale_chit(stale_seconds=24.0), '1')
+
+
+class TestWorkerSocket(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return WorkerApplication(open_test_database(self))
+
+    def connect(self, workerid=None):
+        request = tornado.httpclient.HTTPRequest(self.get_url('/worker/socket').replace('http', 'ws'))
+        if workerid:
+            cookie = tornado.web.create_signed_value(SECRET, 'workerid', workerid).decode('utf8')
+            request.headers['Cookie'] = 'workerid=' + cookie
+        return tornado.websocket.websocket_connect(request)
+
+    @tornado.testing.gen_test
+    async def test_not_logged_in(self):
+        connection = await self.connect()
+        self.assertIsNone(await connection.read_message())
+        self.assertEqual(connection.close_code, 4001)
+
+    @tornado.testing.gen_test
+    async def test_bad_message(self):
+        self._app.currentstatus_controller.create_or_update(workerid='W1', hitid='1', taskindex=0)
+        for message in ('{', '[1]', '"submit"'):
+            connection = await self.connect('W1')
+            connection.write_message(message)
+            self.assertIsNone(await connection.read_message())
+            self.assertEqual(connection.close_code, 4000)
+
+    @tornado.testing.gen_test
+    async def test_submit_and_close(self):
+        app = self._app
+        app.currentstatus_controller.create_or_update(workerid='W1', hitid='1', taskindex=0)
+        connection = await self.connect('W1')
+        connection.write_message(json.dumps({'type' : 'submit', 'id' : 7, 'data' : [], 'prefetch' : 1}))
+        reply = json.loads(await connection.read_message())
+        self.assertEqual(reply, {'id' : 7, 'response' : {'error' : True, 'explanation' : 'invalid_response'}})
+        self.assertEqual([s.worker_id for s in app.worker_sockets], ['W1'])
+        self.assertIsNone(app.chit_controller.get_stale_chit())
+        connection.close()
+        while app.worker_sockets:
+            await tornado.gen.sleep(0.01)
+        # stale after heartbeat_seconds instead of stale_seconds
+        cutoff = app_config.workers['stale_seconds'] - app_config.workers['heartbeat_seconds']
+        self.assertEqual(app.chit_controller.get_stale_chit(stale_seconds=cutoff - 1), '1')
+        self.assertIsNone(app.chit_controller.get_stale_chit(stale_seconds=cutoff + 1))
+
+
+class TestResultCache(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    async def test_concurrent(self):
+        cache = helpers.ResultCache()
+        calls = []
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+        results = await asyncio.gather(*[cache.get('a', compute) for i in range(3)])
+        self.assertEqual(results, [1, 1, 1])
+        self.assertEqual(await cache.get('a', compute), 1)
+        self.assertEqual(await cache.get('b', compute), 2)
+
+    @tornado.testing.gen_test
+    async def test_not_kept(self):
+        cache = helpers.ResultCache()
+        async def compute():
+            return {'error' : True}
+        await cache.get('a', compute, keep=lambda result : not result.get('error'))
+        self.assertNotIn('a', cache.entries)
+        async def fail():
+            raise ValueError('a')
+        with self.assertRaises(ValueError):
+            await cache.get('a', fail)
+        self.assertNotIn('a', cache.entries)
+
+    @tornado.testing.gen_test
+    async def test_expire(self):
+        cache = helpers.ResultCache(ttl=0.0, max_entries=2)
+        async def compute():
+            return 1
+        await cache.get('a', compute)
+        await cache.get('b', compute)
+        self.assertEqual(list(cache.entries), ['b'])
+
+
+class TestSubmissions(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        app = WorkerApplication(open_test_database(self))
+        app.currentstatus_controller.create_or_update(workerid='W1', hitid='1', taskindex=0)
+        return app
+
+    def submit(self, requestid):
+        cookie = tornado.web.create_signed_value(SECRET, 'workerid', 'W1').decode('utf8')
+        body = urllib.parse.urlencode({'data' : json.dumps(RESPONSE), 'requestid' : requestid})
+        return self.http_client.fetch(self.get_url('/HIT/submit'), method='POST', body=body,
+                                      headers={'Cookie' : 'workerid=' + cookie})
+
+    def stored(self):
+        return [(d['taskid'], d['requestid']) for d in self._app.db.cresponses.all()]
+
+    @tornado.testing.gen_test
+    async def test_retry(self):
+        replies = await asyncio.gather(self.submit('r1'), self.submit('r1'))
+        self.assertEqual([json.loads(r.body) for r in replies], [{}, {}])
+        self.assertEqual(json.loads((await self.submit('r1')).body), {})
+        self.assertEqual(self.stored(), [('1', 'W1:r1')])
+        self.assertEqual(self._app.currentstatus_controller.get_current_status('W1')['taskindex'], 1)
+        await self.submit('r2')
+        self.assertEqual(self.stored(), [('1', 'W1:r1'), ('2', 'W1:r2')])
+
+    @tornado.testing.gen_test
+    async def test_reply_lost(self):
+        await self.submit('r1')
+        # the server restarted before the retry arrived
+        self._app.submission_results.entries.clear()
+        self.assertEqual(json.loads((await self.submit('r1')).body), {})
+        self.assertEqual(self.stored(), [('1', 'W1:r1')])
+        self.assertEqual(self._app.currentstatus_controller.get_current_status('W1')['taskindex'], 1)
+
+    @tornado.testing.gen_test
+    async def test_status_not_updated(self):
+        self._app.cresponse_controller.create({'submitted' : datetime.datetime.utcnow(), 'response' : RESPONSE, 'workerid' : 'W1',
+                                               'hitid' : '1', 'taskid' : '1', 'requestid' : 'W1:r1'})
+        self.assertEqual(json.loads((await self.submit('r1')).body), {})
+        self.assertEqual(self.stored(), [('1', 'W1:r1')])
+        self.assertEqual(self._app.currentstatus_controller.get_current_status('W1')['taskindex'], 1)
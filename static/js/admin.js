@@ -1,4 +1,7 @@
       var seenEvents = {};
+      // the WebSocket pushing the run status, null while getStatus() has to poll it
+      var live = null;
+      var statusTimer = null;
 
       $(onReady);
 
@@ -38,6 +41,10 @@
               evt.preventDefault();
               window.location.href = '/admin/download/';
           });
+          $('#download-parquet-btn').click(function(evt) {
+              evt.preventDefault();
+              window.location.href = '/admin/download/?format=parquet&wide=1';
+          });
           $('#download-bonusinfo-btn').click(function(evt) {
               evt.preventDefault();
               window.location.href = '/admin/bonusinfo/';
@@ -137,6 +144,7 @@ $('#addAdmin').click(function(evt) {
 
           
           getStatus(true);
+          startLive();
           getHITs();
 		  reloadAdminList();
       }
@@ -186,24 +194,47 @@ $('#addAdmin').click(function(evt) {
       }
       
       function getStatus(updateTurkInfo) {
+          clearTimeout(statusTimer);
           $.get('/admin/info/' + nocache(), function(data) {
               try {
 				  updateStatus(data,updateTurkInfo);
               } finally {
-                  setTimeout(getStatus, 5000);
+                  // with the live status only the MTurk info is still polled
+                  statusTimer = setTimeout(getStatus, live ? 60000 : 5000);
               }
           }).fail(function () {
               $('#admin-server-info').html('<span class="error">Error updating server information</span>').show();
-              setTimeout(getStatus, 5000);
+              statusTimer = setTimeout(getStatus, 5000);
           });
       }
+
+      function startLive() {
+          if (!window.WebSocket) {
+              return;
+          }
+          var scheme = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+          var socket = new WebSocket(scheme + window.location.host + '/admin/live');
+          socket.onopen = function () {
+              live = socket;
+          };
+          socket.onmessage = function (evt) {
+              updateLive(JSON.parse(evt.data));
+          };
+          socket.onclose = function () {
+              if (live === socket) {
+                  // poll until the server is back
+                  live = null;
+                  getStatus(false);
+                  setTimeout(startLive, 10000);
+              }
+          };
+      }
 	  
 	  function updateStatus(data,updateTurkInfo){
                   if (data.authed) {
                       $('#admin-login-info').text('Logged in as ' + data.full_name + ' (' + data.email + ').');
                       $('#admin-server-info').text('Server is running in '+ data.environment +' mode.');
                       $('#admin-superadmin').toggle(data.superadmin);
-                      $('#admin-task-info').html(data.hitinfo.num_hits + ' HITs ('+ data.hitinfo.num_tasks +' tasks) loaded. ' + data.hitinfo.num_completed_hits + ' HITs ('+ data.hitinfo.num_completed_tasks +' tasks) complete. ');
                       if (!data.turkinfo || !data.turkbalance || data.hitinfo.num_hits==0) {
 						  $('#openEditModalButton').attr("disabled", false);
 						  if (!data.turkinfo){
@@ -273,6 +304,13 @@ $('#addAdmin').click(function(evt) {
                       }
                   }
 
+                  if (data.authed) {
+                      updateLive(data);
+                  }
+	  }
+
+	  function updateLive(data){
+                  $('#admin-task-info').html(data.hitinfo.num_hits + ' HITs ('+ data.hitinfo.num_tasks +' tasks) loaded. ' + data.hitinfo.num_completed_hits + ' HITs ('+ data.hitinfo.num_completed_tasks +' tasks) complete. ');
                   var resolvedStatuses = {};
                   var outstanding = data.hitstatus.outstanding || [];
                   for (var i = 0; i < outstanding.length; i++) {
@@ -355,6 +393,9 @@ $('#addAdmin').click(function(evt) {
           $("#xml-upload-success").hide();
           var data = new FormData();
           data.append('file', $('#xml-upload-file')[0].files[0]);
+          if ($('#xml-upload-append').is(':checked')) {
+              data.append('append', '1');
+          }
           $.ajax({
               url: '/admin/xmlupload/',
               data: data,
@@ -367,7 +408,7 @@ $('#addAdmin').click(function(evt) {
 				  $('#upload-btn-loading').hide();		  
                   if (data.success !== undefined) {
                       var $succ = $("#xml-upload-success");
-                      $succ.text("Successfully uploaded.")
+                      $succ.text(data.appended ? "Successfully appended." : "Successfully uploaded.")
                       $succ.fadeIn();
                       //getStatus();
                   } else {
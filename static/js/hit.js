@@ -25,11 +25,85 @@ function getForcedHit() {
     }
 }
 
+// The worker socket shows the server that the worker is still here and carries the
+// submissions; while it is not open the browser pings and submits over HTTP.
+var socket = null;
+var socketState = 'closed'; // 'connecting', 'open', 'closed' or 'failed'
+var socketRequests = {};
+var socketRequestId = 0;
+
+function connectSocket() {
+    if (!window.WebSocket || socketState !== 'closed' || getAdminTask() !== undefined) return;
+    var ws = new WebSocket((window.location.protocol === 'https:' ? 'wss://' : 'ws://') + window.location.host + '/worker/socket');
+    socketState = 'connecting';
+    ws.onopen = function () {
+        socket = ws;
+        socketState = 'open';
+        $("#ping-error").hide();
+    };
+    ws.onmessage = function (evt) {
+        var message = JSON.parse(evt.data);
+        var callback = socketRequests[message.id];
+        delete socketRequests[message.id];
+        if (callback) callback(message.response);
+    };
+    ws.onclose = function (evt) {
+        var wasOpen = (socket === ws);
+        socket = null;
+        // it is unknown whether the submissions in flight arrived; they are sent again
+        // over HTTP with the same id, so the server stores each of them once
+        var pending = socketRequests;
+        socketRequests = {};
+        $.each(pending, function (id, request) {
+            request.resend();
+        });
+        if (wasOpen && evt.code !== 4001) {
+            socketState = 'closed';
+            setTimeout(connectSocket, 5000);
+        } else {
+            // not logged in or blocked on the way, stays on HTTP
+            socketState = (evt.code === 4001) ? 'closed' : 'failed';
+        }
+    };
+}
+
+// An overloaded server answers 503 and asks to come back after Retry-After seconds.
+// The retries back off exponentially and are spread out at random, so that the
+// browsers do not all return at the same moment.
+var maxRetries = 6;
+
+function retryDelay(retryAfter, attempt) {
+    var delay = Math.max(1000 * (retryAfter || 1), 1000 * Math.pow(2, attempt));
+    return Math.min(delay, 60000) * (0.5 + Math.random());
+}
+
+function postWithRetry(url, data, success, failure, attempt) {
+    attempt = attempt || 0;
+    $.post(url, data, success).fail(function (xhr) {
+        if (xhr.status === 503 && attempt < maxRetries) {
+            setTimeout(function () {
+                postWithRetry(url, data, success, failure, attempt + 1);
+            }, retryDelay(+xhr.getResponseHeader('Retry-After'), attempt));
+        } else if (failure) {
+            failure(xhr);
+        }
+    });
+}
+
 function ping() {
+    if (socket) {
+        setTimeout(ping, 5000);
+        return;
+    }
     $.post('/worker/ping', {}, function(data) {
         $("#ping-error").hide();
         setTimeout(ping, 5000);
-    }).fail(function () {
+    }).fail(function (xhr) {
+        if (xhr.status === 503) {
+            // the server is busy, not gone
+            setTimeout(ping, retryDelay(+xhr.getResponseHeader('Retry-After'), 0));
+            return;
+        }
         if (!$("#ping-error").is(":visible")) {
           $("#ping-error").show();
           scrollToTop($("#hit-modules-scroll"));
@@ -47,7 +121,26 @@ function scrollToBottom($div) {
 
 var currentTypeGroup = null;
 
+var documentRequests = {};
+
+function fetchDocument(hash) {
+    // shared documents are served by content hash, so the browser caches them;
+    // a request that is still running is reused
+    if (!documentRequests[hash]) {
+        documentRequests[hash] = $.get('/document/' + hash, null, null, 'text').fail(function () {
+            delete documentRequests[hash];
+        });
+    }
+    return documentRequests[hash];
+}
+
 function showWithData(task, modules) {
+    if (task.document) {
+        fetchDocument(task.document).done(function (content) {
+            showWithData($.extend({}, task, {content : content, document : null}), modules);
+        });
+        return;
+    }
     $('.content-main').show();
     $('#login-panel').hide();
     $("#hit-content-iframe").ready(function(){
@@ -63,6 +156,27 @@ function showWithData(task, modules) {
     });
 }
 
+// Module definitions only change when a new survey is uploaded, so they are
+// fetched once per survey version and kept here.
+var moduleCache = {};
+var moduleCacheVersion = undefined;
+
+function loadModules(names, version, callback) {
+    if (version !== moduleCacheVersion) {
+        moduleCache = {};
+        moduleCacheVersion = version;
+    }
+    var missing = _.filter(names, function (name) { return !_.has(moduleCache, name); });
+    if (missing.length === 0) {
+        callback(moduleCache);
+        return;
+    }
+    $.get('/HIT/modules/?' + $.param({v : version, names : missing.sort()}, true), function (data) {
+        _.extend(moduleCache, data);
+        callback(moduleCache);
+    });
+}
+
 var hitLoadingTime = undefined;
 var maxWaitingTime = 45 * 1000;
 
@@ -93,6 +207,12 @@ function requestNextTask(response) {
 	      return;
     }
 
+    if (response && response.next_task) {
+        // the submit response already carries the next task
+        showTask(response.next_task);
+        return;
+    }
+
     if (hitLoadingTime === undefined) {
 	      hitLoadingTime = Date.now();
     }
@@ -106,14 +226,14 @@ function requestNextTask(response) {
         });
         return;
     }
-    var getData = {};
+    var getData = {lean : 1};
     var forcedId = getForcedHit();
     if (forcedId !== undefined) {
         getData['force'] = true;
         getData['hitid'] = forcedId;
         getData['workerid'] = $('#login-panel').find('input:first').val();
     }
-    $.post('/HIT/view/', getData, function(data) {
+    postWithRetry('/HIT/view/', getData, function(data) {
 	      $('.loading-holder').hide();
 
 	      if (data.no_hits) {
@@ -148,9 +268,33 @@ function requestNextTask(response) {
 	          $('#login-panel').hide();
 	          $('.turk-verify-content').show().find('.secret-code').html(data.verify_code);
 	      } else {
-            $('#hit-progress').text("You are on task " + (+data.task_num + 1) + " of " + data.num_tasks  + ".");
-            showWithData(data.task, data.modules);
+            showTask(data);
 	      }
+    }, function () {
+        $('.loading-holder').hide();
+        $('.content-main').show();
+        $("#other-error").show().text('The server is very busy. Please reload this page in a minute.');
+    });
+}
+
+function showTask(data) {
+    connectSocket();
+    submissionId = newSubmissionId();
+    $('#hit-progress').text("You are on task " + (+data.task_num + 1) + " of " + data.num_tasks  + ".");
+    if (data.modules) {
+        showWithData(data.task, data.modules);
+        return;
+    }
+    if (data.task.document) {
+        // fetch the document while the modules load, e.g. for the next task of a submit response
+        fetchDocument(data.task.document);
+    }
+    loadModules(data.task.modules, data.modules_version, function (modules) {
+        showWithData(data.task, modules);
+        // warm the cache with the modules of the remaining tasks in the background
+        if (data.hit_modules) {
+            loadModules(data.hit_modules, data.modules_version, function () {});
+        }
     });
 }
 
@@ -195,14 +339,48 @@ function onLoad() {
     requestNextTask();
 }
 
-function submitTask(callback) {
+// Every task shown gets a new submission id, which its submission and all retries of it
+// carry, so that the server stores the response once and answers a retry like the first.
+var submissionId = null;
+
+function newSubmissionId() {
+    var bytes = new Uint8Array(16);
+    if (window.crypto && window.crypto.getRandomValues) {
+        window.crypto.getRandomValues(bytes);
+    } else {
+        for (var i = 0; i < bytes.length; i++) bytes[i] = Math.floor(256 * Math.random());
+    }
+    return _.map(bytes, function (b) { return (b + 256).toString(16).slice(1); }).join('');
+}
+
+function submitTask(callback, attempt) {
+    attempt = attempt || 0;
     $("#next-task-button").attr('disabled', true);
-    $.post('/HIT/submit/', {data : JSON.stringify(serializeModules())}, callback)
-     .fail(function () {
+    if (socket) {
+        socketRequestId += 1;
+        var request = function (response) {
+            if (response && response.explanation === 'overloaded' && attempt < maxRetries) {
+                setTimeout(function () {
+                    submitTask(callback, attempt + 1);
+                }, retryDelay(response.retry_after, attempt));
+            } else {
+                callback(response);
+            }
+        };
+        request.resend = function () {
+            submitTask(callback, attempt + 1);
+        };
+        socketRequests[socketRequestId] = request;
+        socket.send(JSON.stringify({type : 'submit', id : socketRequestId, requestid : submissionId,
+                                    data : serializeModules(), prefetch : 1}));
+        return;
+    }
+    var postData = {data : JSON.stringify(serializeModules()), requestid : submissionId, prefetch : 1};
+    postWithRetry('/HIT/submit/', postData, callback, function () {
         $('#unknown-error').show();
         scrollToBottom($("#hit-modules-scroll"));
         $("#next-task-button").attr('disabled', false);
-     });
+    });
 }
 
 function serializeModules() {
@@ -230,14 +408,45 @@ function showMyImage(fileInput,element) {
         var img=element.parent().parent().find('img')[0]; 
         img.style.display="";           
         img.file = file;    
-        var reader = new FileReader();
         var hiddenElement=element.parent().parent().children('input')[0];
-        reader.onload = (function(aImg,hiddenElement) { 
-            return function(e) { 
-                aImg.src = e.target.result;
-                hiddenElement.value=aImg.src;
-            }; 
-        })(img,hiddenElement);
-        reader.readAsDataURL(file);
+        hiddenElement.value="";
+        img.src = window.URL.createObjectURL(file);
+        uploadImage(file, hiddenElement);
     }    
-}
\ No newline at end of file
+}
+
+// Streams the raw image to the server, which answers with a blob id that the
+// submission refers to. An overloaded server is asked again later; otherwise
+// falls back to sending the image as a data URL.
+function uploadImage(file, hiddenElement, attempt) {
+    attempt = attempt || 0;
+    $.ajax({
+        url : '/HIT/upload/',
+        type : 'POST',
+        data : file,
+        processData : false,
+        contentType : file.type
+    }).done(function (data) {
+        if (data.blob) {
+            hiddenElement.value = 'blob:' + data.blob;
+        } else {
+            readImageAsDataURL(file, hiddenElement);
+        }
+    }).fail(function (xhr) {
+        if (xhr.status === 503 && attempt < maxRetries) {
+            setTimeout(function () {
+                uploadImage(file, hiddenElement, attempt + 1);
+            }, retryDelay(+xhr.getResponseHeader('Retry-After'), attempt));
+        } else {
+            readImageAsDataURL(file, hiddenElement);
+        }
+    });
+}
+
+function readImageAsDataURL(file, hiddenElement) {
+    var reader = new FileReader();
+    reader.onload = function(e) {
+        hiddenElement.value = e.target.result;
+    };
+    reader.readAsDataURL(file);
+}